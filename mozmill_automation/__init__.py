@@ -3,4 +3,10 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
 
+from archive import replay_cli
+from compare import compare_cli
+from jsonlog import logquery_cli
+from merge import merge_cli
+from plan import plan_cli
+from session import session_cli
 from testrun import *
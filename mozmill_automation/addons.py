@@ -0,0 +1,89 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from datetime import datetime
+import os
+import re
+import zipfile
+
+
+RESOURCES_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'resources', 'addons')
+
+INSTALL_TEST = os.path.join(RESOURCES_FOLDER, 'testInstallAddon.js')
+UNINSTALL_TEST = os.path.join(RESOURCES_FOLDER, 'testUninstallAddon.js')
+
+BOOTSTRAP_PATTERN = re.compile(r'<em:bootstrap>\s*true\s*</em:bootstrap>|'
+                               r'em:bootstrap=["\']true["\']')
+
+
+def get_install_manifest(path):
+    """Return the content of the install.rdf file of an add-on."""
+
+    if os.path.isdir(path):
+        with open(os.path.join(path, 'install.rdf'), 'r') as f:
+            return f.read()
+
+    with zipfile.ZipFile(path) as xpi:
+        return xpi.read('install.rdf')
+
+
+def is_restartless(path):
+    """Check if the add-on can be installed without restarting the application."""
+
+    try:
+        return bool(BOOTSTRAP_PATTERN.search(get_install_manifest(path)))
+    except (IOError, KeyError, zipfile.BadZipfile):
+        return False
+
+
+def get_helper_test(path):
+    """Return a manifest entry for a helper test of the automation scripts."""
+
+    return {'path': path,
+            'name': os.path.basename(path),
+            'here': os.path.dirname(path)}
+
+
+def get_suite_reports(report, date_format):
+    """Split the report of a session with several add-on suites by suite.
+
+    Each suite starts with the helper test which installs its add-on. The
+    results of the helper tests are only kept when they have failed.
+    """
+    suites = []
+    for result in report['results']:
+        filename = os.path.abspath(result.get('filename', ''))
+        if filename == INSTALL_TEST:
+            suites.append([])
+
+        if not suites:
+            continue
+
+        if filename in (INSTALL_TEST, UNINSTALL_TEST) and not result.get('failed'):
+            continue
+
+        suites[-1].append(result)
+
+    return [get_report(report, results, date_format) for results in suites]
+
+
+def get_report(report, results, date_format):
+    """Return a copy of the report for the given subset of results."""
+
+    report = dict(report)
+    report['results'] = results
+
+    report['tests_failed'] = len([result for result in results if result.get('failed')])
+    report['tests_skipped'] = len([result for result in results if result.get('skipped')])
+    report['tests_passed'] = len(results) - report['tests_failed'] - report['tests_skipped']
+
+    # Results store their times in milliseconds since the epoch
+    times = [result[key] for result in results
+             for key in ('time_start', 'time_end') if key in result]
+    if times:
+        report['time_start'] = datetime.utcfromtimestamp(min(times) / 1000).strftime(date_format)
+        report['time_end'] = datetime.utcfromtimestamp(max(times) / 1000).strftime(date_format)
+
+    return report
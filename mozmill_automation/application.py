@@ -2,10 +2,18 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import hashlib
 import os
 import re
 
 import mozinfo
+import mozversion
+
+import metrics
+
+
+# Files read by mozversion which identify the version of a build
+VERSION_FILES = ('application.ini', 'platform.ini')
 
 
 def get_mozmill_tests_branch(gecko_branch):
@@ -29,6 +37,41 @@ def get_mozmill_tests_branch(gecko_branch):
     return branch
 
 
+def get_version_info(binary, cache=None):
+    """ Returns the version information of the binary.
+
+    If a cache is given the information is only probed again when the
+    content of the ini files of the build has been changed.
+    """
+    folder = os.path.dirname(os.path.abspath(binary))
+
+    signature = hashlib.md5()
+    found = False
+    for path in (folder, os.path.join(folder, os.pardir, 'Resources')):
+        for name in VERSION_FILES:
+            filename = os.path.join(path, name)
+            if os.path.isfile(filename):
+                with open(filename, 'rb') as f:
+                    signature.update(f.read())
+                found = True
+
+    key = os.path.abspath(binary)
+    if cache and found:
+        entry = cache.get(key)
+        if entry and entry['signature'] == signature.hexdigest():
+            metrics.inc('cache_requests_total', cache='versions', result='hit')
+            return entry['version_info']
+        metrics.inc('cache_requests_total', cache='versions', result='miss')
+
+    version_info = mozversion.get_version(binary)
+
+    if cache and found:
+        cache.set(key, {'signature': signature.hexdigest(),
+                        'version_info': version_info})
+
+    return version_info
+
+
 def is_application(path, application):
     """Check if the path is a supported application"""
     if path.endswith('.app'):
@@ -42,6 +85,15 @@ def is_application(path, application):
     return os.path.exists(os.path.join(path, application))
 
 
+def get_application_folder(binary):
+    """ Returns the folder of the application the binary belongs to. """
+    if mozinfo.isMac:
+        # The folder is the app bundle on OS X
+        return re.compile('.*\.app/').search(binary).group()
+
+    return os.path.dirname(binary)
+
+
 def is_installer(path, application):
     """ Checks if a binary is an installer. """
     try:
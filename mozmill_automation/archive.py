@@ -0,0 +1,168 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import multiprocessing
+import optparse
+import os
+import sys
+import traceback
+
+import files
+
+
+ARCHIVE_VERSION = 1
+
+EXTENSIONS = ('.json.gz', '.json')
+
+
+def write_archive(filename, raw_report, metadata):
+    """Write the raw results and the metadata of a testrun.
+
+    The raw results are the report of Mozmill before the testrun specific
+    data gets added, so the dashboard and JUnit reports can be regenerated.
+    """
+    data = {'archive_version': ARCHIVE_VERSION,
+            'metadata': metadata,
+            'report': raw_report}
+
+    # Endurance results are serialized one at a time from the event log
+    if 'endurance' in metadata:
+        files.JSONFile(filename).write_stream(data, 'metadata.endurance.results',
+                                              metadata['endurance']['results'])
+    else:
+        files.JSONFile(filename).write(data)
+
+
+def read_archive(filename):
+    """Return the raw results and the metadata of an archived testrun."""
+
+    data = files.JSONFile(filename).read()
+    if data.get('archive_version') != ARCHIVE_VERSION:
+        raise ValueError('Unsupported archive version %s: %s' % (
+            data.get('archive_version'), filename))
+
+    return data['report'], data['metadata']
+
+
+def get_name(filename):
+    name = os.path.basename(filename)
+    for extension in EXTENSIONS:
+        if name.endswith(extension):
+            return name[:-len(extension)]
+
+    return name
+
+
+def find_archives(paths):
+    """Return the archives at the given paths, whereby folders get scanned."""
+
+    archives = []
+    for path in paths:
+        if os.path.isdir(path):
+            archives.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                   if name.endswith(EXTENSIONS)))
+        else:
+            archives.append(path)
+
+    return archives
+
+
+def replay_archive(filename, output=None, junit=False, report_url=None):
+    """Regenerate the reports of an archived testrun."""
+
+    # Import here so the archives can be written without a cyclic import
+    import reports
+
+    raw_report, metadata = read_archive(filename)
+    report = reports.build_report(raw_report, metadata)
+
+    name = get_name(filename)
+    if output:
+        files.JSONFile(os.path.join(output, '%s.json' % name)).write(report)
+
+        if junit:
+            junit_file = os.path.join(output, '%s.xml' % name)
+            junit_report = reports.JUnitReport(junit_file, None)
+            junit_report.send_report(junit_report.render(report, str(report['report_type'])),
+                                     junit_file)
+
+    if report_url:
+        dashboard = reports.DashboardReport(report_url, None)
+        dashboard.send_report(report, report_url)
+
+    return {'name': name,
+            'report_type': report['report_type'],
+            'tests_passed': report['tests_passed'],
+            'tests_failed': report['tests_failed'],
+            'tests_skipped': report['tests_skipped']}
+
+
+def _replay_archive(args):
+    filename, kwargs = args
+    try:
+        return replay_archive(filename, **kwargs)
+    except Exception:
+        return {'name': get_name(filename), 'error': traceback.format_exc()}
+
+
+def replay_cli(args=sys.argv[1:]):
+    usage = "usage: %prog [options] (archive|folder) [(archive|folder) ...]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("--junit",
+                      dest="junit",
+                      default=False,
+                      action="store_true",
+                      help="also write JUnit XML style reports to the "
+                           "output folder")
+    parser.add_option("--output",
+                      dest="output",
+                      metavar="PATH",
+                      help="folder to write the regenerated dashboard "
+                           "reports to")
+    parser.add_option("--parallel",
+                      dest="parallel",
+                      default=multiprocessing.cpu_count(),
+                      type="int",
+                      metavar="PROCESSES",
+                      help="number of archives to replay at the same time "
+                           "[default: %default]")
+    parser.add_option("--report",
+                      dest="report_url",
+                      metavar="URL",
+                      help="send the regenerated reports to the report server")
+    options, args = parser.parse_args(args)
+
+    if not args:
+        parser.error("At least one archive has to be specified.")
+
+    if not (options.output or options.report_url):
+        parser.error("No output has been specified.")
+
+    if options.junit and not options.output:
+        parser.error("JUnit reports require an output folder.")
+
+    archives = find_archives(args)
+    kwargs = dict(output=options.output, junit=options.junit,
+                  report_url=options.report_url)
+
+    pool = multiprocessing.Pool(max(1, min(options.parallel, len(archives) or 1)))
+    try:
+        summaries = pool.map(_replay_archive, [(filename, kwargs) for filename in archives])
+    finally:
+        pool.close()
+        pool.join()
+
+    failed = 0
+    for summary in summaries:
+        if 'error' in summary:
+            failed += 1
+            print 'Failed to replay %s:\n%s' % (summary['name'], summary['error'])
+        else:
+            print 'Replayed %s (%s): %d passed, %d failed, %d skipped' % (
+                summary['name'], summary['report_type'], summary['tests_passed'],
+                summary['tests_failed'], summary['tests_skipped'])
+
+    print 'Replayed %d of %d archives' % (len(archives) - failed, len(archives))
+
+    sys.exit(3 if failed else 0)
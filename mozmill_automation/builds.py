@@ -0,0 +1,129 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from multiprocessing.pool import ThreadPool
+import os
+
+import application
+import metrics
+
+
+# Folders of build drops which never contain an installer
+IGNORED_FOLDERS = ('logs', 'mar-tools', 'symbols', 'xpi')
+
+IGNORED_FILES = ('.DS_Store',)
+
+
+def get_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+class BuildFinder(object):
+    """Class to find installers of an application inside a folder.
+
+    Folders are scanned in alphabetical order, whereby the files of a folder
+    are checked before its sub folders. The sub folders of the top-level
+    folder are scanned concurrently, and the result is cached with the
+    modification times of all scanned folders.
+    """
+
+    def __init__(self, application, cache=None, max_depth=5, workers=8):
+        self.application = application
+        self.cache = cache
+        self.max_depth = max_depth
+        self.workers = workers
+
+    def _is_candidate(self, filename):
+        if filename in IGNORED_FILES:
+            return False
+
+        return application.is_installer(filename, self.application)
+
+    def _list_folder(self, path, mtimes):
+        """Return the sorted lists of candidate files and sub folders, and
+        record the modification time of the folder.
+        """
+        builds = []
+        folders = []
+
+        try:
+            mtimes[path] = os.path.getmtime(path)
+            entries = sorted(os.listdir(path))
+        except OSError:
+            return builds, folders
+
+        for entry in entries:
+            entry_path = os.path.join(path, entry)
+            if os.path.isdir(entry_path):
+                if not entry.startswith('.') and not entry in IGNORED_FOLDERS:
+                    folders.append(entry_path)
+            elif self._is_candidate(entry):
+                builds.append(entry_path)
+
+        return builds, folders
+
+    def _scan(self, path, depth, first_only, mtimes):
+        builds, folders = self._list_folder(path, mtimes)
+        if first_only and builds:
+            return builds[:1]
+
+        if self.max_depth is None or depth < self.max_depth:
+            for folder in folders:
+                builds.extend(self._scan(folder, depth + 1, first_only, mtimes))
+                if first_only and builds:
+                    break
+
+        return builds
+
+    def _scan_concurrently(self, path, first_only, mtimes):
+        builds, folders = self._list_folder(path, mtimes)
+        if (first_only and builds) or not folders or self.max_depth == 0:
+            return builds[:1] if first_only else builds
+
+        pool = ThreadPool(min(self.workers, len(folders)))
+        try:
+            # The results are returned in the order of the folders, so the
+            # selection is stable regardless of which scan finishes first
+            results = pool.map(lambda folder: self._scan(folder, 1, first_only, mtimes),
+                               folders)
+        finally:
+            pool.close()
+            pool.join()
+
+        for result in results:
+            builds.extend(result)
+
+        return builds[:1] if first_only else builds
+
+    def find(self, path, first_only=True):
+        """Return the installers found in the given folder.
+
+        If first_only is set only the first installer in alphabetical order
+        is returned, otherwise all of them.
+        """
+        path = os.path.abspath(path)
+        key = '|'.join([path, self.application, 'first' if first_only else 'all'])
+
+        if self.cache:
+            # Builds added to or removed from any of the scanned folders
+            # change the modification time of that folder
+            entry = self.cache.get(key)
+            if entry and entry.get('mtimes') and \
+                    all(os.path.isfile(build) for build in entry['builds']) and \
+                    all(get_mtime(folder) == mtime
+                        for folder, mtime in entry['mtimes'].items()):
+                metrics.inc('cache_requests_total', cache='builds', result='hit')
+                return entry['builds']
+            metrics.inc('cache_requests_total', cache='builds', result='miss')
+
+        mtimes = {}
+        builds = self._scan_concurrently(path, first_only, mtimes)
+
+        if self.cache:
+            self.cache.set(key, {'mtimes': mtimes, 'builds': builds})
+
+        return builds
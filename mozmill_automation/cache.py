@@ -0,0 +1,93 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import tempfile
+import threading
+
+import errors
+import files
+
+
+def get_cache_folder(path=None):
+    """Return the folder used to persist data across testruns."""
+
+    if path:
+        path = os.path.abspath(os.path.expanduser(path))
+    else:
+        path = os.path.join(tempfile.gettempdir(), 'mozmill-automation-cache')
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    return path
+
+
+class JSONCache(object):
+    """Persistent key/value store backed by a single JSON file.
+
+    The cache can be shared by processes, which is why changes are merged
+    into the latest content of the file under a file lock.
+    """
+
+    def __init__(self, folder, name):
+        self.filename = os.path.join(folder, '%s.json' % name)
+
+        self._data = None
+        self._stat = None
+        self._lock = threading.Lock()
+
+    def _get_stat(self):
+        try:
+            stat = os.stat(self.filename)
+            return (stat.st_mtime, stat.st_size)
+        except OSError:
+            return None
+
+    def _load(self):
+        # Reload the file whenever another process has written it
+        stat = self._get_stat()
+        if self._data is None or stat != self._stat:
+            self._stat = stat
+            try:
+                self._data = files.JSONFile(self.filename).read()
+            except (errors.NotFoundException, ValueError):
+                # A missing or corrupt cache only means we start from scratch
+                self._data = {}
+
+        return self._data
+
+    def _write(self):
+        files.JSONFile(self.filename).write(self._data)
+        self._stat = self._get_stat()
+
+    def get(self, key, default=None):
+        """Return the cached value for the given key."""
+
+        with self._lock:
+            return self._load().get(key, default)
+
+    def items(self):
+        """Return a copy of all cached keys and values."""
+
+        with self._lock:
+            return list(self._load().items())
+
+    def set(self, key, value):
+        """Store a value for the given key and write the cache to disk."""
+
+        with self._lock:
+            with files.FileLock(self.filename + '.lock'):
+                self._data = None
+                self._load()[key] = value
+                self._write()
+
+    def remove(self, key):
+        """Remove the given key from the cache."""
+
+        with self._lock:
+            with files.FileLock(self.filename + '.lock'):
+                self._data = None
+                if self._load().pop(key, None) is not None:
+                    self._write()
@@ -0,0 +1,345 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import math
+import optparse
+import os
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import endurance
+import files
+
+
+METHODS = ('bootstrap', 'mannwhitney')
+
+# Comparisons with fewer samples are reported as inconclusive
+MIN_SAMPLES = 5
+
+# Test name used for the comparison of all tests together
+ALL_TESTS = '*'
+
+# Number of bootstrap resamples which get drawn at once
+BOOTSTRAP_CHUNK_SIZE = 1000
+
+# Minimum number of bootstrap means beyond each bound of the interval, so
+# the percentiles of corrected significance levels can still be estimated
+BOOTSTRAP_TAIL_SAMPLES = 25
+
+
+def read_endurance(filename):
+    """Return the name of the build and the endurance results of a dashboard
+    report or an archived testrun.
+    """
+    report_file = files.JSONFile(filename)
+    data = report_file.read(skip=('endurance', 'metadata', 'report', 'results'))
+
+    if 'archive_version' in data:
+        header = report_file.read(skip=('metadata',))['report']
+        results = list(report_file.items('metadata.endurance.results'))
+    else:
+        header = data
+        results = list(report_file.items('endurance.results'))
+
+    if header.get('application_version'):
+        name = '%s (%s)' % (header['application_version'],
+                            header.get('application_buildid', 'unknown'))
+    else:
+        name = os.path.basename(filename)
+
+    return name, results
+
+
+def get_samples(results):
+    """Return the values of each metric by test and checkpoint.
+
+    Checkpoints are identified by the index of their iteration, their label,
+    and how often that label occurred before within the iteration.
+    """
+    samples = {}
+    for test in results:
+        for iteration_index, iteration in enumerate(test.get('iterations', [])):
+            occurrences = {}
+            for checkpoint in iteration.get('checkpoints', []):
+                label = checkpoint.get('label')
+                occurrences[label] = occurrences.get(label, -1) + 1
+                key = (iteration_index, label, occurrences[label])
+
+                for metric in endurance.get_metrics(checkpoint):
+                    value = checkpoint[metric]
+                    if isinstance(value, list):
+                        if not value:
+                            continue
+                        value = endurance.mean(value)
+                    samples.setdefault((test.get('name'), metric), {})[key] = value
+
+    # Compare all tests together, too
+    for (test, metric), values in samples.items():
+        combined = samples.setdefault((ALL_TESTS, metric), {})
+        for key, value in values.items():
+            combined[(test,) + key] = value
+
+    return samples
+
+
+def align(baseline, candidate):
+    """Return the values of the checkpoints which exist in both sets."""
+
+    keys = sorted(set(baseline) & set(candidate))
+    return (numpy.array([baseline[key] for key in keys], dtype=float),
+            numpy.array([candidate[key] for key in keys], dtype=float))
+
+
+def get_resamples(confidence, resamples):
+    """Return the number of bootstrap resamples needed for the interval."""
+
+    tail = (1 - confidence) / 2.0
+    return max(resamples, int(math.ceil(BOOTSTRAP_TAIL_SAMPLES / tail)))
+
+
+def bootstrap_interval(differences, confidence, resamples, random):
+    """Return the confidence interval of the mean of the differences.
+
+    The number of resamples is increased for high confidence levels.
+    """
+    resamples = get_resamples(confidence, resamples)
+
+    count = len(differences)
+    means = []
+    for start in range(0, resamples, BOOTSTRAP_CHUNK_SIZE):
+        size = min(BOOTSTRAP_CHUNK_SIZE, resamples - start)
+        indexes = random.randint(0, count, size=(size, count))
+        means.append(differences[indexes].mean(axis=1))
+
+    alpha = (1 - confidence) / 2.0
+    low, high = numpy.percentile(numpy.concatenate(means),
+                                 [100 * alpha, 100 * (1 - alpha)])
+
+    return float(low), float(high)
+
+
+def mann_whitney(baseline, candidate):
+    """Return the two-sided p-value of the Mann-Whitney U test, based on the
+    normal approximation with tie correction.
+    """
+    count_a, count_b = len(baseline), len(candidate)
+    values = numpy.concatenate([baseline, candidate])
+
+    # Tied values get the average of their ranks
+    _, inverse, counts = numpy.unique(values, return_inverse=True, return_counts=True)
+    ends = numpy.cumsum(counts)
+    ranks = (ends - (counts - 1) / 2.0)[inverse]
+
+    u = ranks[:count_a].sum() - count_a * (count_a + 1) / 2.0
+    expected = count_a * count_b / 2.0
+
+    count = count_a + count_b
+    ties = float((counts ** 3 - counts).sum())
+    variance = count_a * count_b / 12.0 * ((count + 1) - ties / (count * (count - 1)))
+    if variance <= 0:
+        return 1.0
+
+    # Apply the continuity correction
+    z = (abs(u - expected) - 0.5) / math.sqrt(variance)
+
+    return min(1.0, math.erfc(max(z, 0) / math.sqrt(2)))
+
+
+class EnduranceComparison(object):
+    """Class to compare the endurance results of a candidate build against
+    those of a baseline build.
+
+    Metrics measure the memory usage, so an increase is a regression. With
+    the bootstrap method the difference of a metric is significant if the
+    confidence interval of the mean difference of the aligned checkpoints is
+    entirely beyond the threshold. With the Mann-Whitney method all values of
+    both builds are compared. For both methods the significance level is
+    Bonferroni corrected for the number of compared metrics, whereby the
+    metrics of the single tests and of all tests together are corrected
+    separately.
+    """
+
+    def __init__(self, method='bootstrap', threshold=0.05, confidence=0.95,
+                 resamples=2000, seed=0):
+        if numpy is None:
+            raise ImportError('numpy is required to compare endurance results')
+
+        self.method = method
+        self.threshold = threshold
+        self.confidence = confidence
+        self.resamples = resamples
+        self.random = numpy.random.RandomState(seed)
+
+    def compare_metric(self, baseline, candidate, alpha):
+        """Compare the values of a metric by checkpoint of both builds."""
+
+        if self.method == 'bootstrap':
+            a, b = align(baseline, candidate)
+        else:
+            a = numpy.array(baseline.values(), dtype=float)
+            b = numpy.array(candidate.values(), dtype=float)
+
+        comparison = {'samples': min(len(a), len(b))}
+        if comparison['samples'] < MIN_SAMPLES:
+            comparison['verdict'] = 'inconclusive'
+            return comparison
+
+        reference = abs(a.mean()) or 1.0
+        comparison['baseline'] = float(a.mean())
+        comparison['candidate'] = float(b.mean())
+        comparison['delta'] = float(b.mean() - a.mean()) / reference
+
+        if self.method == 'bootstrap':
+            low, high = bootstrap_interval(b - a, 1 - alpha,
+                                           self.resamples, self.random)
+            comparison['interval'] = [low / reference, high / reference]
+            regressed = comparison['interval'][0] > self.threshold
+            improved = comparison['interval'][1] < -self.threshold
+        else:
+            comparison['p_value'] = mann_whitney(a, b)
+            significant = comparison['p_value'] < alpha
+            regressed = significant and comparison['delta'] > self.threshold
+            improved = significant and comparison['delta'] < -self.threshold
+
+        if regressed:
+            comparison['verdict'] = 'regression'
+        elif improved:
+            comparison['verdict'] = 'improvement'
+        else:
+            comparison['verdict'] = 'unchanged'
+
+        return comparison
+
+    def compare(self, baseline_results, candidate_results):
+        """Return the comparisons of all metrics of the tests in both builds."""
+
+        baseline = get_samples(baseline_results)
+        candidate = get_samples(candidate_results)
+        keys = sorted(set(baseline) & set(candidate))
+
+        # Bonferroni correction of the significance level, whereby the
+        # combined metrics are a family of their own
+        combined = len([key for key in keys if key[0] == ALL_TESTS])
+        alphas = {True: (1 - self.confidence) / max(1, combined),
+                  False: (1 - self.confidence) / max(1, len(keys) - combined)}
+
+        comparisons = []
+        for test, metric in keys:
+            comparison = {'test': test, 'metric': metric}
+            comparison.update(self.compare_metric(baseline[(test, metric)],
+                                                  candidate[(test, metric)],
+                                                  alphas[test == ALL_TESTS]))
+            comparisons.append(comparison)
+
+        return comparisons
+
+
+def get_verdict(comparisons):
+    verdicts = set(comparison['verdict'] for comparison in comparisons)
+    for verdict in ('regression', 'improvement', 'unchanged'):
+        if verdict in verdicts:
+            return verdict
+
+    return 'inconclusive'
+
+
+def compare_cli(args=sys.argv[1:]):
+    usage = "usage: %prog [options] baseline candidate [candidate ...]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("--confidence",
+                      dest="confidence",
+                      default=0.95,
+                      type="float",
+                      metavar="LEVEL",
+                      help="confidence level of the intervals and the "
+                           "significance tests [default: %default]")
+    parser.add_option("--method",
+                      dest="method",
+                      default="bootstrap",
+                      choices=METHODS,
+                      metavar="METHOD",
+                      help="bootstrap confidence intervals of the aligned "
+                           "checkpoints (bootstrap), or the Mann-Whitney U "
+                           "test of all values (mannwhitney) [default: %default]")
+    parser.add_option("--output",
+                      dest="output",
+                      metavar="PATH",
+                      help="file to write the comparisons to as JSON")
+    parser.add_option("--resamples",
+                      dest="resamples",
+                      default=2000,
+                      type="int",
+                      metavar="COUNT",
+                      help="minimum number of bootstrap resamples, which "
+                           "is increased for the corrected confidence level "
+                           "[default: %default]")
+    parser.add_option("--threshold",
+                      dest="threshold",
+                      default=0.05,
+                      type="float",
+                      metavar="FRACTION",
+                      help="minimum growth of a metric relative to the "
+                           "baseline to be a regression [default: %default]")
+    parser.add_option("--verbose",
+                      dest="verbose",
+                      default=False,
+                      action="store_true",
+                      help="also print metrics which are unchanged")
+    options, args = parser.parse_args(args)
+
+    if len(args) < 2:
+        parser.error("A baseline and at least one candidate have to be specified.")
+
+    if numpy is None:
+        parser.error("numpy is required, which can be installed via "
+                     "'pip install mozmill-automation[compare]'.")
+
+    comparison = EnduranceComparison(options.method, options.threshold,
+                                     options.confidence, options.resamples)
+
+    baseline_name, baseline_results = read_endurance(args[0])
+
+    output = []
+    verdicts = []
+    for filename in args[1:]:
+        name, results = read_endurance(filename)
+        comparisons = comparison.compare(baseline_results, results)
+        verdict = get_verdict(comparisons)
+        verdicts.append(verdict)
+        output.append({'baseline': baseline_name,
+                       'candidate': name,
+                       'verdict': verdict,
+                       'comparisons': comparisons})
+
+        print 'Comparing %s against %s' % (name, baseline_name)
+        print '%-32s %-20s %14s %14s %9s %20s  %s' % (
+            'Test', 'Metric', 'Baseline', 'Candidate', 'Delta',
+            'Interval' if options.method == 'bootstrap' else 'p-value', 'Verdict')
+        for entry in comparisons:
+            if entry['verdict'] in ('unchanged', 'inconclusive') and not options.verbose:
+                continue
+            if entry['verdict'] == 'inconclusive':
+                print '%-32s %-20s %14s %14s %9s %20s  %s' % (
+                    entry['test'], entry['metric'], '-', '-', '-', '-', entry['verdict'])
+                continue
+
+            if options.method == 'bootstrap':
+                significance = '[%+.1f%%, %+.1f%%]' % (entry['interval'][0] * 100,
+                                                      entry['interval'][1] * 100)
+            else:
+                significance = '%.2g' % entry['p_value']
+            print '%-32s %-20s %14.1f %14.1f %+8.1f%% %20s  %s' % (
+                entry['test'], entry['metric'], entry['baseline'], entry['candidate'],
+                entry['delta'] * 100, significance, entry['verdict'])
+        print 'Verdict: %s' % verdict
+
+    if options.output:
+        files.JSONFile(options.output).write(output)
+
+    # Regressions are reported like failed tests, so they can gate automation
+    sys.exit(2 if 'regression' in verdicts else 0)
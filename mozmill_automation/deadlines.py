@@ -0,0 +1,180 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import math
+import os
+import threading
+import time
+
+import mozlog
+
+
+# Number of durations which are kept for each test
+MAX_SAMPLES = 50
+
+# Number of durations needed before a deadline gets enforced
+MIN_SAMPLES = 3
+
+
+def percentile(values, fraction):
+    """Return the value at the given fraction of the sorted values."""
+
+    values = sorted(values)
+    index = int(math.ceil(fraction * len(values))) - 1
+
+    return values[max(0, min(index, len(values) - 1))]
+
+
+class DurationHistory(object):
+    """Class to track the durations of passed tests across testruns.
+
+    All durations are stored under a single key in the cache, which should
+    identify the kind of testrun, so that only comparable durations get
+    mixed up.
+    """
+
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+
+        self.durations = self.cache.get(self.key) or {}
+        self.modified = False
+
+    def add(self, test_id, duration):
+        samples = self.durations.setdefault(test_id, [])
+        samples.append(round(duration, 3))
+        del samples[:-MAX_SAMPLES]
+
+        self.modified = True
+
+    def get_deadline(self, test_id, factor, slack):
+        """Return the allowed duration of the test in seconds, or None if not
+        enough durations have been recorded yet.
+        """
+        samples = self.durations.get(test_id, [])
+        if len(samples) < MIN_SAMPLES:
+            return None
+
+        return percentile(samples, 0.99) * factor + slack
+
+    def save(self):
+        if self.modified:
+            self.cache.set(self.key, self.durations)
+            self.modified = False
+
+
+class Watchdog(object):
+    """Mozmill handler to kill the application when a test hangs.
+
+    The deadline of each test is derived from its historical durations. Once
+    it has been exceeded the given callback gets called to kill the
+    application, and the test is remembered as expired, so the testrun can
+    continue with the next test.
+    """
+
+    def __init__(self, history, root, kill, factor=3, slack=30, interval=1):
+        self.history = history
+        self.root = root
+        self.kill = kill
+        self.factor = factor
+        self.slack = slack
+        self.interval = interval
+
+        self.logger = mozlog.getLogger('mozmill-automation')
+
+        self.current = None
+        self.expired = None
+        self.timeouts = {}
+        self.timed_out = []
+
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def get_test_id(self, obj):
+        filename = obj.get('filename') or ''
+        if filename.startswith(self.root):
+            filename = os.path.relpath(filename, self.root).replace(os.sep, '/')
+
+        return '%s::%s' % (filename, obj.get('name'))
+
+    def events(self):
+        return {'mozmill.setTest': self.start_test,
+                'mozmill.endTest': self.end_test}
+
+    def start_test(self, obj):
+        test_id = self.get_test_id(obj)
+        deadline = self.history.get_deadline(test_id, self.factor, self.slack)
+
+        with self._lock:
+            self.current = {'id': test_id,
+                            'filename': obj.get('filename'),
+                            'start': time.time(),
+                            'deadline': deadline}
+        if deadline is not None:
+            self.timeouts[test_id] = deadline
+
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def end_test(self, obj):
+        with self._lock:
+            current, self.current = self.current, None
+
+        # Only passing tests are representative for the duration
+        if current and not obj.get('failed') and not obj.get('skipped'):
+            self.history.add(current['id'], time.time() - current['start'])
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            with self._lock:
+                current = self.current
+                if not current or current['deadline'] is None or \
+                        time.time() - current['start'] < current['deadline']:
+                    continue
+
+                self.current = None
+                self.expired = current
+                self.timed_out.append(current['id'])
+
+            self.logger.error('Test %s exceeded its timeout of %.0fs, killing the application' % (
+                current['id'], current['deadline']))
+            try:
+                self.kill()
+            except Exception:
+                self.logger.exception('Failed to kill the application')
+
+    def get_remaining_tests(self, tests):
+        """Return the tests following the test file which has been expired."""
+
+        filenames = [os.path.abspath(test['path']) for test in tests]
+        try:
+            index = filenames.index(os.path.abspath(self.expired['filename']))
+        except (TypeError, ValueError):
+            return []
+
+        return tests[index + 1:]
+
+    def add_timeouts(self, report):
+        """Add the enforced timeouts to the results of the report."""
+
+        for result in report['results']:
+            test_id = self.get_test_id(result)
+            if test_id in self.timeouts:
+                result['timeout'] = self.timeouts[test_id]
+            if test_id in self.timed_out:
+                result['timed_out'] = True
+
+        report['timed_out_tests'] = list(self.timed_out)
+
+    def stop(self, results=None, fatal=False):
+        if self._thread:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+
+        self.history.save()
@@ -0,0 +1,252 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import BaseHTTPServer
+import json
+import os
+import socket
+import SocketServer
+import threading
+import time
+import urllib2
+
+import mozlog
+
+
+# Number of times a shard is handed out before the testrun gets aborted
+MAX_ATTEMPTS = 3
+
+
+def get_test_id(test, root):
+    """Return the identifier of a manifest test relative to the repository."""
+
+    return os.path.relpath(test['path'], root).replace(os.sep, '/')
+
+
+class Coordinator(object):
+    """Class to distribute shards of tests to workers via HTTP.
+
+    Workers lease a shard, send heartbeats while executing it, and post the
+    report once it has been finished. Shards of workers which haven't sent a
+    heartbeat within the lease timeout get reassigned to other workers.
+    """
+
+    def __init__(self, tests, shard_size=10, lease_timeout=120):
+        self.logger = mozlog.getLogger('mozmill-automation')
+        self.lease_timeout = lease_timeout
+
+        self.shards = {}
+        self.pending = []
+        for index in range(0, len(tests), shard_size):
+            shard_id = str(index / shard_size)
+            self.shards[shard_id] = {'id': shard_id,
+                                     'tests': tests[index:index + shard_size],
+                                     'attempts': 0}
+            self.pending.append(shard_id)
+
+        self.leases = {}
+        self.reports = {}
+        self.failed_shards = []
+
+        self.server = None
+        self._lock = threading.Lock()
+
+    @property
+    def finished(self):
+        with self._lock:
+            return len(self.reports) + len(self.failed_shards) == len(self.shards)
+
+    def _expire_leases(self):
+        now = time.time()
+        for shard_id, lease in self.leases.items():
+            if lease['expires'] < now:
+                self.logger.warning('Worker %s timed out, reassigning shard %s' % (
+                    lease['worker'], shard_id))
+                del self.leases[shard_id]
+
+                if self.shards[shard_id]['attempts'] >= MAX_ATTEMPTS:
+                    self.logger.error('Shard %s failed %d times' % (shard_id, MAX_ATTEMPTS))
+                    self.failed_shards.append(shard_id)
+                else:
+                    self.pending.append(shard_id)
+
+    def lease(self, worker):
+        with self._lock:
+            self._expire_leases()
+
+            if self.pending:
+                shard = self.shards[self.pending.pop(0)]
+                shard['attempts'] += 1
+                self.leases[shard['id']] = {'worker': worker,
+                                            'expires': time.time() + self.lease_timeout}
+                self.logger.info('Assigned shard %s to worker %s' % (shard['id'], worker))
+
+                return {'shard': {'id': shard['id'], 'tests': shard['tests']}}
+
+            if self.leases:
+                return {'wait': 5}
+
+            return {'done': True}
+
+    def heartbeat(self, worker, shard_id):
+        with self._lock:
+            lease = self.leases.get(shard_id)
+            if not lease or lease['worker'] != worker:
+                return {'cancelled': True}
+
+            lease['expires'] = time.time() + self.lease_timeout
+            return {}
+
+    def complete(self, worker, shard_id, report):
+        with self._lock:
+            self.leases.pop(shard_id, None)
+
+            # Results of a reassigned shard are only accepted once
+            if not shard_id in self.reports and not shard_id in self.failed_shards:
+                self.logger.info('Worker %s finished shard %s' % (worker, shard_id))
+                self.reports[shard_id] = report
+                if shard_id in self.pending:
+                    self.pending.remove(shard_id)
+
+            return {}
+
+    def start(self, host='', port=0):
+        parent = self
+
+        class Handler(CoordinatorRequestHandler):
+            coordinator = parent
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.logger.info('Coordinator listening at port %d for %d shards' % (
+            self.server.server_address[1], len(self.shards)))
+
+    def wait(self):
+        """Wait until all shards have been finished and return the reports."""
+
+        while not self.finished:
+            time.sleep(1)
+            with self._lock:
+                self._expire_leases()
+
+        # Let workers which are polling know that there is nothing left
+        time.sleep(5)
+
+        return [self.reports[shard_id] for shard_id in sorted(self.reports, key=int)]
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class CoordinatorRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Request handler for the work queue of the coordinator."""
+
+    coordinator = None
+
+    def log_message(self, format, *args):
+        self.coordinator.logger.debug('Coordinator: %s' % (format % args))
+
+    def do_POST(self):
+        data = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+
+        if self.path == '/lease':
+            response = self.coordinator.lease(data['worker'])
+        elif self.path == '/heartbeat':
+            response = self.coordinator.heartbeat(data['worker'], data['shard'])
+        elif self.path == '/complete':
+            response = self.coordinator.complete(data['worker'], data['shard'],
+                                                 data['report'])
+        else:
+            self.send_error(404)
+            return
+
+        content = json.dumps(response)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class Worker(object):
+    """Class to retrieve shards of tests from a coordinator."""
+
+    def __init__(self, url, heartbeat_interval=30):
+        self.url = url.rstrip('/')
+        self.heartbeat_interval = heartbeat_interval
+        self.id = '%s-%d' % (socket.gethostname(), os.getpid())
+
+        self.logger = mozlog.getLogger('mozmill-automation')
+
+    def _request(self, path, data):
+        data['worker'] = self.id
+        request = urllib2.Request(self.url + path, json.dumps(data),
+                                  {'Content-Type': 'application/json'})
+
+        return json.loads(urllib2.urlopen(request).read())
+
+    def _send_heartbeats(self, shard_id, stopped, cancelled, cancel):
+        while not stopped.wait(self.heartbeat_interval):
+            try:
+                response = self._request('/heartbeat', {'shard': shard_id})
+            except Exception:
+                self.logger.exception('Failed to send heartbeat to: %s' % self.url)
+                continue
+
+            # The shard has been reassigned to another worker
+            if response.get('cancelled'):
+                self.logger.warning('Shard %s has been reassigned, cancelling it' % shard_id)
+                cancelled.set()
+                if cancel:
+                    cancel()
+                break
+
+    def run(self, execute, cancel=None):
+        """Execute shards until the coordinator has none left.
+
+        The execute callback gets the list of tests of a shard and has to
+        return the report for them. The cancel callback gets called when the
+        coordinator has reassigned the shard, and has to stop the execution.
+        """
+        while True:
+            response = self._request('/lease', {})
+            if response.get('done'):
+                break
+
+            if 'wait' in response:
+                time.sleep(response['wait'])
+                continue
+
+            shard = response['shard']
+            self.logger.info('Executing shard %s with %d tests' % (
+                shard['id'], len(shard['tests'])))
+
+            stopped = threading.Event()
+            cancelled = threading.Event()
+            heartbeat = threading.Thread(target=self._send_heartbeats,
+                                         args=(shard['id'], stopped, cancelled, cancel))
+            heartbeat.daemon = True
+            heartbeat.start()
+            try:
+                report = execute(shard['tests'])
+            finally:
+                stopped.set()
+                heartbeat.join()
+
+            # Results of a cancelled shard are incomplete, and wouldn't be
+            # accepted by the coordinator anyway
+            if cancelled.is_set():
+                continue
+
+            self._request('/complete', {'shard': shard['id'], 'report': report})
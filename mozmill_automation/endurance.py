@@ -0,0 +1,303 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import math
+
+
+# Keys of a checkpoint which are not metrics
+BLACKLIST = ('timestamp', 'label')
+
+# Confidence level of the precision for adaptive iterations
+PRECISION_CONFIDENCE = 0.95
+
+
+def mean(values):
+    return float(sum(values)) / len(values)
+
+
+def normal_quantile(probability):
+    """Return the quantile of the standard normal distribution."""
+
+    low, high = -10.0, 10.0
+    while high - low > 1e-6:
+        middle = (low + high) / 2
+        if 0.5 * (1 + math.erf(middle / math.sqrt(2))) < probability:
+            low = middle
+        else:
+            high = middle
+
+    return (low + high) / 2
+
+
+def incomplete_beta(x, a, b):
+    """Return the regularized incomplete beta function by its continued fraction."""
+
+    if x <= 0 or x >= 1:
+        return max(0.0, min(1.0, x))
+
+    # The continued fraction converges quickly only below the mean
+    if x > (a + 1) / (a + b + 2):
+        return 1 - incomplete_beta(1 - x, b, a)
+
+    front = math.exp(math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) +
+                     a * math.log(x) + b * math.log(1 - x)) / a
+
+    tiny = 1e-30
+    c, d = 1.0, 1 - (a + b) * x / (a + 1)
+    d = 1 / (d if abs(d) > tiny else tiny)
+    result = d
+    for m in range(1, 200):
+        for numerator in (m * (b - m) * x / ((a + 2 * m - 1) * (a + 2 * m)),
+                          -(a + m) * (a + b + m) * x / ((a + 2 * m) * (a + 2 * m + 1))):
+            d = 1 + numerator * d
+            d = 1 / (d if abs(d) > tiny else tiny)
+            c = 1 + numerator / c
+            c = c if abs(c) > tiny else tiny
+            result *= c * d
+
+        if abs(c * d - 1) < 1e-10:
+            break
+
+    return front * result
+
+
+def t_quantile(probability, df):
+    """Return the quantile of the Student t distribution with the given
+    degrees of freedom, for probabilities above 0.5.
+    """
+    def cdf(t):
+        return 1 - 0.5 * incomplete_beta(df / (df + t * t), df / 2.0, 0.5)
+
+    low, high = 0.0, 1.0
+    while cdf(high) < probability:
+        low, high = high, high * 2
+
+    while high - low > 1e-6:
+        middle = (low + high) / 2
+        if cdf(middle) < probability:
+            low = middle
+        else:
+            high = middle
+
+    return (low + high) / 2
+
+
+def linear_regression(values):
+    """Return the slope and its standard error for values over their index."""
+
+    count = len(values)
+    x_mean = (count - 1) / 2.0
+    y_mean = mean(values)
+
+    sxx = sum((x - x_mean) ** 2 for x in range(count))
+    sxy = sum((x - x_mean) * (y - y_mean) for x, y in enumerate(values))
+    slope = sxy / sxx
+
+    if count < 3:
+        return slope, float('inf')
+
+    intercept = y_mean - slope * x_mean
+    residuals = sum((y - intercept - slope * x) ** 2 for x, y in enumerate(values))
+
+    return slope, math.sqrt(residuals / (count - 2) / sxx)
+
+
+def get_precision(values, z):
+    """Return the half width of the confidence interval relative to the mean."""
+
+    if len(values) < 2:
+        return None
+
+    value_mean = mean(values)
+    if not value_mean:
+        return None
+
+    variance = sum((value - value_mean) ** 2 for value in values) / (len(values) - 1)
+
+    return z * math.sqrt(variance / len(values)) / abs(value_mean)
+
+
+def get_metrics(checkpoint):
+    """Return the names of the metrics of a checkpoint."""
+
+    return [key for key in checkpoint.keys() if not key in BLACKLIST]
+
+
+def get_iteration_means(iteration):
+    """Return the mean value of each metric across the checkpoints of an iteration."""
+
+    values = {}
+    for checkpoint in iteration['checkpoints']:
+        for metric in get_metrics(checkpoint):
+            data = checkpoint[metric]
+            if not isinstance(data, list):
+                data = [data]
+            values.setdefault(metric, []).extend(data)
+
+    return dict((metric, mean(data)) for metric, data in values.items() if data)
+
+
+def get_test_precision(results, z):
+    """Return the precision of the mean of each metric across the iterations of a test."""
+
+    series = {}
+    for iteration in results.get('iterations', []):
+        for metric, value in get_iteration_means(iteration).items():
+            series.setdefault(metric, []).append(value)
+
+    return dict((metric, get_precision(values, z)) for metric, values in series.items())
+
+
+def calculate_stats(data, keys):
+    """Calculates the min/max/average of each key in data"""
+
+    stats = { }
+    for key in keys:
+        stats[key] = {'average' : sum(data[key]) / len(data[key]),
+                      'min' : min(data[key]),
+                      'max' : max(data[key])}
+    return stats
+
+
+def populate_metrics(dict, keys, data):
+    for key in keys:
+        _data = data[key]
+        if not isinstance(_data, list):
+            _data = [_data]
+        dict.setdefault(key, []).extend(_data)
+
+
+def iter_stats(endurance, results):
+    """Yield the results of the endurance tests with their stats added, and
+    add the stats of all results to the endurance data once all of them have
+    been yielded. Only the values of a single test are kept in memory.
+    """
+    metrics = []
+
+    # Sum, count, min, and max of each metric across all tests
+    totals = {}
+    for test in results:
+        test_metrics = {}
+
+        for iteration in test['iterations']:
+            iteration_metrics = {}
+
+            for checkpoint in iteration['checkpoints']:
+                if not metrics:
+                    metrics = get_metrics(checkpoint)
+
+                populate_metrics(iteration_metrics, metrics, checkpoint)
+
+            iteration['stats'] = calculate_stats(iteration_metrics, metrics)
+            populate_metrics(test_metrics, metrics, iteration_metrics)
+
+        test['stats'] = calculate_stats(test_metrics, metrics)
+
+        # Record the achieved precision of the adaptive iterations
+        if 'adaptive' in endurance:
+            z = endurance['adaptive']['z']
+            test['precision'] = get_test_precision(test, z)
+
+        for key in metrics:
+            total = totals.setdefault(key, [0, 0, None, None])
+            for value in test_metrics[key]:
+                total[0] += value
+                total[1] += 1
+                total[2] = value if total[2] is None else min(total[2], value)
+                total[3] = value if total[3] is None else max(total[3], value)
+
+        yield test
+
+    if totals:
+        endurance['stats'] = dict((key, {'average': total[0] / total[1],
+                                         'min': total[2],
+                                         'max': total[3]})
+                                  for key, total in totals.items())
+
+
+def add_stats(endurance):
+    """Add the stats of iterations, tests and all results to the endurance data.
+
+    Results which are not a list get their stats added while they are
+    iterated over, whereby the stats of all results are only available once
+    the iteration has been finished.
+    """
+    if isinstance(endurance['results'], list):
+        for _ in iter_stats(endurance, endurance['results']):
+            pass
+    else:
+        endurance['results'] = iter_stats(endurance, endurance['results'])
+
+    return endurance
+
+
+class LeakDetector(object):
+    """Class to detect memory leaks while the endurance tests are running.
+
+    For every test and metric the mean value of each iteration is tracked.
+    Tests are tracked separately, given that each of them starts with its own
+    memory baseline. A leak is reported when the lower confidence bound of
+    the growth per iteration exceeds the slope threshold, or when the growth
+    over all iterations based on that bound exceeds the growth threshold.
+    The bound is based on the Student t distribution, given that only a few
+    iterations might have been run.
+
+    Results arrive once a test has finished all of its iterations, so leaks
+    are detected per test and not while a test is still iterating.
+    """
+
+    def __init__(self, slope=None, growth=None, confidence=0.95,
+                 min_iterations=5):
+        self.slope = slope
+        self.growth = growth
+        # The regression needs at least three values for its standard error
+        self.min_iterations = max(min_iterations, 3)
+        self.confidence = confidence
+
+        # Values by test and metric, and detected leaks by test and metric
+        self.series = {}
+        self.leaks = {}
+
+    @property
+    def enabled(self):
+        return self.slope is not None or self.growth is not None
+
+    def add_results(self, results):
+        """Add the results of an endurance test and return newly found leaks."""
+
+        test = results.get('name')
+        for iteration in results.get('iterations', []):
+            for metric, value in get_iteration_means(iteration).items():
+                self.series.setdefault((test, metric), []).append(value)
+
+        return self.analyze(test)
+
+    def analyze(self, test):
+        """Check all metrics of the test which haven't been flagged yet for a leak."""
+
+        found = {}
+        if not self.enabled:
+            return found
+
+        leaks = self.leaks.get(test, {})
+        for (name, metric), values in self.series.items():
+            if name != test or metric in leaks or len(values) < self.min_iterations:
+                continue
+
+            # The regression has two parameters, which leaves n - 2 degrees of freedom
+            slope, error = linear_regression(values)
+            lower_bound = slope - t_quantile(self.confidence, len(values) - 2) * error
+            growth = lower_bound * (len(values) - 1)
+
+            if (self.slope is not None and lower_bound > self.slope) or \
+                    (self.growth is not None and growth > self.growth):
+                found[metric] = {'iterations': len(values),
+                                 'slope': slope,
+                                 'slope_lower_bound': lower_bound,
+                                 'growth': values[-1] - values[0]}
+
+        if found:
+            self.leaks.setdefault(test, {}).update(found)
+
+        return found
@@ -10,6 +10,14 @@ class InvalidBinaryException(Exception):
         Exception.__init__(self, ': '.join(["Invalid binary specified", binary]))
 
 
+class DownloadException(Exception):
+    """Class for a failed or corrupted download exception."""
+
+    def __init__(self, message, url):
+        self.url = url
+        Exception.__init__(self, ': '.join([message, url]))
+
+
 class NotFoundException(Exception):
     """Class for a resource not being found exception."""
 
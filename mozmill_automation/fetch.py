@@ -0,0 +1,469 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import hashlib
+import httplib
+from multiprocessing.pool import ThreadPool
+import os
+import Queue
+import re
+import shutil
+import tempfile
+import threading
+import time
+import urllib
+import urlparse
+
+import mozlog
+
+import cache
+import errors
+import metrics
+
+
+CHUNK_SIZE = 64 * 1024
+
+# Size of the ranges which get requested in parallel
+PART_SIZE = 4 * 1024 * 1024
+
+MAX_REDIRECTS = 5
+MAX_RETRIES = 3
+
+# Algorithm used to address downloads in the cache by their content
+CACHE_ALGORITHM = 'sha256'
+
+# Seconds after which a URL gets downloaded again, given that URLs like
+# those of latest builds can refer to new builds over time
+CACHE_MAX_AGE = 24 * 60 * 60
+
+# Size of all cached downloads, beyond which the least recently used
+# downloads get removed
+CACHE_MAX_SIZE = 10 * 1024 * 1024 * 1024
+
+# Channels of builds which are resolved via mozdownload
+SPECIFIER_PATTERN = re.compile(r'^(?P<channel>release|candidate|nightly|aurora):'
+                               r'(?P<version>[^:#]+)(?::(?P<locale>[^:#]+))?'
+                               r'(?:#(?P<checksum>.+))?$')
+
+
+def is_url(value):
+    return urlparse.urlparse(value).scheme in ('http', 'https')
+
+
+def is_specifier(value):
+    """Check if the value specifies a build which has to be downloaded."""
+
+    return is_url(value) or bool(SPECIFIER_PATTERN.match(value))
+
+
+def parse_checksum(fragment):
+    """Return the algorithm and digest of a fragment like 'sha512=abc...'."""
+
+    if not fragment:
+        return None
+
+    algorithm, _, digest = fragment.partition('=')
+    algorithm = algorithm.lower()
+    if not digest or not algorithm in hashlib.algorithms:
+        raise ValueError('Invalid checksum: %s' % fragment)
+
+    return (algorithm, digest.lower())
+
+
+def resolve_specifier(specifier, application='firefox', directory=None):
+    """Return the URL and the expected checksum of the build.
+
+    Specifiers are URLs or 'channel:version[:locale]', whereby the version of
+    nightly and aurora builds is a date or 'latest'. A checksum can be
+    appended as fragment like '#sha512=abc...'.
+    """
+    match = SPECIFIER_PATTERN.match(specifier)
+    if not match:
+        url, _, fragment = specifier.partition('#')
+        return url, parse_checksum(fragment)
+
+    # Import here so URLs can be downloaded without mozdownload
+    import mozdownload
+
+    kwargs = dict(directory=directory or tempfile.gettempdir(),
+                  application=application,
+                  locale=match.group('locale') or 'en-US')
+
+    channel = match.group('channel')
+    version = match.group('version')
+    if channel == 'release':
+        scraper = mozdownload.ReleaseScraper(version=version, **kwargs)
+    elif channel == 'candidate':
+        scraper = mozdownload.ReleaseCandidateScraper(version=version, **kwargs)
+    else:
+        branch = 'mozilla-central' if channel == 'nightly' else 'mozilla-aurora'
+        date = None if version == 'latest' else version
+        scraper = mozdownload.DailyScraper(branch=branch, date=date, **kwargs)
+
+    return scraper.final_url, parse_checksum(match.group('checksum'))
+
+
+def hash_file(filename, algorithm):
+    digest = hashlib.new(algorithm)
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            digest.update(data)
+
+    return digest.hexdigest()
+
+
+def get_filename(url):
+    return urllib.unquote(urlparse.urlparse(url).path.rstrip('/').rsplit('/', 1)[-1])
+
+
+class Connection(object):
+    """Class to send requests over a persistent connection to a host."""
+
+    def __init__(self, url, timeout=60):
+        self.timeout = timeout
+        self.url = url
+        self.connection = None
+
+    def _connect(self):
+        parsed = urlparse.urlparse(self.url)
+        if parsed.scheme == 'https':
+            self.connection = httplib.HTTPSConnection(parsed.netloc, timeout=self.timeout)
+        else:
+            self.connection = httplib.HTTPConnection(parsed.netloc, timeout=self.timeout)
+
+    def request(self, headers=None):
+        """Send a GET request and return the response, whereby redirects
+        get followed and update the URL of the connection.
+        """
+        for _ in range(MAX_REDIRECTS + 1):
+            if not self.connection:
+                self._connect()
+
+            parsed = urlparse.urlparse(self.url)
+            path = parsed.path or '/'
+            if parsed.query:
+                path += '?' + parsed.query
+
+            try:
+                self.connection.request('GET', path, headers=headers or {})
+                response = self.connection.getresponse()
+            except (httplib.HTTPException, IOError):
+                # The server might have closed the idle connection
+                self.close()
+                raise
+
+            if response.status in (301, 302, 303, 307, 308):
+                response.read()
+                location = urlparse.urljoin(self.url, response.getheader('location'))
+                if urlparse.urlparse(location)[:2] != parsed[:2]:
+                    self.close()
+                self.url = location
+                continue
+
+            return response
+
+        raise errors.DownloadException('Too many redirects', self.url)
+
+    def close(self):
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+
+class RangeDownloader(object):
+    """Class to download a file with parallel range requests.
+
+    Each worker keeps its connection open for all the ranges it downloads.
+    The content gets hashed in order while the download is in progress,
+    whereby ranges are read back from the file once all previous ranges have
+    been hashed. Servers which don't support ranges are read sequentially.
+    """
+
+    def __init__(self, url, connections=4, part_size=PART_SIZE, timeout=60):
+        self.url = url
+        self.connections = max(1, connections)
+        self.part_size = part_size
+        self.timeout = timeout
+
+        self.final_url = url
+        self.error = None
+        self.logger = mozlog.getLogger('mozmill-automation')
+
+    def _worker(self, url, filename, queue, parts):
+        connection = Connection(url, self.timeout)
+        try:
+            with open(filename, 'r+b') as f:
+                while self.error is None:
+                    try:
+                        index = queue.get_nowait()
+                    except Queue.Empty:
+                        break
+
+                    start, end, done = parts[index]
+                    self._download_part(connection, f, start, end)
+                    done.set()
+        except Exception, e:
+            # Wake up the hashing of the main thread, which raises the error
+            self.error = e
+            for part in parts:
+                part[2].set()
+        finally:
+            connection.close()
+
+    def _download_part(self, connection, f, start, end):
+        for attempt in range(MAX_RETRIES):
+            try:
+                response = connection.request({'Range': 'bytes=%d-%d' % (start, end)})
+                if response.status != 206 or not response.getheader(
+                        'content-range', '').startswith('bytes %d-%d/' % (start, end)):
+                    response.read()
+                    raise errors.DownloadException(
+                        'Unexpected response to range request (%d)' % response.status,
+                        connection.url)
+
+                f.seek(start)
+                remaining = end - start + 1
+                while remaining:
+                    data = response.read(min(CHUNK_SIZE, remaining))
+                    if not data:
+                        raise IOError('Connection closed before end of range')
+                    f.write(data)
+                    remaining -= len(data)
+                f.flush()
+                return
+            except (httplib.HTTPException, IOError), e:
+                connection.close()
+                self.logger.debug('Retrying range %d-%d of %s: %s' % (
+                    start, end, connection.url, e))
+                if attempt == MAX_RETRIES - 1:
+                    raise
+
+    def _copy(self, response, filename, hashes):
+        with open(filename, 'wb') as f:
+            while True:
+                data = response.read(CHUNK_SIZE)
+                if not data:
+                    break
+                for digest in hashes.values():
+                    digest.update(data)
+                f.write(data)
+
+    def download(self, filename, algorithms=(CACHE_ALGORITHM,)):
+        """Download the file and return the hex digests of its content."""
+
+        hashes = dict((algorithm, hashlib.new(algorithm)) for algorithm in algorithms)
+
+        # A request for the first byte tells the size and range support
+        connection = Connection(self.url, self.timeout)
+        try:
+            response = connection.request({'Range': 'bytes=0-0'})
+            self.final_url = connection.url
+            if response.status == 200:
+                self._copy(response, filename, hashes)
+                return dict((name, digest.hexdigest()) for name, digest in hashes.items())
+
+            content_range = response.getheader('content-range', '')
+            response.read()
+            if response.status != 206 or not '/' in content_range:
+                raise errors.DownloadException(
+                    'Unexpected response (%d)' % response.status, connection.url)
+            url = connection.url
+        finally:
+            connection.close()
+
+        size = int(content_range.rsplit('/', 1)[1])
+        with open(filename, 'wb') as f:
+            f.truncate(size)
+
+        # Parts are (start, end, done event) with inclusive ends
+        parts = [(start, min(start + self.part_size, size) - 1, threading.Event())
+                 for start in range(0, size, self.part_size)]
+        queue = Queue.Queue()
+        for index in range(len(parts)):
+            queue.put(index)
+
+        workers = []
+        for _ in range(min(self.connections, len(parts))):
+            worker = threading.Thread(target=self._worker,
+                                      args=(url, filename, queue, parts))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        completed = False
+        try:
+            with open(filename, 'rb') as f:
+                for start, end, done in parts:
+                    done.wait()
+                    if self.error:
+                        raise self.error
+
+                    f.seek(start)
+                    remaining = end - start + 1
+                    while remaining:
+                        data = f.read(min(CHUNK_SIZE, remaining))
+                        for digest in hashes.values():
+                            digest.update(data)
+                        remaining -= len(data)
+            completed = True
+        finally:
+            if not completed:
+                # Stop the workers from starting further ranges
+                self.error = self.error or errors.DownloadException('Download aborted', url)
+            for worker in workers:
+                worker.join()
+
+        return dict((name, digest.hexdigest()) for name, digest in hashes.items())
+
+
+class BuildFetcher(object):
+    """Class to download builds into a cache addressed by their content.
+
+    Downloads are indexed by their URL, and the same content is only stored
+    once, even if it has been downloaded from different URLs. Index entries
+    expire after max_age seconds, and the least recently used downloads get
+    removed once all downloads exceed max_size bytes.
+    """
+
+    def __init__(self, folder, application='firefox', connections=4,
+                 part_size=PART_SIZE, max_age=CACHE_MAX_AGE,
+                 max_size=CACHE_MAX_SIZE):
+        self.folder = cache.get_cache_folder(folder)
+        self.index = cache.JSONCache(self.folder, 'index')
+        self.application = application
+        self.connections = connections
+        self.part_size = part_size
+        self.max_age = max_age
+        self.max_size = max_size
+
+        self._lock = threading.Lock()
+        self.logger = mozlog.getLogger('mozmill-automation')
+
+    def get_object_path(self, digest, filename):
+        return os.path.join(self.folder, 'objects', digest[:2], digest, filename)
+
+    def lookup(self, url, checksum=None):
+        """Return the path of the cached download if it is available."""
+
+        entry = self.index.get(url)
+        if not entry:
+            return None
+
+        if self.max_age is not None and \
+                time.time() - entry.get('time', 0) > self.max_age:
+            return None
+
+        path = self.get_object_path(entry[CACHE_ALGORITHM], entry['filename'])
+        if not os.path.isfile(path) or os.path.getsize(path) != entry['size']:
+            return None
+
+        if checksum:
+            # Downloads are only hashed with the algorithms requested so far
+            if not checksum[0] in entry:
+                entry[checksum[0]] = hash_file(path, checksum[0])
+            if entry[checksum[0]] != checksum[1]:
+                return None
+
+        entry['last_used'] = time.time()
+        self.index.set(url, entry)
+
+        return path
+
+    def evict(self, keep=None):
+        """Remove the least recently used downloads to satisfy the size limit."""
+
+        if self.max_size is None:
+            return
+
+        with self._lock:
+            objects = {}
+            for url, entry in self.index.items():
+                digest = entry[CACHE_ALGORITHM]
+                item = objects.setdefault(digest, {'urls': [], 'last_used': 0,
+                                                   'size': entry['size'],
+                                                   'filename': entry['filename']})
+                item['urls'].append(url)
+                item['last_used'] = max(item['last_used'],
+                                        entry.get('last_used', entry.get('time', 0)))
+
+            total = sum(item['size'] for item in objects.values())
+            for digest, item in sorted(objects.items(), key=lambda item: item[1]['last_used']):
+                if total <= self.max_size:
+                    break
+                if digest == keep:
+                    continue
+
+                self.logger.info('Removing cached download: %s' % item['filename'])
+                shutil.rmtree(os.path.dirname(self.get_object_path(digest, item['filename'])),
+                              ignore_errors=True)
+                for url in item['urls']:
+                    self.index.remove(url)
+                total -= item['size']
+
+    def fetch(self, specifier):
+        """Download the build and return the path of the cached installer."""
+
+        url, checksum = resolve_specifier(specifier, self.application)
+
+        path = self.lookup(url, checksum)
+        metrics.inc('cache_requests_total', cache='downloads',
+                    result='hit' if path else 'miss')
+        if path:
+            self.logger.info('Using cached build for %s: %s' % (url, path))
+            return path
+
+        algorithms = [CACHE_ALGORITHM]
+        if checksum and checksum[0] != CACHE_ALGORITHM:
+            algorithms.append(checksum[0])
+
+        self.logger.info('Downloading build: %s' % url)
+        fd, tmp_filename = tempfile.mkstemp(dir=self.folder)
+        os.close(fd)
+        try:
+            downloader = RangeDownloader(url, self.connections, self.part_size)
+            digests = downloader.download(tmp_filename, algorithms)
+
+            if checksum and digests[checksum[0]] != checksum[1]:
+                raise errors.DownloadException(
+                    'Checksum mismatch (%s: expected %s, got %s)' % (
+                        checksum[0], checksum[1], digests[checksum[0]]), url)
+
+            # Keep the name of the file, given that it identifies the type
+            # of the installer
+            filename = get_filename(downloader.final_url) or 'build'
+            path = self.get_object_path(digests[CACHE_ALGORITHM], filename)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+
+            if os.path.isfile(path):
+                os.remove(tmp_filename)
+            else:
+                shutil.move(tmp_filename, path)
+        except:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            raise
+
+        entry = dict(digests, filename=filename, size=os.path.getsize(path),
+                     time=time.time(), last_used=time.time())
+        self.index.set(url, entry)
+        self.evict(keep=digests[CACHE_ALGORITHM])
+
+        return path
+
+    def fetch_all(self, specifiers, workers=4):
+        """Download the builds in parallel and return their paths."""
+
+        if not specifiers:
+            return []
+
+        pool = ThreadPool(min(workers, len(specifiers)))
+        try:
+            return pool.map(self.fetch, specifiers)
+        finally:
+            pool.close()
+            pool.join()
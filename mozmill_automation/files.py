@@ -3,39 +3,327 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 
+import gzip
 import json
 import os
+import tempfile
+
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
 
 import errors
 
 
+class JSONStreamReader:
+    """Class to incrementally decode a JSON document from a file object.
+
+    Only the values which are requested get decoded, while all others are
+    skipped without being materialized.
+    """
+
+    WHITESPACE = ' \t\r\n'
+    DELIMITERS = WHITESPACE + ',:]}'
+
+    def __init__(self, f, chunk_size=64 * 1024):
+        self.f = f
+        self.chunk_size = chunk_size
+
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size=None):
+        data = self.f.read(size or self.chunk_size)
+        if not data:
+            self.eof = True
+            return False
+
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Return the next character which is not a whitespace."""
+
+        while True:
+            while self.pos < len(self.buffer) and \
+                    self.buffer[self.pos] in self.WHITESPACE:
+                self.pos += 1
+
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+
+            if not self._fill():
+                raise ValueError('Unexpected end of JSON data')
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError('Expected %r at position %d' % (char, self.pos))
+        self.pos += 1
+
+    def decode(self):
+        """Decode the next value completely."""
+
+        self.peek()
+
+        # Incomplete values are decoded again from their start, so the size
+        # of the reads grows to keep the decoding of large values linear
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+
+                # A number cut off by the end of the buffer is incomplete
+                if self.eof or (end < len(self.buffer) and
+                                self.buffer[end] in self.DELIMITERS):
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+
+            self._fill(size)
+            size *= 2
+
+    def iter_array(self):
+        """Iterate over the elements of an array, whereby the caller has to
+        consume each element before requesting the next one.
+        """
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+
+        while True:
+            yield
+
+            if self.peek() == ',':
+                self.pos += 1
+            else:
+                self.expect(']')
+                return
+
+    def iter_object(self):
+        """Iterate over the keys of an object, whereby the caller has to
+        consume the value of each key before requesting the next one.
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+
+        while True:
+            key = self.decode()
+            self.expect(':')
+            yield key
+
+            if self.peek() == ',':
+                self.pos += 1
+            else:
+                self.expect('}')
+                return
+
+    def skip(self):
+        """Skip the next value without decoding nested arrays and objects."""
+
+        char = self.peek()
+        if char == '[':
+            for _ in self.iter_array():
+                self.skip()
+        elif char == '{':
+            for _ in self.iter_object():
+                self.skip()
+        else:
+            self.decode()
+
+    def find(self, keys):
+        """Yield the elements of the array found at the given keys.
+
+        A key of '*' descends into each element of an array.
+        """
+        char = self.peek()
+        if not keys:
+            if char == '[':
+                for _ in self.iter_array():
+                    yield self.decode()
+            else:
+                self.skip()
+        elif keys[0] == '*' and char == '[':
+            for _ in self.iter_array():
+                for item in self.find(keys[1:]):
+                    yield item
+        elif keys[0] != '*' and char == '{':
+            for key in self.iter_object():
+                if key == keys[0]:
+                    for item in self.find(keys[1:]):
+                        yield item
+                else:
+                    self.skip()
+        else:
+            self.skip()
+
+
 class JSONFile:
-    """Class to handle reading and writing of JSON files."""
+    """Class to handle reading and writing of JSON files.
+
+    Files with a .gz extension are transparently compressed.
+    """
 
     def __init__(self, filename):
         self.filename = os.path.abspath(filename)
 
-    def read(self):
+    def _open(self, filename, mode):
+        if self.filename.endswith('.gz'):
+            return gzip.open(filename, mode + 'b')
+
+        return open(filename, mode)
+
+    def _open_for_reading(self):
         if not os.path.isfile(self.filename):
             raise errors.NotFoundException('Specified file cannot be found.',
                                            self.filename)
 
+        return self._open(self.filename, 'r')
+
+    def _read_object(self, reader, skip):
+        data = {}
+        for key in reader.iter_object():
+            nested = [path.split('.', 1)[1] for path in skip
+                      if path.startswith(key + '.')]
+            if key in skip:
+                reader.skip()
+            elif nested and reader.peek() == '{':
+                data[key] = self._read_object(reader, nested)
+            else:
+                data[key] = reader.decode()
+
+        return data
+
+    def read(self, skip=()):
+        """Read the document, whereby the values of the given keys are
+        skipped without being loaded. Keys can be dotted paths like
+        'endurance.results' to skip values of nested objects.
+        """
+        f = self._open_for_reading()
         try:
-            f = open(self.filename, 'r')
-            return json.loads(f.read())
+            if not skip:
+                return json.load(f)
+
+            return self._read_object(JSONStreamReader(f), skip)
         finally:
             f.close()
 
-    def write(self, data):
+    def items(self, path):
+        """Iterate over the elements of the array at the given dotted path,
+        e.g. 'results' or 'endurance.results.*.iterations', without loading
+        the whole document.
+        """
+        f = self._open_for_reading()
         try:
-            folder = os.path.dirname(self.filename)
-            if not os.path.exists(folder):
-                os.makedirs(folder)
-            f = open(self.filename, 'w')
-            f.write(json.dumps(data))
+            for item in JSONStreamReader(f).find(path.split('.')):
+                yield item
         finally:
             f.close()
 
+    def write(self, data):
+        """Write the data atomically via a temporary file."""
+
+        self.write_stream(data)
+
+    def _dump_stream(self, f, data, keys, items):
+        f.write('{%s: ' % json.dumps(keys[0]))
+        if len(keys) > 1:
+            self._dump_stream(f, data.get(keys[0]) or {}, keys[1:], items)
+        else:
+            f.write('[')
+            for index, item in enumerate(items):
+                if index:
+                    f.write(', ')
+                json.dump(item, f)
+            f.write(']')
+
+        # Other values are serialized last, given that they can be updated
+        # while the items are generated
+        remainder = dict((key, value) for key, value in data.items() if key != keys[0])
+        if remainder:
+            f.write(', %s' % json.dumps(remainder)[1:])
+        else:
+            f.write('}')
+
+    def write_stream(self, data, key=None, items=()):
+        """Write the data atomically, whereby the given items get serialized
+        one at a time as array of the key. The key can be a dotted path like
+        'endurance.results' to the array.
+        """
+        folder = os.path.dirname(self.filename)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+        handle, tmp_filename = tempfile.mkstemp(
+            dir=folder, prefix='.%s.' % os.path.basename(self.filename))
+        os.close(handle)
+        os.chmod(tmp_filename, 0644)
+
+        try:
+            f = self._open(tmp_filename, 'w')
+            try:
+                if key is None:
+                    json.dump(data, f)
+                else:
+                    self._dump_stream(f, data, key.split('.'), items)
+            finally:
+                f.close()
+
+            # Renaming doesn't replace existing files on Windows
+            if os.name == 'nt' and os.path.exists(self.filename):
+                os.remove(self.filename)
+            os.rename(tmp_filename, self.filename)
+        except:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            raise
+
+
+class FileLock(object):
+    """Context manager for an exclusive lock across processes, which is
+    held on the given lock file. The lock gets released by the operating
+    system if the process dies.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.filename, 'a')
+        if os.name == 'nt':
+            self._file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except IOError:
+                    # Locking gives up after 10 seconds, so keep on waiting
+                    pass
+        else:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            if os.name == 'nt':
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        finally:
+            self._file.close()
+            self._file = None
+
 
 def get_unique_filename(filename, start_index):
     (basename, ext) = os.path.splitext(filename)
@@ -0,0 +1,103 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import merge
+
+
+# Tests which have been flaky in at least this fraction of their runs get
+# quarantined, once enough runs have been recorded
+QUARANTINE_RATE = 0.1
+MIN_RUNS = 5
+
+
+def get_test_key(result, report_type):
+    return '::'.join(merge.get_test_identity(result, report_type))
+
+
+class FlakinessHistory(object):
+    """Class to track how often tests only passed after a retry."""
+
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+
+        self.tests = self.cache.get(self.key) or {}
+
+    def get_rate(self, test_key):
+        entry = self.tests.get(test_key)
+        if not entry or not entry['runs']:
+            return 0.0
+
+        return float(entry['flaky']) / entry['runs']
+
+    def is_flaky(self, test_key):
+        entry = self.tests.get(test_key)
+        return bool(entry) and entry['runs'] >= MIN_RUNS and \
+            self.get_rate(test_key) >= QUARANTINE_RATE
+
+    def record(self, test_key, flaky):
+        entry = self.tests.setdefault(test_key, {'runs': 0, 'flaky': 0})
+        entry['runs'] += 1
+        if flaky:
+            entry['flaky'] += 1
+
+    def save(self):
+        self.cache.set(self.key, self.tests)
+
+
+def classify(report, retry_reports, history=None, quarantine=False):
+    """Merge the retries of failed tests into the report.
+
+    Tests which passed in a retry are marked as flaky, and all others keep
+    their failure. If quarantine is enabled, results of tests which are known
+    to be flaky get moved into a separate section which doesn't count for
+    the totals.
+    """
+    report_type = report.get('report_type', '')
+
+    # Retries run whole test files, so they also contain tests which passed
+    # in the first run, and which are not retried tests
+    failed = set(get_test_key(result, report_type) for result in report['results']
+                 if result.get('failed'))
+
+    attempts = {}
+    for retry_report in retry_reports:
+        for result in retry_report['results']:
+            key = get_test_key(result, report_type)
+            if key in failed:
+                attempts[key] = attempts.get(key, 1) + 1
+
+    merger = merge.ReportMerger('pass')
+    for item in [report] + retry_reports:
+        merger.add(item)
+    merged = merger.get_report()
+
+    results = []
+    merged['flaky_tests'] = []
+    merged['quarantine'] = []
+    for result in merged['results']:
+        key = get_test_key(result, report_type)
+        flaky = key in attempts and not result.get('failed')
+        if key in attempts:
+            result['attempts'] = attempts[key]
+        if flaky:
+            result['flaky'] = True
+            merged['flaky_tests'].append(key)
+
+        known_flaky = history and history.is_flaky(key)
+        if history and not result.get('skipped'):
+            history.record(key, flaky)
+
+        if quarantine and known_flaky:
+            result['flaky_rate'] = history.get_rate(key)
+            merged['quarantine'].append(result)
+        else:
+            results.append(result)
+
+    merged['results'] = results
+    merged['tests_failed'] = len([result for result in results if result.get('failed')])
+    merged['tests_skipped'] = len([result for result in results if result.get('skipped')])
+    merged['tests_passed'] = len(results) - merged['tests_failed'] - merged['tests_skipped']
+
+    return merged
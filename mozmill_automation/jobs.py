@@ -0,0 +1,246 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import subprocess
+import sys
+import time
+import xml.dom.minidom
+
+import mozlog
+
+import files
+
+
+# Descriptions of the exit codes of a testrun
+STATUS = {0: 'passed',
+          2: 'failed',
+          3: 'aborted',
+          4: 'not supported'}
+
+
+def filter_args(args, options, flags=()):
+    """Return the arguments without the given options and flags.
+
+    Options are expected to be followed by a value, which gets removed too.
+    """
+    filtered = []
+    skip = False
+    for arg in args:
+        if skip:
+            skip = False
+        elif arg in flags:
+            pass
+        elif arg in options:
+            skip = True
+        elif arg.split('=', 1)[0] in options and '=' in arg:
+            pass
+        else:
+            filtered.append(arg)
+
+    return filtered
+
+
+def get_option_value(args, option):
+    """Return the value of the last occurrence of the option, or None."""
+
+    value = None
+    for index, arg in enumerate(args):
+        if arg == option and index + 1 < len(args):
+            value = args[index + 1]
+        elif arg.startswith(option + '='):
+            value = arg.split('=', 1)[1]
+
+    return value
+
+
+def get_job_filename(filename, name):
+    """Return the filename for a job, which must not be shared with others."""
+
+    (basename, ext) = os.path.splitext(filename)
+
+    return '%s_%s%s' % (basename, name, ext)
+
+
+def get_junit_summary(filename):
+    """Return the number of tests, failures and skips of a JUnit report."""
+
+    if not os.path.isfile(filename):
+        return None
+
+    testsuite = xml.dom.minidom.parse(filename).documentElement
+    return dict((key, int(testsuite.getAttribute(key) or 0))
+                for key in ('tests', 'failures', 'skips'))
+
+
+class ResourcePool(object):
+    """Class to track the resources which are used by running jobs.
+
+    Resources are amounts like CPUs or megabytes of memory. If displays are
+    given, the display resource is backed by them, and each job gets its own
+    display assigned.
+    """
+
+    def __init__(self, capacity, displays=None):
+        self.capacity = dict(capacity)
+        self.displays = list(displays or [])
+        if self.displays:
+            self.capacity['display'] = len(self.displays)
+
+        self.used = dict((name, 0) for name in self.capacity)
+
+    def exceeds_capacity(self, resources):
+        return any(amount > self.capacity[name]
+                   for name, amount in resources.items() if name in self.capacity)
+
+    def fits(self, resources):
+        return all(self.used[name] + amount <= self.capacity[name]
+                   for name, amount in resources.items() if name in self.capacity)
+
+    def acquire(self, job):
+        for name, amount in job.resources.items():
+            if name in self.used:
+                self.used[name] += amount
+
+        if self.displays and job.resources.get('display'):
+            job.displays = [self.displays.pop(0)
+                            for _ in range(job.resources['display'])]
+
+    def release(self, job):
+        for name, amount in job.resources.items():
+            if name in self.used:
+                self.used[name] -= amount
+
+        self.displays.extend(job.displays)
+        job.displays = []
+
+
+class TestrunJob(object):
+    """Class to execute a testrun script in a separate process."""
+
+    def __init__(self, name, testrun_type, args, logfile=None, junit_file=None,
+                 resources=None):
+        self.name = name
+        self.testrun_type = testrun_type
+        self.args = args
+        self.logfile = logfile
+        self.junit_file = junit_file
+        self.resources = resources or {}
+        self.displays = []
+
+        self.process = None
+        self.returncode = None
+        self.duration = None
+        self._start_time = None
+
+    @property
+    def command(self):
+        script = 'import mozmill_automation; mozmill_automation.%s_cli()' % self.testrun_type
+        return [sys.executable, '-c', script] + self.args
+
+    @property
+    def status(self):
+        if self.returncode is None:
+            return 'running' if self.process else 'pending'
+
+        return STATUS.get(self.returncode, 'error')
+
+    def start(self):
+        output = None
+        if self.logfile:
+            folder = os.path.dirname(self.logfile)
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            output = open(self.logfile, 'w')
+
+        env = None
+        if self.displays:
+            env = dict(os.environ, DISPLAY=self.displays[0])
+
+        self._start_time = time.time()
+        self.process = subprocess.Popen(self.command, stdout=output,
+                                        stderr=subprocess.STDOUT, env=env)
+        if output:
+            output.close()
+
+    def poll(self):
+        """Return the exit code of the process, or None if it is still running."""
+
+        if self.returncode is None and self.process:
+            self.returncode = self.process.poll()
+            if self.returncode is not None:
+                self.duration = time.time() - self._start_time
+
+        return self.returncode
+
+    def get_summary(self):
+        summary = {'name': self.name,
+                   'type': self.testrun_type,
+                   'status': self.status,
+                   'returncode': self.returncode,
+                   'duration': self.duration,
+                   'logfile': self.logfile}
+
+        if self.junit_file:
+            # Testruns add the index of the run to the filename
+            filename = files.get_unique_filename(self.junit_file, 0)
+            summary['junit_file'] = filename
+            summary['results'] = get_junit_summary(filename)
+
+        return summary
+
+
+def run_jobs(jobs, parallel=1, interval=1, pool=None):
+    """Execute the jobs with at most the given number running in parallel.
+
+    If a resource pool is given, jobs are only started while their resources
+    are available, whereby later jobs may start before earlier ones which
+    don't fit yet.
+    """
+    logger = mozlog.getLogger('mozmill-automation')
+    pending = list(jobs)
+    running = []
+
+    if pool:
+        for job in jobs:
+            if pool.exceeds_capacity(job.resources):
+                raise ValueError('Resources of job %s exceed the capacity: %s' % (
+                    job.name, job.resources))
+
+    while pending or running:
+        for job in [job for job in running if job.poll() is not None]:
+            logger.info('Finished %s testrun for %s: %s' % (
+                job.testrun_type, job.name, job.status))
+            running.remove(job)
+            if pool:
+                pool.release(job)
+
+        for job in list(pending):
+            if len(running) >= parallel:
+                break
+            if pool and not pool.fits(job.resources):
+                continue
+
+            pending.remove(job)
+            if pool:
+                pool.acquire(job)
+            logger.info('Starting %s testrun for %s' % (job.testrun_type, job.name))
+            job.start()
+            running.append(job)
+
+        if running:
+            time.sleep(interval)
+
+    return jobs
+
+
+def get_exit_code(jobs):
+    """Return the exit code which represents the results of all jobs."""
+
+    codes = [job.returncode for job in jobs]
+    for code in (3, 2, 4):
+        if code in codes:
+            return code
+
+    return 0 if all(code == 0 for code in codes) else 3
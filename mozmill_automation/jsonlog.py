@@ -0,0 +1,241 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import atexit
+import gzip
+import json
+import logging
+import optparse
+import os
+import shutil
+import sys
+import threading
+import time
+
+
+LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+
+# Levels of Mozmill events, all other events are logged as debug output
+EVENT_LEVELS = {'mozmill.fail': 'ERROR',
+                'mozmill.skip': 'WARNING',
+                'mozmill.pass': 'INFO',
+                'mozmill.setTest': 'INFO',
+                'mozmill.endTest': 'INFO',
+                'mozmill.endRunner': 'INFO'}
+
+
+def get_rotated_filename(filename, index):
+    return '%s.%d.gz' % (filename, index)
+
+
+def open_log(filename):
+    """Open a plain or gzip compressed log file for reading."""
+
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+
+    return open(filename, 'r')
+
+
+class StructuredLog(object):
+    """Class to write log records as JSON lines from a background thread.
+
+    Records are buffered in memory and written in batches, so that emitting a
+    record never waits for disk I/O. Once the log file exceeds the maximum
+    size, it gets compressed and rotated, whereby the oldest backup is
+    removed. The buffer is flushed when the process exits.
+    """
+
+    def __init__(self, filename, max_size=20 * 1024 * 1024, backups=5,
+                 flush_interval=1):
+        self.filename = os.path.abspath(filename)
+        self.max_size = max_size
+        self.backups = backups
+        self.flush_interval = flush_interval
+
+        folder = os.path.dirname(self.filename)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._file_lock = threading.Lock()
+        self._stopped = threading.Event()
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+        atexit.register(self.close)
+
+    def emit(self, record):
+        with self._lock:
+            self._buffer.append(record)
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """Write all buffered records to the log file."""
+
+        with self._file_lock:
+            with self._lock:
+                records, self._buffer = self._buffer, []
+
+            if not records:
+                return
+
+            with open(self.filename, 'a') as f:
+                for record in records:
+                    f.write(json.dumps(record, default=str) + '\n')
+
+            if os.path.getsize(self.filename) >= self.max_size:
+                self.rotate()
+
+    def rotate(self):
+        """Compress the current log file and shift the existing backups."""
+
+        oldest = get_rotated_filename(self.filename, self.backups)
+        if os.path.exists(oldest):
+            os.remove(oldest)
+
+        for index in range(self.backups - 1, 0, -1):
+            path = get_rotated_filename(self.filename, index)
+            if os.path.exists(path):
+                os.rename(path, get_rotated_filename(self.filename, index + 1))
+
+        with open(self.filename, 'rb') as source:
+            target = gzip.open(get_rotated_filename(self.filename, 1), 'wb')
+            try:
+                shutil.copyfileobj(source, target)
+            finally:
+                target.close()
+        os.remove(self.filename)
+
+    def close(self):
+        if not self._stopped.is_set():
+            self._stopped.set()
+            self._thread.join()
+        self.flush()
+
+
+class StructuredLogHandler(object):
+    """Mozmill handler which sends all events to the structured log."""
+
+    def __init__(self, log):
+        self.log = log
+        self.test = None
+
+    def events(self):
+        return {}
+
+    def __call__(self, eventName, obj):
+        if eventName == 'mozmill.setTest':
+            self.test = obj.get('name')
+
+        self.log.emit({'time': time.time(),
+                       'source': 'mozmill',
+                       'level': EVENT_LEVELS.get(eventName, 'DEBUG'),
+                       'event': eventName,
+                       'test': self.test,
+                       'data': obj})
+
+        if eventName == 'mozmill.endTest':
+            self.test = None
+
+    def stop(self, results, fatal):
+        self.log.flush()
+
+
+class StructuredLoggingHandler(logging.Handler):
+    """Logging handler which sends the records of the automation scripts to
+    the structured log.
+    """
+
+    def __init__(self, log, handler=None):
+        logging.Handler.__init__(self)
+
+        self.log = log
+        self.handler = handler
+
+    def emit(self, record):
+        self.log.emit({'time': record.created,
+                       'source': record.name,
+                       'level': record.levelname,
+                       'event': None,
+                       'test': self.handler.test if self.handler else None,
+                       'message': self.format(record)})
+
+
+def get_log_files(filename):
+    """Return the rotated backups and the log file in chronological order."""
+
+    index = 1
+    backups = []
+    while os.path.exists(get_rotated_filename(filename, index)):
+        backups.insert(0, get_rotated_filename(filename, index))
+        index += 1
+
+    return backups + ([filename] if os.path.exists(filename) else [])
+
+
+def query(filenames, test=None, level=None, event=None):
+    """Yield the records of the log files matching the given filters."""
+
+    min_level = LEVELS.index(level) if level else 0
+    for filename in filenames:
+        f = open_log(filename)
+        try:
+            for line in f:
+                if not line.strip():
+                    continue
+
+                record = json.loads(line)
+                if test and test not in (record.get('test') or ''):
+                    continue
+                if record.get('level') in LEVELS and \
+                        LEVELS.index(record['level']) < min_level:
+                    continue
+                if event and record.get('event') != event:
+                    continue
+
+                yield record
+        finally:
+            f.close()
+
+
+def logquery_cli(args=sys.argv[1:]):
+    usage = "usage: %prog [options] logfile [logfile ...]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("--event",
+                      dest="event",
+                      metavar="EVENT",
+                      help="only show records of the given Mozmill event")
+    parser.add_option("--level",
+                      dest="level",
+                      choices=LEVELS,
+                      metavar="LEVEL",
+                      help="only show records with at least the given level")
+    parser.add_option("--test",
+                      dest="test",
+                      metavar="NAME",
+                      help="only show records of tests containing the name")
+    options, args = parser.parse_args(args)
+
+    if not args:
+        parser.error("At least one log file has to be specified.")
+
+    # Include rotated backups of the given log files
+    filenames = []
+    for filename in args:
+        filenames.extend(get_log_files(filename) if not filename.endswith('.gz')
+                         else [filename])
+
+    try:
+        for record in query(filenames, options.test, options.level, options.event):
+            print json.dumps(record)
+    except IOError:
+        # Output has been closed, e.g. when piped to head
+        pass
@@ -0,0 +1,261 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import optparse
+import sys
+
+import endurance
+import files
+
+
+PRECEDENCES = ('latest', 'pass', 'fail')
+
+
+def get_test_identity(result, report_type):
+    """Return the identity of a test result based on its manifest location.
+
+    The path of the test file is made relative to the tests folder, so that
+    results of different workspaces can be matched.
+    """
+    filename = result.get('filename', '').replace('\\', '/')
+    root_path = '/'.join(['tests', report_type.split('-', 1)[-1]])
+
+    return (filename.partition(root_path)[2].lstrip('/') or filename,
+            result.get('name'))
+
+
+def get_status(result):
+    if result.get('skipped'):
+        return 'skipped'
+
+    return 'failed' if result.get('failed') else 'passed'
+
+
+class ReportMerger(object):
+    """Class to merge dashboard reports of shards, reruns or resumed testruns.
+
+    Reports have to be added in chronological order. Results of the same test
+    are deduplicated based on the precedence: 'latest' keeps the result of
+    the last report, 'pass' keeps the latest passing result, and 'fail' keeps
+    the latest failing result. Only the selected results are kept in memory,
+    while endurance results which are streamed from report files are read
+    again when the merged report gets written. The merged report can be
+    retrieved once for each of its consumers.
+    """
+
+    def __init__(self, precedence='latest'):
+        if not precedence in PRECEDENCES:
+            raise ValueError('Unknown precedence: %s' % precedence)
+
+        self.precedence = precedence
+
+        self.report = None
+        self.results = {}
+        self.order = []
+        self.endurance = None
+        self.endurance_sources = []
+        self.endurance_tests = {}
+        self.endurance_order = []
+
+    def _select(self, current, result):
+        if self.precedence == 'latest':
+            return result
+
+        preferred = 'passed' if self.precedence == 'pass' else 'failed'
+        if get_status(current) == preferred and get_status(result) != preferred:
+            return current
+
+        return result
+
+    def add(self, report):
+        """Add the results of a report."""
+
+        if self.report is None:
+            self.report = dict((key, value) for key, value in report.items()
+                               if key not in ('results', 'endurance'))
+        else:
+            self.report['time_start'] = min(self.report['time_start'], report['time_start'])
+            self.report['time_end'] = max(self.report['time_end'], report['time_end'])
+
+        report_type = report.get('report_type', '')
+        for result in report['results']:
+            identity = get_test_identity(result, report_type)
+            if identity in self.results:
+                self.results[identity] = self._select(self.results[identity], result)
+            else:
+                self.results[identity] = result
+                self.order.append(identity)
+
+        if 'endurance' in report:
+            self.add_endurance(report['endurance'])
+
+    def add_endurance(self, data):
+        """Add the endurance results, whereby the latest results of a test win.
+
+        Only the position of the latest results of each test is kept, so the
+        results can be streamed from their reports when the merged report
+        gets written.
+        """
+        if self.endurance is None:
+            self.endurance = dict((key, value) for key, value in data.items()
+                                  if key not in ('results', 'stats'))
+            self.endurance['leaks'] = {}
+            self.endurance['aborted'] = False
+
+        source = len(self.endurance_sources)
+        results = data.get('results', [])
+        self.endurance_sources.append(results)
+        for position, test in enumerate(results):
+            name = test.get('name')
+            if not name in self.endurance_tests:
+                self.endurance_order.append(name)
+            self.endurance_tests[name] = (source, position)
+
+        self.endurance['leaks'].update(data.get('leaks') or {})
+        self.endurance['aborted'] = self.endurance['aborted'] or data.get('aborted', False)
+
+    def iter_endurance_results(self):
+        """Yield the latest results of each endurance test, whereby the
+        results of a report are yielded in a single pass over it. Tests are
+        ordered by the report which contains their latest results.
+        """
+        for source, results in enumerate(self.endurance_sources):
+            for position, test in enumerate(results):
+                if self.endurance_tests[test.get('name')] == (source, position):
+                    yield test
+
+    def get_report(self):
+        """Return the merged report with recalculated totals."""
+
+        if self.report is None:
+            raise ValueError('No reports have been added')
+
+        report = dict(self.report)
+        report['results'] = [self.results[identity] for identity in self.order]
+
+        statuses = [get_status(result) for result in report['results']]
+        report['tests_passed'] = statuses.count('passed')
+        report['tests_failed'] = statuses.count('failed')
+        report['tests_skipped'] = statuses.count('skipped')
+
+        if self.endurance is not None:
+            report['endurance'] = dict(self.endurance)
+            if all(isinstance(results, list) for results in self.endurance_sources):
+                # Results in memory keep the order of the first occurrence
+                report['endurance']['results'] = [
+                    self.endurance_sources[source][position]
+                    for source, position in (self.endurance_tests[name]
+                                             for name in self.endurance_order)]
+            else:
+                report['endurance']['results'] = self.iter_endurance_results()
+            endurance.add_stats(report['endurance'])
+
+        return report
+
+
+def merge_reports(reports, precedence='latest'):
+    """Merge the given reports into a single report."""
+
+    merger = ReportMerger(precedence)
+    for report in reports:
+        merger.add(report)
+
+    return merger.get_report()
+
+
+class ReportItems(object):
+    """Array of a report file, which is read again whenever it is iterated."""
+
+    def __init__(self, filename, path):
+        self.filename = filename
+        self.path = path
+
+    def __iter__(self):
+        return files.JSONFile(self.filename).items(self.path)
+
+
+def read_report(filename):
+    """Read a report, whereby the results and the endurance results are
+    streamed from the file.
+    """
+    report = files.JSONFile(filename).read(skip=('results', 'endurance.results'))
+    report['results'] = ReportItems(filename, 'results')
+    if 'endurance' in report:
+        report['endurance']['results'] = ReportItems(filename, 'endurance.results')
+
+    return report
+
+
+def write_report(report, filename):
+    """Write the report to a file, serializing one result at a time."""
+
+    if 'endurance' in report:
+        # The selected results are in memory, unlike the endurance results
+        files.JSONFile(filename).write_stream(report, 'endurance.results',
+                                              report['endurance']['results'])
+    else:
+        header = dict(report)
+        results = header.pop('results')
+        files.JSONFile(filename).write_stream(header, 'results', results)
+
+
+def merge_cli(args=sys.argv[1:]):
+    usage = "usage: %prog [options] report [report ...]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("--junit",
+                      dest="junit_file",
+                      metavar="PATH",
+                      help="JUnit XML style report file")
+    parser.add_option("--output",
+                      dest="output",
+                      metavar="PATH",
+                      help="file to write the merged dashboard report to")
+    parser.add_option("--precedence",
+                      dest="precedence",
+                      default="latest",
+                      choices=PRECEDENCES,
+                      metavar="PRECEDENCE",
+                      help="which result of a test to keep: latest, pass or "
+                           "fail [default: %default]")
+    parser.add_option("--report",
+                      dest="report_url",
+                      metavar="URL",
+                      help="send the merged results to the report server")
+    options, args = parser.parse_args(args)
+
+    if not args:
+        parser.error("At least one report has to be specified.")
+
+    if not (options.output or options.junit_file or options.report_url):
+        parser.error("No output has been specified.")
+
+    # Reports are read one after the other, so only the selected results of
+    # all reports are kept in memory
+    merger = ReportMerger(options.precedence)
+    for filename in args:
+        merger.add(read_report(filename))
+    report = merger.get_report()
+
+    print 'Merged %d reports: %d passed, %d failed, %d skipped' % (
+        len(args), report['tests_passed'], report['tests_failed'],
+        report['tests_skipped'])
+
+    if options.output:
+        write_report(report, options.output)
+
+    if options.junit_file or options.report_url:
+        # Import here so the reports can be merged without Mozmill
+        import reports
+
+        if options.junit_file:
+            junit = reports.JUnitReport(options.junit_file, None)
+            junit.send_report(junit.render(report, str(report.get('report_type', ''))),
+                              options.junit_file)
+
+        if options.report_url:
+            # Streamed endurance results can only be written once per report
+            dashboard = reports.DashboardReport(options.report_url, None)
+            dashboard.send_report(merger.get_report(), options.report_url)
+
+    sys.exit(2 if report['tests_failed'] else 0)
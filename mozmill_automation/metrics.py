@@ -0,0 +1,241 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import BaseHTTPServer
+import os
+import SocketServer
+import tempfile
+import threading
+import time
+
+
+PREFIX = 'mozmill_automation_'
+
+# Upper bounds in seconds of the histogram buckets
+DURATION_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+# Name, type, and description of all metrics which can be recorded
+METRICS = {
+    'addon_downloads_total': ('counter', 'Add-ons downloaded for testruns.'),
+    'cache_requests_total': ('counter', 'Lookups of cached data by cache and result.'),
+    'phase_duration_seconds': ('histogram', 'Duration of the phases of testruns.'),
+    'report_upload_duration_seconds': ('histogram', 'Duration of sending reports.'),
+    'report_upload_failures_total': ('counter', 'Reports which could not be sent.'),
+    'repository_operation_duration_seconds': ('histogram', 'Duration of operations on the tests repository.'),
+    'test_duration_seconds': ('histogram', 'Duration of executed tests.'),
+    'testruns_total': ('counter', 'Finished testruns by result.'),
+    'tests_total': ('counter', 'Executed tests by result.'),
+}
+
+# The registry only exists if metrics have been enabled, so recording them
+# is a no-op otherwise
+_registry = None
+
+
+class Registry(object):
+    """Class to hold the values of all recorded metrics.
+
+    The given labels are added to all metrics, e.g. to tell the metrics of
+    testruns apart which are exported to different files.
+    """
+
+    def __init__(self, buckets=DURATION_BUCKETS, labels=None):
+        self.buckets = buckets
+        self.labels = dict(labels or {})
+
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def get_key(self, name, labels):
+        return (name, tuple(sorted(dict(self.labels, **labels).items())))
+
+    def inc(self, name, value, labels):
+        key = self.get_key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels):
+        key = self.get_key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {
+                    'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram['buckets'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+
+        with self._lock:
+            samples = {}
+            for (name, labels), value in sorted(self.counters.items()):
+                samples.setdefault(name, []).append((name, labels, value))
+
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                lines = samples.setdefault(name, [])
+                for bound, count in zip(self.buckets, histogram['buckets']):
+                    lines.append((name + '_bucket', labels + (('le', format_value(bound)),), count))
+                lines.append((name + '_bucket', labels + (('le', '+Inf'),), histogram['count']))
+                lines.append((name + '_sum', labels, histogram['sum']))
+                lines.append((name + '_count', labels, histogram['count']))
+
+        output = []
+        for name in sorted(samples):
+            metric_type, description = METRICS[name]
+            output.append('# HELP %s%s %s' % (PREFIX, name, description))
+            output.append('# TYPE %s%s %s' % (PREFIX, name, metric_type))
+            for sample_name, labels, value in samples[name]:
+                output.append('%s%s%s %s' % (PREFIX, sample_name,
+                                             format_labels(labels),
+                                             format_value(value)))
+
+        return '\n'.join(output) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\')
+                                                         .replace('"', '\\"')
+                                                         .replace('\n', '\\n'))
+                             for key, value in labels)
+
+
+def format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+
+    return repr(value)
+
+
+def enable(labels=None):
+    """Start recording metrics, whereby the labels are added to all of them."""
+
+    global _registry
+    if _registry is None:
+        _registry = Registry(labels=labels)
+
+
+def is_enabled():
+    return _registry is not None
+
+
+def inc(name, value=1, **labels):
+    """Increment the counter with the given labels."""
+
+    if _registry is not None:
+        _registry.inc(name, value, labels)
+
+
+def observe(name, value, **labels):
+    """Record a value of the histogram with the given labels."""
+
+    if _registry is not None:
+        _registry.observe(name, value, labels)
+
+
+class timed(object):
+    """Context manager to record the duration of its block in a histogram."""
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        if _registry is not None:
+            self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.start is not None:
+            observe(self.name, time.time() - self.start, **self.labels)
+
+
+def render():
+    return _registry.render() if _registry is not None else ''
+
+
+def write(filename):
+    """Write the metrics for the textfile collector of the node exporter.
+
+    The file gets replaced atomically, so the collector never reads a
+    partially written file.
+    """
+    if _registry is None:
+        return
+
+    filename = os.path.abspath(filename)
+    folder = os.path.dirname(filename)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    handle, tmp_filename = tempfile.mkstemp(
+        dir=folder, prefix='.%s.' % os.path.basename(filename))
+    try:
+        with os.fdopen(handle, 'w') as f:
+            f.write(render())
+        os.chmod(tmp_filename, 0644)
+
+        # Renaming doesn't replace existing files on Windows
+        if os.name == 'nt' and os.path.exists(filename):
+            os.remove(filename)
+        os.rename(tmp_filename, filename)
+    except:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+
+class MetricsServer(object):
+    """Local HTTP server which exposes the metrics to be scraped."""
+
+    def __init__(self):
+        self.server = None
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self, host='127.0.0.1', port=0):
+        self.server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Request handler which serves the metrics at /metrics."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        content = render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
@@ -0,0 +1,374 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import multiprocessing
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+import mozfile
+import mozinstall
+import mozlog
+
+import application
+import builds
+import cache
+import fetch
+import files
+import jobs
+import repository
+import testrun
+
+
+# Resources used by a job of each testrun type, unless the plan overrides them
+DEFAULT_RESOURCES = {
+    'addons': {'cpu': 1, 'memory': 1024, 'display': 1},
+    'endurance': {'cpu': 1, 'memory': 2048, 'display': 1},
+    'functional': {'cpu': 1, 'memory': 1024, 'display': 1},
+    'l10n': {'cpu': 1, 'memory': 1024, 'display': 1},
+    'remote': {'cpu': 1, 'memory': 1024, 'display': 1},
+    'update': {'cpu': 1, 'memory': 1024, 'display': 1},
+}
+
+TESTRUN_TYPES = sorted(DEFAULT_RESOURCES)
+
+
+def get_total_memory():
+    """Return the physical memory in MB, or None if it cannot be determined."""
+
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / (1024 * 1024)
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def get_default_capacity():
+    capacity = {'cpu': multiprocessing.cpu_count(),
+                'display': 1}
+
+    memory = get_total_memory()
+    if memory:
+        capacity['memory'] = memory
+
+    return capacity
+
+
+class TestrunPlan(object):
+    """Class to execute a matrix of testruns across builds.
+
+    The plan is a JSON document like:
+
+        {"builds": {"en-US": "firefox-38.0.en-US.linux-x86_64.tar.bz2"},
+         "testruns": [{"type": "functional"},
+                      {"type": "update", "args": ["--channel", "beta"]}],
+         "args": ["--report", "http://..."],
+         "resources": {"cpu": 4, "memory": 8192},
+         "displays": [":1", ":2"]}
+
+    Each testrun is executed for all builds or those listed in its "builds"
+    key. Builds given as URL or channel:version[:locale] get downloaded in
+    parallel first. Builds are installed and the tests repository is cloned
+    only once, and shared by all testruns. Only update testruns get the
+    installer, given that they modify the installed build.
+
+    Testruns which set "exclusive" are not executed alongside any other
+    testrun, and "parallel" limits the number of testruns executed at the
+    same time.
+    """
+
+    def __init__(self, plan, workspace=None, cache_dir=None):
+        self.plan = plan
+        self.workspace = os.path.abspath(workspace or
+                                         tempfile.mkdtemp(prefix='plan_'))
+        self.cache_dir = cache_dir
+
+        self.application = self.plan.get('application', 'firefox')
+        self.cache_folder = cache.get_cache_folder(self.cache_dir)
+        self.version_cache = cache.JSONCache(self.cache_folder, 'versions')
+
+        # Prepared builds and repositories by the name of the build and branch
+        self.builds = {}
+        self.downloads = {}
+        self.repositories = {}
+        self.jobs = []
+        self.job_builds = {}
+        self.build_copies = []
+
+        capacity = get_default_capacity()
+        capacity.update(self.plan.get('resources', {}))
+        self.pool = jobs.ResourcePool(capacity, self.plan.get('displays'))
+
+        self.logger = mozlog.getLogger('mozmill-automation')
+
+        self.validate()
+
+    def validate(self):
+        """Check the plan for errors before anything gets executed."""
+
+        if not self.plan.get('builds'):
+            raise ValueError('The plan doesn\'t specify any builds')
+
+        if not self.plan.get('testruns'):
+            raise ValueError('The plan doesn\'t specify any testruns')
+
+        if not self.application in testrun.APPLICATION_BINARY_NAMES:
+            raise ValueError('Unknown application: %s' % self.application)
+
+        names = set()
+        for entry in self.plan['testruns']:
+            if entry.get('type') not in TESTRUN_TYPES:
+                raise ValueError('Unknown testrun type: %s' % entry.get('type'))
+
+            # Testruns of the same type need a name to tell their jobs apart
+            name = entry.get('name', entry['type'])
+            if name in names:
+                raise ValueError('Testrun name is not unique: %s' % name)
+            names.add(name)
+
+            for name in entry.get('builds', []):
+                if not name in self.plan['builds']:
+                    raise ValueError('Unknown build for %s testrun: %s' % (
+                        entry['type'], name))
+
+            if self.pool.exceeds_capacity(self.get_resources(entry)):
+                raise ValueError('Resources of %s testrun exceed the capacity: %s' % (
+                    entry['type'], self.pool.capacity))
+
+    def get_resources(self, entry):
+        # Exclusive testruns occupy all resources
+        if entry.get('exclusive'):
+            return dict(self.pool.capacity)
+
+        resources = dict(DEFAULT_RESOURCES[entry['type']])
+        resources.update(entry.get('resources', {}))
+
+        return resources
+
+    def get_build_names(self, entry):
+        return entry.get('builds') or sorted(self.plan['builds'])
+
+    def prepare_build(self, name):
+        """Install the build if necessary and probe its version."""
+
+        path = os.path.abspath(self.downloads.get(name, self.plan['builds'][name]))
+        if not os.path.exists(path):
+            raise ValueError('Build cannot be found: %s' % path)
+
+        if not application.is_installer(path, self.application) and \
+                not application.is_application(path, self.application):
+            finder = builds.BuildFinder(self.application,
+                                        cache=cache.JSONCache(self.cache_folder, 'builds'))
+            found = finder.find(path)
+            if not found:
+                raise ValueError('No build found in: %s' % path)
+            path = found[0]
+
+        build = {'path': path, 'folder': None}
+        binary_name = testrun.APPLICATION_BINARY_NAMES[self.application]
+        if application.is_installer(path, self.application):
+            build['folder'] = mozinstall.install(path, os.path.join(self.workspace,
+                                                                    'builds', name))
+            build['binary'] = mozinstall.get_binary(build['folder'], binary_name)
+        elif os.path.isdir(path):
+            build['binary'] = mozinstall.get_binary(path, binary_name)
+        else:
+            build['binary'] = path
+
+        version_info = application.get_version_info(build['binary'],
+                                                    self.version_cache)
+        build['branch'] = application.get_mozmill_tests_branch(
+            version_info.get('application_repository'))
+        build['version'] = version_info.get('application_version')
+
+        self.logger.info('Prepared build %s: %s %s' % (
+            name, version_info.get('application_display_name'), build['version']))
+
+        return build
+
+    def prepare_repository(self, branch):
+        """Clone the tests repository for the given branch."""
+
+        url = self.plan.get('repository') or \
+            testrun.MOZMILL_TESTS_REPOSITORIES[self.application]
+        repo = repository.MercurialRepository(url)
+
+        path = os.path.join(self.workspace, 'repositories', branch)
+        self.logger.info('Cloning test repository for %s to: %s' % (branch, path))
+        repo.clone(path)
+        repo.update(branch)
+
+        return repo.path
+
+    def prepare(self):
+        """Prepare the builds and repositories used by the testruns."""
+
+        names = set(name for entry in self.plan['testruns']
+                    for name in self.get_build_names(entry))
+
+        # Builds specified by URL or channel and version get downloaded
+        # in parallel
+        names_to_fetch = sorted(name for name in names
+                                if fetch.is_specifier(self.plan['builds'][name]))
+        fetcher = fetch.BuildFetcher(os.path.join(self.cache_folder, 'downloads'),
+                                     application=self.application)
+        paths = fetcher.fetch_all([self.plan['builds'][name] for name in names_to_fetch])
+        self.downloads = dict(zip(names_to_fetch, paths))
+
+        for name in sorted(names):
+            self.builds[name] = self.prepare_build(name)
+
+        for build in self.builds.values():
+            if not build['branch'] in self.repositories:
+                self.repositories[build['branch']] = self.prepare_repository(build['branch'])
+
+    def copy_build(self, build, folder):
+        """Copy a build which has been installed before into the folder,
+        and return the path of its binary.
+        """
+        source = application.get_application_folder(build['binary'])
+        target = os.path.join(folder, os.path.basename(source.rstrip('/')))
+
+        self.logger.info('Copying build for update tests to: %s' % target)
+        if os.path.exists(target):
+            mozfile.remove(target)
+        shutil.copytree(source, target, symlinks=True)
+        self.build_copies.append(folder)
+
+        return os.path.join(target, os.path.relpath(build['binary'], source))
+
+    def get_jobs(self):
+        """Return the testrun jobs for all entries of the plan."""
+
+        testrun_jobs = []
+        for entry in self.plan['testruns']:
+            for build_name in self.get_build_names(entry):
+                build = self.builds[build_name]
+                name = '%s-%s' % (entry.get('name', entry['type']), build_name)
+                folder = os.path.join(self.workspace, 'jobs', name)
+
+                args = list(self.plan.get('args', [])) + list(entry.get('args', []))
+
+                # Processes can't share the structured log, given that it gets rotated
+                structured_log = jobs.get_option_value(args, '--structured-log')
+                if structured_log:
+                    args = jobs.filter_args(args, options=('--structured-log',))
+                    args += ['--structured-log', jobs.get_job_filename(structured_log, name)]
+
+                args += ['--application', self.application,
+                         '--cache-dir', self.cache_folder,
+                         '--junit', os.path.join(folder, 'junit.xml'),
+                         '--logfile', os.path.join(folder, 'mozmill.log'),
+                         '--repository-path', self.repositories[build['branch']],
+                         '--workspace', folder]
+
+                # Update tests modify the build, so they need their own copy
+                if entry['type'] != 'update':
+                    args.append(build['binary'])
+                elif build['folder']:
+                    args.append(build['path'])
+                else:
+                    args.append(self.copy_build(build, os.path.join(folder, 'build')))
+
+                job = jobs.TestrunJob(name, entry['type'], args,
+                                      logfile=os.path.join(folder, 'output.log'),
+                                      junit_file=os.path.join(folder, 'junit.xml'),
+                                      resources=self.get_resources(entry))
+                self.job_builds[name] = build_name
+                testrun_jobs.append(job)
+
+        return testrun_jobs
+
+    def cleanup(self):
+        for build in self.builds.values():
+            if build['folder']:
+                self.logger.info('Removing build: %s' % build['folder'])
+                mozfile.remove(build['folder'])
+
+        for folder in self.build_copies:
+            self.logger.info('Removing copy of build: %s' % folder)
+            mozfile.remove(folder)
+
+        for path in self.repositories.values():
+            self.logger.info('Removing test repository: %s' % path)
+            mozfile.remove(path)
+
+    def run(self):
+        """Execute the plan and return the summary of all testruns."""
+
+        start_time = time.time()
+        try:
+            self.prepare()
+            self.jobs = self.get_jobs()
+
+            self.logger.info('Executing %d testruns with resources: %s' % (
+                len(self.jobs), ', '.join('%s=%s' % item
+                                          for item in sorted(self.pool.capacity.items()))))
+            jobs.run_jobs(self.jobs, parallel=self.plan.get('parallel') or len(self.jobs),
+                          pool=self.pool)
+        finally:
+            self.cleanup()
+
+        summary = {'duration': time.time() - start_time,
+                   'status': jobs.STATUS.get(self.get_exit_code(), 'error'),
+                   'testruns': []}
+        for job in self.jobs:
+            entry = job.get_summary()
+            entry['build'] = self.job_builds[job.name]
+            summary['testruns'].append(entry)
+
+        files.JSONFile(os.path.join(self.workspace, 'summary.json')).write(summary)
+
+        return summary
+
+    def get_exit_code(self):
+        return jobs.get_exit_code(self.jobs)
+
+
+def plan_cli(args=sys.argv[1:]):
+    usage = "usage: %prog [options] plan"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("--cache-dir",
+                      dest="cache_dir",
+                      metavar="PATH",
+                      help="path to the folder which persists data "
+                           "across testruns [default: %tmp%]")
+    parser.add_option("--workspace",
+                      dest="workspace",
+                      metavar="PATH",
+                      help="path to the workspace folder, which contains "
+                           "the data of all testruns [default: %tmp%]")
+    options, args = parser.parse_args(args)
+
+    if len(args) != 1:
+        parser.error("Exactly one plan has to be specified.")
+
+    try:
+        plan = TestrunPlan(files.JSONFile(args[0]).read(),
+                           workspace=options.workspace,
+                           cache_dir=options.cache_dir)
+    except ValueError, e:
+        parser.error(str(e))
+
+    try:
+        summary = plan.run()
+    except Exception:
+        traceback.print_exc()
+        sys.exit(3)
+
+    logger = mozlog.getLogger('mozmill-automation')
+    logger.info('%-24s %-12s %-14s %8s %8s %8s' % (
+        'Testrun', 'Build', 'Status', 'Tests', 'Failed', 'Skipped'))
+    for entry in summary['testruns']:
+        results = entry.get('results') or {}
+        logger.info('%-24s %-12s %-14s %8s %8s %8s' % (
+            entry['name'], entry['build'], entry['status'],
+            results.get('tests', '-'), results.get('failures', '-'),
+            results.get('skips', '-')))
+    logger.info('Summary written to: %s' % os.path.join(plan.workspace, 'summary.json'))
+
+    sys.exit(plan.get_exit_code())
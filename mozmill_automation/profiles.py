@@ -0,0 +1,113 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import shutil
+
+import mozfile
+
+
+# Isolation levels of tests, from the strongest to the weakest
+ISOLATION_LEVELS = ('restart', 'reset', 'shared')
+
+RESET_TEST = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'resources', 'profiles', 'testResetState.js')
+
+
+def get_index(path):
+    """Return the modification time and size of all files in the folder,
+    keyed by their relative path.
+    """
+    index = {}
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            filename = os.path.join(root, name)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                # The file has been removed in the meantime
+                continue
+            index[os.path.relpath(filename, path)] = (stat.st_mtime, stat.st_size)
+
+    return index
+
+
+def get_reset_test():
+    """Return a manifest entry for the test which resets the application."""
+
+    return {'path': RESET_TEST,
+            'name': os.path.basename(RESET_TEST),
+            'here': os.path.dirname(RESET_TEST)}
+
+
+def get_segments(tests, default):
+    """Split the tests into groups which are executed in the same session.
+
+    Tests with an isolation level of 'restart' get a session on their own,
+    while consecutive tests of the other levels share one. Tests with an
+    isolation level of 'reset' are preceded by the test which resets the
+    state of the application to the baseline.
+    """
+    segments = []
+    for test in tests:
+        isolation = test.get('isolation')
+        if isolation not in ISOLATION_LEVELS:
+            isolation = default
+
+        if isolation == 'restart' or not segments or segments[-1]['restart']:
+            segments.append({'restart': isolation == 'restart', 'tests': []})
+
+        if isolation == 'reset':
+            segments[-1]['tests'].append(get_reset_test())
+        segments[-1]['tests'].append(test)
+
+    return [segment['tests'] for segment in segments]
+
+
+class ProfileSnapshot(object):
+    """Class to restore a profile to a previously taken snapshot.
+
+    Only files whose modification time or size differ from the snapshot get
+    copied back, and files which have been created since then get removed.
+    """
+
+    def __init__(self, profile, folder):
+        self.profile = profile
+        self.folder = folder
+
+        self.index = None
+
+    def take(self):
+        if os.path.exists(self.folder):
+            mozfile.remove(self.folder)
+        shutil.copytree(self.profile, self.folder)
+
+        # Copies keep the modification time, so the index of the snapshot
+        # matches the profile
+        self.index = get_index(self.folder)
+
+    def restore(self):
+        """Restore the profile and return the number of changed files."""
+
+        current = get_index(self.profile)
+        changed = 0
+
+        for path, stat in current.items():
+            if not path in self.index:
+                os.remove(os.path.join(self.profile, path))
+                changed += 1
+            elif stat != self.index[path]:
+                shutil.copy2(os.path.join(self.folder, path),
+                             os.path.join(self.profile, path))
+                changed += 1
+
+        for path in self.index:
+            if not path in current:
+                target = os.path.join(self.profile, path)
+                if not os.path.isdir(os.path.dirname(target)):
+                    os.makedirs(os.path.dirname(target))
+                shutil.copy2(os.path.join(self.folder, path), target)
+                changed += 1
+
+        return changed
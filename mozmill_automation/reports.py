@@ -3,107 +3,247 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 from datetime import datetime
+import httplib
+import json
 import os
+import shutil
+import sys
+import tempfile
+import time
+import urlparse
 import xml.dom.minidom
 
 from mozmill.report import Report
 from mozprofile.addons import AddonManager
 
-import testrun
+import archive
+import endurance
+import metrics
+import profiles
+import resultstore
 
 
-class DashboardReport(Report):
+def get_screenshots(testrun, result):
+    """ Returns the screenshots taken during a failed test. """
+    if not testrun.screenshots or not result.get('failed'):
+        return []
 
-    def __init__(self, report, testrun):
-        Report.__init__(self, report)
+    if not 'time_start' in result or not 'time_end' in result:
+        return []
 
-        self.testrun = testrun
+    # Screenshots in the RAM workspace get synced to disk at the end
+    return [testrun.workspace_manager.get_persistent_path(path)
+            for path in testrun.screenshots.get_screenshots(result['time_start'],
+                                                            result['time_end'])]
 
-    def _calculate_endurance_stats(self, data, keys):
-        """Calculates the min/max/average of each key in data"""
 
-        stats = { }
-        for key in keys:
-            stats[key] = {'average' : sum(data[key]) / len(data[key]),
-                          'min' : min(data[key]),
-                          'max' : max(data[key])}
-        return stats
+def remove_helper_results(report):
+    """ Removes passed results of the test which resets the application. """
+    results = [result for result in report['results']
+               if result.get('filename') != profiles.RESET_TEST or result.get('failed')]
 
-    def _populate_endurance_metrics(self, dict, keys, data):
-        for key in keys:
-            _data = data[key]
-            if not isinstance(_data, list):
-                _data = [_data]
-            dict.setdefault(key, []).extend(_data)
+    report['tests_passed'] -= len(report['results']) - len(results)
+    report['results'] = results
 
-    def get_report(self, results):
-        """ Customize the report data. """
-        report = Report.get_report(self, results)
 
-        report['report_type'] = self.testrun.report_type
-        report['report_version'] = self.testrun.report_version
-        report['tests_repository'] = self.testrun.repository.url
-        report['tests_changeset'] = self.testrun.repository.changeset
-        report['tags'] = self.testrun.options.tags or [ ]
+def get_metadata(testrun):
+    """ Returns the data of the testrun which gets added to its reports. """
+    metadata = {'type': testrun.type,
+                'report_type': testrun.report_type,
+                'report_version': testrun.report_version,
+                'tests_repository': testrun.repository.url,
+                'tests_changeset': testrun.repository.changeset,
+                'tags': testrun.options.tags or [],
+                'graphics': testrun.graphics}
 
-        # Include graphic card related information if present
-        if self.testrun.graphics:
-            report['system_info']['graphics'] = self.testrun.graphics
+    if testrun.type == 'addons' and testrun.target_addon:
+        metadata['target_addon'] = AddonManager.addon_details(testrun.target_addon)
 
-        # Add-on Testrun
-        if isinstance(self.testrun, testrun.AddonsTestRun):
-            self.get_addons_results(report)
+    elif testrun.type == 'endurance':
+        # The results are read from the event log while the report gets
+        # written, so they never have to be in memory at once
+        metadata['endurance'] = dict(testrun._mozmill.persisted['endurance'])
+        metadata['endurance']['results'] = testrun.endurance_results
+        metadata['endurance']['leaks'] = testrun.leak_detector.leaks
+        metadata['endurance']['aborted'] = testrun.leak_aborted
 
-        # Endurance Testrun
-        if isinstance(self.testrun, testrun.EnduranceTestRun):
-            self.get_endurance_results(report)
+    elif testrun.type == 'update':
+        metadata['updates'] = testrun._mozmill.persisted['updates']
 
-        # Update Testrun
-        if isinstance(self.testrun, testrun.UpdateTestRun):
-            self.get_update_results(report)
+    return metadata
 
-        return report
 
-    def get_endurance_results(self, report):
-        blacklist = ('timestamp', 'label')
-        metrics = []
+def is_streamed(report):
+    """ Checks if the endurance results of the report are not a list. """
+    return 'endurance' in report and \
+        not isinstance(report['endurance']['results'], list)
 
-        report['endurance'] = self.testrun._mozmill.persisted['endurance']
-        report['endurance']['results'] = self.testrun.endurance_results
 
-        all_metrics = {}
-        for test in report['endurance']['results']:
-            test_metrics = {}
+def post_report(filename, report_url):
+    """ Sends the report file to the report server. """
+    url = urlparse.urlparse(report_url)
+    if url.scheme == 'https':
+        connection = httplib.HTTPSConnection(url.netloc)
+    else:
+        connection = httplib.HTTPConnection(url.netloc)
 
-            for iteration in test['iterations']:
-                iteration_metrics = {}
+    try:
+        # The file gets sent in blocks
+        with open(filename, 'rb') as f:
+            connection.request('POST', url.path or '/', f,
+                               {'Content-Type': 'application/json',
+                                'Content-Length': str(os.path.getsize(filename))})
+        data = json.loads(connection.getresponse().read())
+    finally:
+        connection.close()
 
-                for checkpoint in iteration['checkpoints']:
-                    if not metrics:
-                        metrics = [key for key in checkpoint.keys() if not key in blacklist]
+    if not 'ok' in data:
+        print "Creating report document failed (%s)" % data
+        return None
 
-                    self._populate_endurance_metrics(iteration_metrics, metrics, checkpoint)
+    print "Report document created at '%s%s'" % (report_url, data['id'])
+    return data
 
-                iteration['stats'] = self._calculate_endurance_stats(iteration_metrics, metrics)
-                self._populate_endurance_metrics(test_metrics, metrics, iteration_metrics)
 
-            test['stats'] = self._calculate_endurance_stats(test_metrics, metrics)
-            self._populate_endurance_metrics(all_metrics, metrics, test_metrics)
+def build_report(raw_report, metadata):
+    """ Returns the dashboard report for the raw results and the testrun metadata. """
+    report = dict(raw_report)
 
-            report['endurance']['stats'] = self._calculate_endurance_stats(all_metrics, metrics)
+    for key in ('report_type', 'report_version', 'tests_repository',
+                'tests_changeset', 'tags'):
+        report[key] = metadata[key]
 
-        return report
+    # Include graphic card related information if present
+    if metadata.get('graphics'):
+        report['system_info'] = dict(report['system_info'],
+                                     graphics=metadata['graphics'])
 
-    def get_update_results(self, report):
-        report['updates'] = self.testrun._mozmill.persisted['updates']
+    # Add-on Testrun
+    if 'target_addon' in metadata:
+        report['target_addon'] = metadata['target_addon']
 
-        return report
+    # Endurance Testrun
+    if 'endurance' in metadata:
+        report['endurance'] = dict(metadata['endurance'])
+        endurance.add_stats(report['endurance'])
+
+    # Update Testrun
+    if 'updates' in metadata:
+        report['updates'] = metadata['updates']
+
+    return report
+
+
+class DashboardReport(Report):
+
+    def __init__(self, report, testrun):
+        Report.__init__(self, report)
+
+        self.testrun = testrun
+
+    def get_raw_report(self, results):
+        """ Returns the results and the data gathered while running the tests. """
+        report = Report.get_report(self, results)
+        remove_helper_results(report)
+
+        # Reference screenshots taken by failing tests
+        for result in report['results']:
+            screenshots = get_screenshots(self.testrun, result)
+            if screenshots:
+                result['screenshots'] = screenshots
 
-    def get_addons_results(self, report):
-        report['target_addon'] = AddonManager.addon_details(self.testrun.target_addon)
+        # Timeouts which have been enforced for the tests
+        if self.testrun.watchdog:
+            self.testrun.watchdog.add_timeouts(report)
 
         return report
 
+    def get_report(self, results):
+        """ Customize the report data. """
+        return build_report(self.get_raw_report(results),
+                            get_metadata(self.testrun))
+
+    def send_report(self, results, report_url):
+        """ Send the report and record how long it took. """
+        start = time.time()
+        try:
+            if is_streamed(results):
+                response = self.send_streamed_report(results, report_url)
+            else:
+                response = Report.send_report(self, results, report_url)
+        except Exception:
+            metrics.inc('report_upload_failures_total', report='dashboard')
+            raise
+        metrics.observe('report_upload_duration_seconds', time.time() - start,
+                        report='dashboard')
+
+        # Failures are only printed, and a response only returned on success
+        if response is None and report_url.startswith('http'):
+            metrics.inc('report_upload_failures_total', report='dashboard')
+
+        return response
+
+    def send_streamed_report(self, results, report_url):
+        """ Send a report whose endurance results are streamed, whereby the
+        report is written to a file first. """
+        handle, filename = tempfile.mkstemp(suffix='.json')
+        os.close(handle)
+        try:
+            resultstore.write_report(results, filename)
+
+            if report_url == 'stdout':
+                with open(filename, 'r') as f:
+                    shutil.copyfileobj(f, sys.stdout)
+            elif report_url.startswith('file://'):
+                shutil.copyfile(filename, report_url.split('file://', 1)[1])
+            else:
+                return post_report(filename, report_url)
+        finally:
+            os.remove(filename)
+
+
+class ResultSpool(DashboardReport):
+
+    def __init__(self, index, testrun):
+        DashboardReport.__init__(self, testrun.result_store.get_filename(index),
+                                 testrun)
+
+        self.index = index
+        self.failed_tests = []
+
+    def get_report(self, results):
+        """ Archive the raw results before the report gets built. """
+        raw_report = self.get_raw_report(results)
+        metadata = get_metadata(self.testrun)
+
+        if self.testrun.options.archive:
+            archive.write_archive(self.testrun.get_archive_filename(self.index),
+                                  raw_report, metadata)
+
+        return build_report(raw_report, metadata)
+
+    def send_report(self, results, filename):
+        """ Write the report to the result store of the testrun. """
+        self.testrun.result_store.save(self.index, results)
+
+        if metrics.is_enabled():
+            for result in results['results']:
+                if result.get('skipped'):
+                    status = 'skipped'
+                elif result.get('failed'):
+                    status = 'failed'
+                else:
+                    status = 'passed'
+                metrics.inc('tests_total', type=self.testrun.type, status=status)
+
+                if 'time_start' in result and 'time_end' in result:
+                    metrics.observe('test_duration_seconds',
+                                    (result['time_end'] - result['time_start']) / 1000.0,
+                                    type=self.testrun.type)
+
+        # Only keep the data needed to determine the exit code
+        self.failed_tests = resultstore.get_failed_tests(results)
+
 
 class JUnitReport(Report):
 
@@ -115,8 +255,17 @@ class JUnitReport(Report):
     def get_report(self, results):
         """ Generate JUnit XML report. """
         report = Report.get_report(self, results)
+        remove_helper_results(report)
+
+        for result in report['results']:
+            screenshots = get_screenshots(self.testrun, result)
+            if screenshots:
+                result['screenshots'] = screenshots
+
+        return self.render(report, str(self.testrun.report_type))
 
-        report_type = str(self.testrun.report_type)
+    def render(self, report, report_type):
+        """ Generate JUnit XML from the report data. """
         time_start = datetime.strptime(report['time_start'], self.date_format)
         time_end = datetime.strptime(report['time_end'], self.date_format)
 
@@ -189,6 +338,14 @@ class JUnitReport(Report):
                 failed_element.setAttribute('message', unicode(message).encode('ascii', 'xmlcharrefreplace'))
                 failed_element.appendChild(doc.createTextNode(unicode(body).encode('ascii', 'xmlcharrefreplace')))
                 testcase_element.appendChild(failed_element)
+
+                # Attach screenshots in the format of the Jenkins attachments plugin
+                screenshots = result.get('screenshots')
+                if screenshots:
+                    output_element = doc.createElement('system-out')
+                    output_element.appendChild(doc.createTextNode('\n'.join(
+                        ['[[ATTACHMENT|%s]]' % path for path in screenshots])))
+                    testcase_element.appendChild(output_element)
             testsuite_element.appendChild(testcase_element)
 
         doc.appendChild(testsuite_element)
@@ -196,10 +353,14 @@ class JUnitReport(Report):
 
     def send_report(self, results, filename):
         """ Write JUnit report to file. """
+        start = time.time()
         try:
             f = file(filename, 'w')
         except Exception, e:
+            metrics.inc('report_upload_failures_total', report='junit')
             print "Printing results to '%s' failed (%s)." % (filename, e)
             return
         print >> f, results
+        metrics.observe('report_upload_duration_seconds', time.time() - start,
+                        report='junit')
         return
@@ -8,6 +8,7 @@ import re
 import shutil
 import urlparse
 
+import metrics
 import process
 
 
@@ -65,6 +66,14 @@ class MercurialRepository(object):
 
         return self._exec(['parent', '--template', '{node}'])
 
+    def get_changed_files(self, changeset):
+        """Get the files changed between the given and the current changeset"""
+
+        output = self._exec(['status', '--rev', changeset, '--rev', '.',
+                             '--no-status'])
+
+        return [line.strip() for line in output.splitlines() if line.strip()]
+
     def clone(self, path=None):
         """Clone the remote repository to the local path"""
 
@@ -72,7 +81,9 @@ class MercurialRepository(object):
             # A new destination has been specified
             self.path = os.path.abspath(path)
 
-        self._exec(['clone', self.url, self.path], True)
+        with metrics.timed('repository_operation_duration_seconds',
+                           operation='clone'):
+            self._exec(['clone', self.url, self.path], True)
 
     def update(self, branch=None):
         """ Update the local repository for recent changes. """
@@ -80,7 +91,9 @@ class MercurialRepository(object):
         if branch is None:
             branch = self.branch
 
-        self._exec(['update', '-C', branch])
+        with metrics.timed('repository_operation_duration_seconds',
+                           operation='update'):
+            self._exec(['update', '-C', branch])
 
     def remove(self):
         """Remove the repository from the local disk"""
@@ -0,0 +1,57 @@
+/* This Source Code Form is subject to the terms of the Mozilla Public
+ * License, v. 2.0. If a copy of the MPL was not distributed with this
+ * file, You can obtain one at http://mozilla.org/MPL/2.0/. */
+
+"use strict";
+
+/**
+ * Installs the target add-on of the current suite without a restart of the
+ * application. The suites are passed in by the automation scripts via the
+ * persisted data.
+ */
+
+Components.utils.import("resource://gre/modules/AddonManager.jsm");
+Components.utils.import("resource://gre/modules/FileUtils.jsm");
+Components.utils.import("resource://gre/modules/Services.jsm");
+
+function getUserPrefs() {
+  return Services.prefs.getChildList("").filter(function (aName) {
+    return Services.prefs.prefHasUserValue(aName);
+  });
+}
+
+function testInstallAddon() {
+  var suite = persisted.addons.suites[persisted.addons.index];
+
+  // Remember the modified preferences to reset the baseline afterward
+  persisted.addons.userPrefs = getUserPrefs();
+
+  var finished = false;
+  var error = null;
+
+  AddonManager.getInstallForFile(new FileUtils.File(suite.path), function (aInstall) {
+    aInstall.addListener({
+      onInstallEnded: function (aInstall, aAddon) {
+        if (aAddon.pendingOperations & AddonManager.PENDING_INSTALL) {
+          error = "Add-on requires a restart to be installed";
+        }
+        finished = true;
+      },
+      onInstallFailed: function (aInstall) {
+        error = "Installation failed with error " + aInstall.error;
+        finished = true;
+      },
+      onDownloadFailed: function (aInstall) {
+        error = "Download failed with error " + aInstall.error;
+        finished = true;
+      }
+    });
+    aInstall.install();
+  });
+
+  assert.waitFor(function () {
+    return finished;
+  }, "Add-on '" + suite.id + "' has been installed");
+
+  assert.ok(!error, "Add-on '" + suite.id + "' has been installed: " + error);
+}
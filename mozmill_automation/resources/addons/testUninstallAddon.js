@@ -0,0 +1,52 @@
+/* This Source Code Form is subject to the terms of the Mozilla Public
+ * License, v. 2.0. If a copy of the MPL was not distributed with this
+ * file, You can obtain one at http://mozilla.org/MPL/2.0/. */
+
+"use strict";
+
+/**
+ * Uninstalls the target add-on of the current suite and resets the
+ * preferences modified by the suite, so the next suite starts from the same
+ * baseline.
+ */
+
+Components.utils.import("resource://gre/modules/AddonManager.jsm");
+Components.utils.import("resource://gre/modules/Services.jsm");
+
+function teardownModule(aModule) {
+  // Always continue with the next suite, even if the uninstall failed
+  persisted.addons.index++;
+}
+
+function testUninstallAddon() {
+  var suite = persisted.addons.suites[persisted.addons.index];
+
+  var finished = false;
+  AddonManager.getAddonByID(suite.id, function (aAddon) {
+    if (!aAddon) {
+      finished = true;
+      return;
+    }
+
+    AddonManager.addAddonListener({
+      onUninstalled: function (aUninstalled) {
+        if (aUninstalled.id === suite.id) {
+          AddonManager.removeAddonListener(this);
+          finished = true;
+        }
+      }
+    });
+    aAddon.uninstall();
+  });
+
+  assert.waitFor(function () {
+    return finished;
+  }, "Add-on '" + suite.id + "' has been uninstalled");
+
+  var userPrefs = persisted.addons.userPrefs || [];
+  Services.prefs.getChildList("").forEach(function (aName) {
+    if (Services.prefs.prefHasUserValue(aName) && userPrefs.indexOf(aName) === -1) {
+      Services.prefs.clearUserPref(aName);
+    }
+  });
+}
@@ -0,0 +1,100 @@
+/* This Source Code Form is subject to the terms of the Mozilla Public
+ * License, v. 2.0. If a copy of the MPL was not distributed with this
+ * file, You can obtain one at http://mozilla.org/MPL/2.0/. */
+
+"use strict";
+
+/**
+ * Resets the state of the application between tests without a restart.
+ * The first execution records the baseline of the preferences, and all
+ * following executions restore it, and close additional windows and tabs.
+ */
+
+Components.utils.import("resource://gre/modules/Services.jsm");
+
+const Ci = Components.interfaces;
+
+function getPrefValue(aName) {
+  switch (Services.prefs.getPrefType(aName)) {
+    case Ci.nsIPrefBranch.PREF_BOOL:
+      return Services.prefs.getBoolPref(aName);
+    case Ci.nsIPrefBranch.PREF_INT:
+      return Services.prefs.getIntPref(aName);
+    default:
+      return Services.prefs.getCharPref(aName);
+  }
+}
+
+function setPrefValue(aName, aValue) {
+  switch (typeof aValue) {
+    case "boolean":
+      Services.prefs.setBoolPref(aName, aValue);
+      break;
+    case "number":
+      Services.prefs.setIntPref(aName, aValue);
+      break;
+    default:
+      Services.prefs.setCharPref(aName, aValue);
+  }
+}
+
+function getUserPrefs() {
+  var prefs = {};
+  Services.prefs.getChildList("").forEach(function (aName) {
+    if (Services.prefs.prefHasUserValue(aName)) {
+      prefs[aName] = getPrefValue(aName);
+    }
+  });
+
+  return prefs;
+}
+
+function resetPrefs(aBaseline) {
+  var current = getUserPrefs();
+
+  for (var name in current) {
+    if (!(name in aBaseline)) {
+      Services.prefs.clearUserPref(name);
+    }
+    else if (current[name] !== aBaseline[name]) {
+      setPrefValue(name, aBaseline[name]);
+    }
+  }
+
+  for (var name in aBaseline) {
+    if (!(name in current)) {
+      setPrefValue(name, aBaseline[name]);
+    }
+  }
+}
+
+function resetWindows() {
+  var windows = Services.wm.getEnumerator("navigator:browser");
+  var first = null;
+
+  while (windows.hasMoreElements()) {
+    var win = windows.getNext();
+    if (!first) {
+      first = win;
+    }
+    else {
+      win.close();
+    }
+  }
+
+  if (first) {
+    var browser = first.gBrowser;
+    browser.removeAllTabsBut(browser.selectedTab);
+    browser.loadURI("about:blank");
+  }
+}
+
+function testResetState() {
+  if (!persisted.isolation) {
+    persisted.isolation = {prefs: getUserPrefs()};
+    return;
+  }
+
+  resetPrefs(persisted.isolation.prefs);
+  resetWindows();
+}
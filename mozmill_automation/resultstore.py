@@ -0,0 +1,79 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import os
+
+import files
+
+
+def write_report(report, filename):
+    """Write a report, whereby the endurance results are serialized one at a
+    time, given that they can be streamed from an event log.
+    """
+    if 'endurance' in report:
+        files.JSONFile(filename).write_stream(report, 'endurance.results',
+                                              report['endurance']['results'])
+    else:
+        files.JSONFile(filename).write(report)
+
+
+def get_failed_tests(report):
+    """Return the identifying data of all failed tests of a report."""
+
+    return [{'filename': result.get('filename'), 'name': result.get('name')}
+            for result in report['results'] if result.get('failed')]
+
+
+class ResultStore(object):
+    """Class to keep the results of each testrun index on disk.
+
+    Reports are written as soon as a testrun has been finished, so repeated
+    testruns within the same process don't keep their results in memory.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+
+    def get_filename(self, index, name='report', extension='.json'):
+        return os.path.join(self.folder, '%d_%s%s' % (index, name, extension))
+
+    def save(self, index, report):
+        write_report(report, self.get_filename(index))
+
+    def load(self, index):
+        return files.JSONFile(self.get_filename(index)).read()
+
+    @property
+    def indexes(self):
+        return sorted(int(name.split('_', 1)[0]) for name in os.listdir(self.folder)
+                      if name.endswith('_report.json'))
+
+
+class EventLog(object):
+    """Class to append event data to a file with one JSON object per line."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.count = 0
+
+        with open(self.filename, 'w'):
+            pass
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        with open(self.filename, 'r') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    def append(self, data):
+        with open(self.filename, 'a') as f:
+            f.write(json.dumps(data) + '\n')
+        self.count += 1
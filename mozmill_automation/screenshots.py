@@ -0,0 +1,156 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import hashlib
+import os
+import struct
+import threading
+import zlib
+
+import mozlog
+
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+
+def read_png_chunks(data):
+    """Return the list of (type, body) chunks of PNG data."""
+
+    chunks = []
+    position = len(PNG_SIGNATURE)
+    while position + 8 <= len(data):
+        length, chunk_type = struct.unpack('>I4s', data[position:position + 8])
+        chunks.append((chunk_type, data[position + 8:position + 8 + length]))
+        position += length + 12
+
+    return chunks
+
+
+def write_png_chunk(chunk_type, body):
+    crc = zlib.crc32(chunk_type + body) & 0xffffffff
+    return struct.pack('>I4s', len(body), chunk_type) + body + struct.pack('>I', crc)
+
+
+def process_png(data):
+    """Recompress PNG data and return it together with the hash of its pixels.
+
+    The hash is computed from the header and the decompressed image data, so
+    identical images get the same hash regardless of the used compression.
+    """
+    chunks = read_png_chunks(data)
+    image_data = zlib.decompress(''.join(body for chunk_type, body in chunks
+                                         if chunk_type == 'IDAT'))
+    header = ''.join(body for chunk_type, body in chunks if chunk_type == 'IHDR')
+    digest = hashlib.sha1(header + image_data).hexdigest()
+
+    output = [PNG_SIGNATURE]
+    for chunk_type, body in chunks:
+        if chunk_type == 'IDAT':
+            # All image data is written as a single chunk at the first position
+            if image_data is not None:
+                output.append(write_png_chunk('IDAT', zlib.compress(image_data, 9)))
+                image_data = None
+        else:
+            output.append(write_png_chunk(chunk_type, body))
+    output = ''.join(output)
+
+    return output if len(output) < len(data) else data, digest
+
+
+class ScreenshotPipeline(object):
+    """Class to process screenshots in the background while tests are running.
+
+    New screenshots are recompressed and identical ones are removed, whereby
+    the index keeps a reference to the first screenshot with the same
+    content. The folder is only checked in the given interval, so that the
+    application under test is not slowed down.
+    """
+
+    def __init__(self, path, interval=5):
+        self.path = path
+        self.interval = interval
+
+        self.logger = mozlog.getLogger('mozmill-automation')
+        self.index = {}
+        self.hashes = {}
+
+        self._sizes = {}
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _process(self, filename):
+        path = os.path.join(self.path, filename)
+        timestamp = os.path.getmtime(path)
+
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        if data.startswith(PNG_SIGNATURE):
+            output, digest = process_png(data)
+        else:
+            output, digest = data, hashlib.sha1(data).hexdigest()
+
+        if digest in self.hashes:
+            os.remove(path)
+            path = self.hashes[digest]
+        else:
+            if len(output) < len(data):
+                with open(path, 'wb') as f:
+                    f.write(output)
+            self.hashes[digest] = path
+
+        self.index[filename] = {'path': path,
+                                'hash': digest,
+                                'timestamp': int(timestamp * 1000)}
+
+    def process(self, final=False):
+        """Process all screenshots which are not written anymore."""
+
+        if not os.path.isdir(self.path):
+            return
+
+        for filename in sorted(os.listdir(self.path)):
+            path = os.path.join(self.path, filename)
+            if filename in self.index or not os.path.isfile(path):
+                continue
+
+            # Only process files once their size has settled
+            size = os.path.getsize(path)
+            if not final and self._sizes.get(filename) != size:
+                self._sizes[filename] = size
+                continue
+
+            try:
+                self._process(filename)
+            except Exception:
+                self.logger.exception('Failed to process screenshot: %s' % path)
+                self.index[filename] = {'path': path,
+                                        'hash': None,
+                                        'timestamp': int(os.path.getmtime(path) * 1000)}
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.process()
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread and process all remaining screenshots."""
+
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+        self.process(final=True)
+
+    def get_screenshots(self, time_start, time_end):
+        """Return the paths of screenshots taken in the given time frame (in ms)."""
+
+        return sorted(set(entry['path'] for entry in self.index.values()
+                          if time_start <= entry['timestamp'] <= time_end))
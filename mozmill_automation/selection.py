@@ -0,0 +1,176 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import re
+import subprocess
+
+import mozlog
+
+import distributed
+
+
+MODULE_EXTENSIONS = ('.js', '.jsm')
+
+REQUIRE_PATTERN = re.compile(r'''\brequire\(\s*["']([^"']+)["']\s*\)''')
+IMPORT_PATTERN = re.compile(r'''\b(?:Cu|Components\.utils)\.import\(\s*["']([^"']+)["']''')
+
+
+def build_dependency_index(root):
+    """Return the files which use a module, keyed by the path of the module.
+
+    Modules loaded via require() are resolved relative to the file, while
+    modules imported via Cu.import() are matched by their filename.
+    """
+    modules = []
+    for folder, dirs, filenames in os.walk(root):
+        dirs[:] = [name for name in dirs if not name.startswith('.')]
+        modules.extend(os.path.join(folder, name) for name in filenames
+                       if os.path.splitext(name)[1] in MODULE_EXTENSIONS)
+
+    by_name = {}
+    for path in modules:
+        by_name.setdefault(os.path.basename(path), []).append(path)
+
+    index = {}
+    for path in modules:
+        with open(path, 'r') as f:
+            content = f.read()
+
+        dependencies = []
+        for target in REQUIRE_PATTERN.findall(content):
+            target = os.path.normpath(os.path.join(os.path.dirname(path), target))
+            if not os.path.splitext(target)[1]:
+                target += '.js'
+            dependencies.append(target)
+
+        for url in IMPORT_PATTERN.findall(content):
+            dependencies.extend(by_name.get(url.rsplit('/', 1)[-1], []))
+
+        source = os.path.relpath(path, root).replace(os.sep, '/')
+        for target in dependencies:
+            target = os.path.relpath(target, root).replace(os.sep, '/')
+            if target != source:
+                index.setdefault(target, []).append(source)
+
+    return index
+
+
+def get_affected_files(changed_files, index):
+    """Return the changed files and all files which depend on them."""
+
+    affected = set(changed_files)
+    pending = list(changed_files)
+    while pending:
+        for dependent in index.get(pending.pop(), []):
+            if not dependent in affected:
+                affected.add(dependent)
+                pending.append(dependent)
+
+    return affected
+
+
+class TestSelector(object):
+    """Class to select the tests affected by changes to the tests repository.
+
+    The changes are determined against the changeset of the last successful
+    testrun, which is recorded per key in the cache. A full testrun is forced
+    when no baseline exists, manifests have been changed, or the given amount
+    of testruns has been executed since the last full run.
+    """
+
+    def __init__(self, repository, cache, key, full_run_interval=10):
+        self.repository = repository
+        self.cache = cache
+        self.key = key
+        self.full_run_interval = full_run_interval
+
+        self.logger = mozlog.getLogger('mozmill-automation')
+        self.full_run = True
+
+    def get_dependency_index(self):
+        """Return the dependency index of the current changeset."""
+
+        changeset = self.repository.changeset
+        entry = self.cache.get('dependencies|%s' % self.repository.url)
+        if entry and entry['changeset'] == changeset:
+            return entry['index']
+
+        index = build_dependency_index(self.repository.path)
+        self.cache.set('dependencies|%s' % self.repository.url,
+                       {'changeset': changeset, 'index': index})
+
+        return index
+
+    def get_selected_ids(self, test_ids):
+        """Return the identifiers of the affected tests or None for a full run."""
+
+        baseline = self.cache.get(self.key)
+        if not baseline:
+            self.logger.info('No baseline available, running all tests')
+            return None
+
+        if baseline['runs_since_full'] + 1 >= self.full_run_interval:
+            self.logger.info('Forcing a full run after %d selective runs' %
+                             baseline['runs_since_full'])
+            return None
+
+        try:
+            changed_files = self.repository.get_changed_files(baseline['changeset'])
+        except subprocess.CalledProcessError:
+            self.logger.warning('Unknown baseline changeset %s, running all tests' %
+                                baseline['changeset'])
+            return None
+
+        self.logger.info('%d files changed since changeset %s' % (
+            len(changed_files), baseline['changeset']))
+
+        modules = []
+        data_folders = []
+        for path in changed_files:
+            extension = os.path.splitext(path)[1]
+            if extension == '.ini':
+                self.logger.info('Manifest %s has been changed, running all tests' % path)
+                return None
+            elif extension in MODULE_EXTENSIONS:
+                modules.append(path)
+            else:
+                # Data files are used by the tests in the same folder
+                data_folders.append(os.path.dirname(path) + '/')
+
+        affected = get_affected_files(modules, self.get_dependency_index())
+
+        return set(test_id for test_id in test_ids
+                   if test_id in affected or
+                   any(test_id.startswith(folder) for folder in data_folders))
+
+    def select(self, tests):
+        """Return the tests affected by the changes since the baseline."""
+
+        test_ids = [distributed.get_test_id(test, self.repository.path) for test in tests]
+        selected = self.get_selected_ids(test_ids)
+
+        self.full_run = selected is None
+        if self.full_run:
+            return tests
+
+        self.logger.info('Selected %d of %d tests affected by changes' % (
+            len(selected), len(tests)))
+
+        return [test for test, test_id in zip(tests, test_ids) if test_id in selected]
+
+    def record(self, passed):
+        """Record the result of the testrun to update the baseline."""
+
+        baseline = self.cache.get(self.key) or {'changeset': None,
+                                                'runs_since_full': 0}
+
+        # The baseline only moves forward with passing runs, so changes of
+        # failing runs are included again in the next selection
+        if passed:
+            baseline['changeset'] = self.repository.changeset
+        baseline['runs_since_full'] = 0 if self.full_run else baseline['runs_since_full'] + 1
+
+        if baseline['changeset']:
+            self.cache.set(self.key, baseline)
@@ -0,0 +1,137 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import optparse
+import shlex
+import sys
+import traceback
+
+import mozlog
+
+import plan
+
+
+# Testruns which are not executed alongside others, given that endurance
+# tests measure the memory usage, and update tests change the system state
+EXCLUSIVE_TYPES = ('endurance', 'update')
+
+
+def get_plan(build, types, args=(), type_args=None, application='firefox',
+             parallel=False):
+    """Return the plan to execute testruns of the given types for a build.
+
+    Update testruns are executed last, and testruns are executed in sequence
+    unless parallel is set.
+    """
+    type_args = type_args or {}
+
+    # Sorting is stable, so all other testruns keep their order
+    types = sorted(types, key=lambda testrun_type: testrun_type == 'update')
+
+    testruns = []
+    for testrun_type in types:
+        testruns.append({'type': testrun_type,
+                         'args': list(type_args.get(testrun_type, [])),
+                         'exclusive': testrun_type in EXCLUSIVE_TYPES})
+
+    session_plan = {'application': application,
+                    'args': list(args),
+                    'builds': {'build': build},
+                    'testruns': testruns}
+    if not parallel:
+        session_plan['parallel'] = 1
+
+    return session_plan
+
+
+def session_cli(args=sys.argv[1:]):
+    usage = "usage: %prog [options] (binary|folder|url) [testrun options]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("--application",
+                      dest="application",
+                      default="firefox",
+                      metavar="APPLICATION",
+                      help="application name [default: %default]")
+    parser.add_option("--cache-dir",
+                      dest="cache_dir",
+                      metavar="PATH",
+                      help="path to the folder which persists data "
+                           "across testruns [default: %tmp%]")
+    parser.add_option("--parallel",
+                      dest="parallel",
+                      default=False,
+                      action="store_true",
+                      help="execute testruns at the same time, except for "
+                           "endurance and update testruns")
+    parser.add_option("--type-args",
+                      dest="type_args",
+                      default=[],
+                      action="append",
+                      metavar="TYPE:ARGS",
+                      help="arguments only for testruns of the given type, "
+                           "e.g. 'update:--channel beta'")
+    parser.add_option("--types",
+                      dest="types",
+                      metavar="TYPES",
+                      help="comma separated list of testrun types to execute "
+                           "(%s)" % ', '.join(plan.TESTRUN_TYPES))
+    parser.add_option("--workspace",
+                      dest="workspace",
+                      metavar="PATH",
+                      help="path to the workspace folder, which contains "
+                           "the data of all testruns [default: %tmp%]")
+
+    # Arguments after the build are passed to the testruns
+    parser.disable_interspersed_args()
+    options, args = parser.parse_args(args)
+
+    if not args:
+        parser.error("A binary or a folder containing a binary has to be specified.")
+
+    if not options.types:
+        parser.error("The testrun types have to be specified.")
+
+    types = [testrun_type.strip() for testrun_type in options.types.split(',')
+             if testrun_type.strip()]
+    for testrun_type in types:
+        if not testrun_type in plan.TESTRUN_TYPES:
+            parser.error("Unknown testrun type: %s" % testrun_type)
+    if len(set(types)) != len(types):
+        parser.error("Testrun types have to be unique.")
+
+    type_args = {}
+    for entry in options.type_args:
+        testrun_type, _, value = entry.partition(':')
+        if not testrun_type in types:
+            parser.error("Arguments for a testrun type which is not "
+                         "executed: %s" % testrun_type)
+        type_args.setdefault(testrun_type, []).extend(shlex.split(value))
+
+    session_plan = get_plan(args[0], types, args[1:], type_args,
+                            application=options.application,
+                            parallel=options.parallel)
+
+    try:
+        session = plan.TestrunPlan(session_plan,
+                                   workspace=options.workspace,
+                                   cache_dir=options.cache_dir)
+    except ValueError, e:
+        parser.error(str(e))
+
+    try:
+        summary = session.run()
+    except Exception:
+        traceback.print_exc()
+        sys.exit(3)
+
+    logger = mozlog.getLogger('mozmill-automation')
+    logger.info('%-12s %-14s %8s %8s %8s' % (
+        'Testrun', 'Status', 'Tests', 'Failed', 'Skipped'))
+    for entry in summary['testruns']:
+        results = entry.get('results') or {}
+        logger.info('%-12s %-14s %8s %8s %8s' % (
+            entry['type'], entry['status'], results.get('tests', '-'),
+            results.get('failures', '-'), results.get('skips', '-')))
+
+    sys.exit(session.get_exit_code())
@@ -5,7 +5,6 @@
 import ConfigParser
 import os
 import optparse
-import re
 import shutil
 import sys
 import tempfile
@@ -20,13 +19,31 @@ import mozinstall
 import mozlog
 import mozmill
 import mozmill.logger
-import mozversion
+from mozprofile.addons import AddonManager
 
+import addons
 import application
+import builds
+import cache
+import deadlines
+import distributed
+import endurance
 import errors
+import fetch
 import files
+import flaky
+import jobs
+import jsonlog
+import merge
+import metrics
+import profiles
 import reports
 import repository
+import resultstore
+import screenshots
+import selection
+import updateproxy
+import workspace
 
 
 MOZMILL_TESTS_REPOSITORIES = {
@@ -35,6 +52,10 @@ MOZMILL_TESTS_REPOSITORIES = {
     'thunderbird' : "http://hg.mozilla.org/users/bugzilla_standard8.plus.com/qa-tests/",
 }
 
+# Sizes reserved in the RAM workspace for entries which grow while testing
+PROFILE_SIZE = 64 * 1024 * 1024
+SCREENSHOTS_SIZE = 64 * 1024 * 1024
+
 APPLICATION_BINARY_NAMES = {
     'firefox' : "firefox",
     'metrofirefox' : "firefox",
@@ -45,32 +66,48 @@ APPLICATION_BINARY_NAMES = {
 class TestRun(object):
     """Base class to execute a Mozmill test-run"""
 
+    # Whether the tests can be distributed to workers in shards
+    supports_sharding = True
+
+    # Whether failed tests can be executed again
+    supports_retries = True
+
     def __init__(self, args=sys.argv[1:], debug=False, manifest_path=None,
                  timeout=None, mozlog_level='INFO'):
 
-        usage = "usage: %prog [options] (binary|folder)"
+        usage = "usage: %prog [options] (binary|folder|url|channel:version[:locale])"
         parser = optparse.OptionParser(usage=usage)
         self.add_options(parser)
         self.options, self.args = parser.parse_args(args)
+        self.original_args = list(args)
 
         if len(self.args) != 1:
             parser.error("Exactly one binary or a folder containing a single " \
                 " binary has to be specified.")
 
+        self.cache_folder = cache.get_cache_folder(self.options.cache_dir)
+        self.build_finder = builds.BuildFinder(
+            self.options.application,
+            cache=cache.JSONCache(self.cache_folder, 'builds'))
+        self.version_cache = cache.JSONCache(self.cache_folder, 'versions')
+        self.duration_cache = cache.JSONCache(self.cache_folder, 'durations')
+        self.version_info = None
+
         self.binary = self.args[0]
         self.debug = debug
         self.timeout = timeout
         self.manifest_path = manifest_path
         self.persisted = {}
 
-        if self.options.workspace:
-            path = os.path.expanduser(self.options.workspace)
-            self.workspace = os.path.abspath(path)
-
-            if not os.path.exists(self.workspace):
-                os.makedirs(self.workspace)
-        else:
-            self.workspace = tempfile.mkdtemp('.workspace')
+        quota = self.options.workspace_quota
+        ram_limit = self.options.ram_workspace
+        self.workspace_manager = workspace.Workspace(
+            self.options.workspace,
+            self.cache_folder,
+            quota=quota * 1024 * 1024 if quota is not None else None,
+            ram_limit=ram_limit * 1024 * 1024 if ram_limit else None,
+            ram_root=self.options.ram_workspace_path)
+        self.workspace = self.workspace_manager.path
 
         # default listeners
         self.listeners = [(self.graphics_event, 'mozmill.graphics')]
@@ -82,8 +119,15 @@ class TestRun(object):
         self.addon_list = []
         self.downloaded_addons = []
         self.preferences = {}
+        self.screenshots = None
+        self.result_store = None
+        self.watchdog = None
 
         self.testrun_index = 0
+        self.active_tests = []
+        self.shard_tests = None
+        self.shard_cancelled = False
+        self.test_selector = None
 
         self.last_failed_tests = None
         self.exception_type = None
@@ -93,6 +137,33 @@ class TestRun(object):
         self.mozlogger = mozlog.getLogger('mozmill-automation')
         self.mozlogger.setLevel(getattr(mozlog, mozlog_level.upper()))
 
+        self.structured_log = None
+        self.structured_log_handler = None
+        self.structured_logging_handler = None
+        if self.options.structured_log:
+            self.structured_log = jsonlog.StructuredLog(
+                self.options.structured_log,
+                max_size=self.options.structured_log_size * 1024 * 1024)
+            self.structured_log_handler = jsonlog.StructuredLogHandler(self.structured_log)
+            self.structured_logging_handler = jsonlog.StructuredLoggingHandler(
+                self.structured_log, self.structured_log_handler)
+            self.mozlogger.addHandler(self.structured_logging_handler)
+
+        # Metrics are only recorded if they get exported
+        self.metrics_server = None
+        if self.options.metrics_file or self.options.metrics_port is not None:
+            labels = {}
+            for label in self.options.metrics_labels:
+                name, _, value = label.partition('=')
+                if not name or not value:
+                    parser.error("Metrics labels have to be specified as NAME=VALUE.")
+                labels[name] = value
+            metrics.enable(labels)
+        if self.options.metrics_port is not None:
+            self.metrics_server = metrics.MetricsServer()
+            self.metrics_server.start(port=self.options.metrics_port)
+            self.mozlogger.info('Serving metrics at port %d' % self.metrics_server.port)
+
 
     def _get_binary(self):
         """ Returns the binary to test. """
@@ -102,6 +173,13 @@ class TestRun(object):
         """ Sets the list of binaries to test. """
         self._binary = None
 
+        # Builds specified by URL or channel and version get downloaded
+        if fetch.is_specifier(build):
+            fetcher = fetch.BuildFetcher(os.path.join(self.cache_folder, 'downloads'),
+                                         application=self.options.application,
+                                         connections=self.options.fetch_connections)
+            build = fetcher.fetch(build)
+
         build = os.path.abspath(build)
 
         if not os.path.exists(build):
@@ -115,16 +193,10 @@ class TestRun(object):
             self._binary = build
             return
 
-        # Otherwise recursively scan the folder and select the first found build
-        for root, dirs, files in os.walk(build):
-            # Ensure we select the build by alphabetical order
-            files.sort()
-
-            for f in files:
-                if not f in [".DS_Store"] and \
-                        application.is_installer(f, self.options.application):
-                    self._binary = os.path.abspath(os.path.join(root, f))
-                    return
+        # Otherwise scan the folder and select the first found build
+        found = self.find_builds(build)
+        if found:
+            self._binary = found[0]
 
     binary = property(_get_binary, _set_binary, None)
 
@@ -141,10 +213,95 @@ class TestRun(object):
                           choices=APPLICATION_BINARY_NAMES.keys(),
                           metavar="APPLICATION",
                           help="application name [default: %default]")
+        parser.add_option("--archive",
+                          dest="archive",
+                          metavar="PATH",
+                          help="folder to archive the raw results and "
+                               "metadata of each testrun in, from which "
+                               "reports can be regenerated with testrun_replay")
+        parser.add_option("--cache-dir",
+                          dest="cache_dir",
+                          metavar="PATH",
+                          help="path to the folder which persists data "
+                               "across testruns [default: %tmp%]")
+        parser.add_option("--changed-tests-only",
+                          dest="changed_tests_only",
+                          default=False,
+                          action="store_true",
+                          help="only run tests affected by changes to the "
+                               "tests repository since the last passing "
+                               "testrun")
+        parser.add_option("--fetch-connections",
+                          dest="fetch_connections",
+                          default=4,
+                          type="int",
+                          metavar="CONNECTIONS",
+                          help="number of parallel connections to download "
+                               "builds which are specified by URL or as "
+                               "channel:version[:locale] [default: %default]")
+        parser.add_option("--full-run-interval",
+                          dest="full_run_interval",
+                          default=10,
+                          type="int",
+                          metavar="RUNS",
+                          help="force a full run after this number of "
+                               "testruns with changed tests only "
+                               "[default: %default]")
+        parser.add_option("--isolation",
+                          dest="isolation",
+                          choices=profiles.ISOLATION_LEVELS,
+                          metavar="LEVEL",
+                          help="isolation of tests which don't specify it in "
+                               "the manifest: restart the application with a "
+                               "restored profile (restart), reset the state "
+                               "of the running application (reset), or share "
+                               "the state (shared) [default: restart with "
+                               "--restart, otherwise shared]")
         parser.add_option("--junit",
                           dest="junit_file",
                           metavar="PATH",
                           help="JUnit XML style report file")
+        parser.add_option("--metrics-file",
+                          dest="metrics_file",
+                          metavar="PATH",
+                          help="write counters and histograms of the "
+                               "testrun to this file in the Prometheus text "
+                               "format, e.g. for the textfile collector")
+        parser.add_option("--metrics-label",
+                          dest="metrics_labels",
+                          default=[],
+                          action="append",
+                          metavar="NAME=VALUE",
+                          help="label to add to all metrics of the testrun, "
+                               "can be specified multiple times")
+        parser.add_option("--metrics-port",
+                          dest="metrics_port",
+                          type="int",
+                          metavar="PORT",
+                          help="serve counters and histograms of the "
+                               "testrun in the Prometheus text format at "
+                               "http://localhost:PORT/metrics")
+        parser.add_option("--quarantine",
+                          dest="quarantine",
+                          default=False,
+                          action="store_true",
+                          help="report tests which are known to be flaky in "
+                               "a separate section, which doesn't affect the "
+                               "exit code")
+        parser.add_option("--ram-workspace",
+                          dest="ram_workspace",
+                          type="int",
+                          metavar="MB",
+                          help="place the installed build, profiles and "
+                               "screenshots in a RAM-backed folder of the "
+                               "given size, and use the disk for entries "
+                               "which don't fit")
+        parser.add_option("--ram-workspace-path",
+                          dest="ram_workspace_path",
+                          default="/dev/shm",
+                          metavar="PATH",
+                          help="RAM-backed file system to use for the RAM "
+                               "workspace [default: %default]")
         parser.add_option("--report",
                           dest="report_url",
                           metavar="URL",
@@ -153,29 +310,110 @@ class TestRun(object):
                           dest="repository_url",
                           metavar="URL",
                           help="URL of a custom repository")
+        parser.add_option("--repository-path",
+                          dest="repository_path",
+                          metavar="PATH",
+                          help="path to an existing checkout of the tests "
+                               "repository, which is used instead of a clone")
         parser.add_option("--restart",
                           dest="restart",
                           default=False,
                           action="store_true",
                           help="restart the application between tests")
+        parser.add_option("--no-test-timeouts",
+                          dest="no_test_timeouts",
+                          default=False,
+                          action="store_true",
+                          help="don't kill tests which exceed the timeout "
+                               "derived from their historical durations")
+        parser.add_option("--retries",
+                          dest="retries",
+                          default=0,
+                          type="int",
+                          metavar="RETRIES",
+                          help="execute failed tests again up to the given "
+                               "number of times, and mark those which pass "
+                               "as flaky [default: %default]")
         parser.add_option("--tag",
                           dest="tags",
                           action="append",
                           metavar="TAG",
                           help="Tag to apply to the report")
+        parser.add_option("--test-timeout-factor",
+                          dest="test_timeout_factor",
+                          default=3,
+                          type="float",
+                          metavar="FACTOR",
+                          help="factor applied to the 99th percentile of "
+                               "the historical durations of a test to get "
+                               "its timeout [default: %default]")
+        parser.add_option("--test-timeout-slack",
+                          dest="test_timeout_slack",
+                          default=30,
+                          type="int",
+                          metavar="SECONDS",
+                          help="time added to the timeout of each test "
+                               "[default: %default]")
         parser.add_option("--workspace",
                           dest="workspace",
                           metavar="PATH",
                           help="path to the workspace folder, which contains "
                                "the testrun data [default: %tmp%]")
+        parser.add_option("--workspace-quota",
+                          dest="workspace_quota",
+                          type="int",
+                          metavar="MB",
+                          help="disk quota for artifacts kept by testruns, "
+                               "whereby those of the least recently used "
+                               "testruns get removed first")
 
         mozmill = optparse.OptionGroup(parser, "Mozmill options")
         mozmill.add_option("-l", "--logfile",
                           dest="logfile",
                           metavar="PATH",
                           help="path to log file")
+        mozmill.add_option("--structured-log",
+                          dest="structured_log",
+                          metavar="PATH",
+                          help="path to a log file which receives all events "
+                               "as JSON lines, including the debug output")
+        mozmill.add_option("--structured-log-size",
+                          dest="structured_log_size",
+                          default=20,
+                          type="int",
+                          metavar="MB",
+                          help="size after which the structured log gets "
+                               "compressed and rotated [default: %default]")
         parser.add_option_group(mozmill)
 
+        sharding = optparse.OptionGroup(parser, "Distribution options")
+        sharding.add_option("--coordinator",
+                            dest="coordinator_port",
+                            type="int",
+                            metavar="PORT",
+                            help="distribute the tests to workers connecting "
+                                 "to the given port and report the merged "
+                                 "results")
+        sharding.add_option("--lease-timeout",
+                            dest="lease_timeout",
+                            default=120,
+                            type="int",
+                            metavar="SECONDS",
+                            help="reassign the shard of a worker which hasn't "
+                                 "responded within this time [default: %default]")
+        sharding.add_option("--shard-size",
+                            dest="shard_size",
+                            default=10,
+                            type="int",
+                            metavar="TESTS",
+                            help="number of tests per shard [default: %default]")
+        sharding.add_option("--worker",
+                            dest="worker_url",
+                            metavar="URL",
+                            help="execute shards of tests retrieved from the "
+                                 "coordinator at the given URL")
+        parser.add_option_group(sharding)
+
     def download_addon(self, url, target_path):
         """ Download the XPI file. """
         try:
@@ -187,11 +425,17 @@ class TestRun(object):
 
             self.mozlogger.info('Downloading %s to %s' % (url, target_path))
             urllib.urlretrieve(url, target_path)
+            metrics.inc('addon_downloads_total', result='success')
 
             return target_path
         except Exception:
+            metrics.inc('addon_downloads_total', result='failure')
             self.mozlogger.exception('Failed to download addon from: %s' % url)
 
+    def find_builds(self, path, first_only=True):
+        """ Returns the builds inside the given folder in alphabetical order. """
+        return self.build_finder.find(path, first_only)
+
     def get_tests_folder(self, *args):
         """ Getting the correct tests path for the testrun. """
 
@@ -221,7 +465,9 @@ class TestRun(object):
     def prepare_application(self, binary):
         # Prepare the binary for the test run
         if application.is_installer(self.binary, self.options.application):
-            install_path = os.path.join(self.workspace, 'binary')
+            # Installers are compressed, so reserve space for the extracted build
+            install_path = self.workspace_manager.get_fast_path(
+                'binary', os.path.getsize(self.binary) * 3)
 
             self.mozlogger.info('Installing build: %s' % self.binary)
             self._folder = mozinstall.install(self.binary, install_path)
@@ -233,17 +479,36 @@ class TestRun(object):
             if os.path.isdir(self.binary):
                 self._folder = self.binary
             else:
-                if mozinfo.isMac:
-                    # Ensure that self._folder is the app bundle on OS X
-                    p = re.compile('.*\.app/')
-                    self._folder = p.search(self.binary).group()
-                else:
-                    self._folder = os.path.dirname(self.binary)
+                self._folder = application.get_application_folder(self.binary)
 
             binary_name = APPLICATION_BINARY_NAMES[self.options.application]
             self._application = mozinstall.get_binary(self._folder,
                                                       binary_name)
 
+    def prepare_repository(self):
+        """ Prepares the tests repository for the branch of the application. """
+        app_repository_url = self.version_info.get('application_repository')
+        branch_name = application.get_mozmill_tests_branch(app_repository_url)
+
+        if self.options.repository_path:
+            # An existing checkout can be shared by multiple testruns, so only
+            # update it if it's not on the expected branch yet
+            self.repository.path = os.path.abspath(self.options.repository_path)
+            self.mozlogger.info('Using test repository at: %s' % self.repository.path)
+            if self.repository.branch == branch_name:
+                metrics.inc('cache_requests_total', cache='repository', result='hit')
+                return
+        else:
+            path = os.path.join(self.workspace, 'mozmill-tests')
+            self.mozlogger.info('Cloning test repository to: %s' % path)
+            self.repository.clone(path)
+
+        metrics.inc('cache_requests_total', cache='repository', result='miss')
+
+        # Update the mozmill-test repository to match the Gecko branch
+        self.mozlogger.info('Updating branch of test repository to: %s' % branch_name)
+        self.repository.update(branch_name)
+
     def graphics_event(self, obj):
         if not self.graphics:
             self.graphics = obj
@@ -261,32 +526,197 @@ class TestRun(object):
     def report_type(self):
         return self.options.application + '-' + self.type
 
-    def run_tests(self):
-        """ Start the execution of the tests. """
+    def get_active_tests(self):
+        """ Returns the tests of the manifest which have to be run. """
         manifest = manifestparser.TestManifest(
             manifests=[os.path.join(self.repository.path, self.manifest_path)],
             strict=False)
 
-        tests = manifest.active_tests(**mozinfo.info)
+        return self.select_tests(manifest.active_tests(**mozinfo.info))
+
+    def select_tests(self, tests):
+        """ Returns the subset of the active tests to run. """
+        if self.shard_tests is not None:
+            tests = [test for test in tests
+                     if distributed.get_test_id(test, self.repository.path) in self.shard_tests]
+
+        if self.test_selector:
+            tests = self.test_selector.select(tests)
+
+        return tests
+
+    def run_tests(self):
+        """ Start the execution of the tests. """
+        tests = self.get_active_tests()
+
+        if self.options.coordinator_port is not None:
+            self.coordinate_tests(tests)
+        elif self.options.worker_url:
+            self.process_shards()
+        elif self.supports_retries and (self.options.retries or self.options.quarantine):
+            self.execute_with_retries(tests)
+        else:
+            self.execute_tests(tests)
+
+    def execute_with_retries(self, tests):
+        """ Executes the tests and retries the failed ones in a new profile. """
+        last_failed_tests = self.last_failed_tests
+
+        # The merged report replaces the one of the first attempt
+        testrun_index = self.testrun_index
+        self.execute_tests(tests, send_reports=False)
+        report = self.result_store.load(testrun_index)
+
+        retry_reports = []
+        failed_files = set(result.get('filename') for result in report['results']
+                           if result.get('failed'))
+        while failed_files and len(retry_reports) < self.options.retries:
+            retry_tests = [test for test in tests
+                           if os.path.abspath(test['path']) in failed_files]
+            if not retry_tests:
+                break
+
+            self.mozlogger.info('Retrying %d failed tests (attempt %d of %d)' % (
+                len(retry_tests), len(retry_reports) + 1, self.options.retries))
+            self.execute_tests(retry_tests, send_reports=False)
+
+            # Retries only contribute to the merged report of the first attempt
+            retry_report = self.result_store.load(self.testrun_index - 1)
+            os.remove(self.result_store.get_filename(self.testrun_index - 1))
+            retry_reports.append(retry_report)
+            failed_files = set(result.get('filename') for result in retry_report['results']
+                               if result.get('failed'))
+
+        history = flaky.FlakinessHistory(cache.JSONCache(self.cache_folder, 'flakiness'),
+                                         '|'.join([self.report_type, self.repository.url]))
+        report = flaky.classify(report, retry_reports, history, self.options.quarantine)
+        history.save()
+
+        for key in report['flaky_tests']:
+            self.mozlogger.warning('Flaky test: %s' % key)
+        for result in report['quarantine']:
+            self.mozlogger.info('Quarantined test: %s (flaky in %.0f%% of runs)' % (
+                flaky.get_test_key(result, self.report_type), result['flaky_rate'] * 100))
+
+        # Only consistent failures of tests outside the quarantine count
+        self.last_failed_tests = last_failed_tests
+        self.send_reports(report, testrun_index)
+
+    def coordinate_tests(self, tests):
+        """ Distributes the tests to workers and reports the merged results. """
+        if not self.supports_sharding:
+            raise errors.NotSupportedTestrunException(self)
+
+        coordinator = distributed.Coordinator(
+            [distributed.get_test_id(test, self.repository.path) for test in tests],
+            shard_size=self.options.shard_size,
+            lease_timeout=self.options.lease_timeout)
+        coordinator.start(port=self.options.coordinator_port)
+        try:
+            shard_reports = coordinator.wait()
+        finally:
+            coordinator.stop()
+
+        if coordinator.failed_shards:
+            raise Exception('Shards could not be executed: %s' %
+                            ', '.join(coordinator.failed_shards))
+
+        # Without active tests there are no shards, and nothing to report
+        if not shard_reports:
+            self.mozlogger.info('No tests have been distributed')
+            return
+
+        self.send_reports(merge.merge_reports(shard_reports))
+
+    def send_reports(self, report, testrun_index=None):
+        """ Sends a report which has been assembled outside of Mozmill.
+
+        The report is stored at the given index, which defaults to the
+        index of the next testrun, and following testruns continue after it.
+        """
+        if testrun_index is None:
+            testrun_index = self.testrun_index
 
-        # instantiate handlers
-        logger = mozmill.logger.LoggerListener(log_file=self.options.logfile,
-                                               console_level=self.debug and 'DEBUG' or 'INFO',
-                                               file_level=self.debug and 'DEBUG' or 'INFO',
-                                               debug=self.debug)
-        handlers = [logger]
         if self.options.report_url:
+            dashboard = reports.DashboardReport(self.options.report_url, self)
+            dashboard.send_report(report, self.options.report_url)
+
+        if self.options.junit_file:
+            filename = files.get_unique_filename(self.options.junit_file,
+                                                 testrun_index)
+            junit = reports.JUnitReport(filename, self)
+            junit.send_report(junit.render(report, str(self.report_type)), filename)
+
+        self.result_store.save(testrun_index, report)
+        self.last_failed_tests = (self.last_failed_tests or
+                                  resultstore.get_failed_tests(report))
+
+        self.testrun_index = testrun_index + 1
+        self.export_metrics()
+
+    def process_shards(self):
+        """ Executes shards of tests retrieved from the coordinator. """
+        if not self.supports_sharding:
+            raise errors.NotSupportedTestrunException(self)
+
+        def execute(shard_tests):
+            self.shard_tests = shard_tests
+            self.shard_cancelled = False
+            try:
+                self.execute_tests(self.get_active_tests(), send_reports=False)
+            finally:
+                self.shard_tests = None
+
+            return self.result_store.load(self.testrun_index - 1)
+
+        def cancel():
+            self.shard_cancelled = True
+            self.kill_application()
+
+        distributed.Worker(self.options.worker_url).run(execute, cancel)
+
+    def execute_tests(self, tests, send_reports=True):
+        """ Executes the given tests with Mozmill. """
+        self.active_tests = tests
+
+        # instantiate handlers, whereby debug output only goes to the
+        # structured log if present, given that it is written asynchronously
+        debug = self.debug and not self.structured_log
+        logger = mozmill.logger.LoggerListener(log_file=self.options.logfile,
+                                               console_level=debug and 'DEBUG' or 'INFO',
+                                               file_level=debug and 'DEBUG' or 'INFO',
+                                               debug=debug)
+        # Results are written to disk, so they don't pile up in memory
+        # across repeated testruns
+        spool = reports.ResultSpool(self.testrun_index, self)
+        handlers = [logger, spool]
+        if self.structured_log_handler:
+            handlers.append(self.structured_log_handler)
+
+        if self.options.report_url and send_reports:
             self.report = reports.DashboardReport(self.options.report_url, self)
             handlers.append(self.report)
 
-        if self.options.junit_file:
+        if self.options.junit_file and send_reports:
             filename = files.get_unique_filename(self.options.junit_file,
                                                  self.testrun_index)
             self.junit_report = reports.JUnitReport(filename, self)
             handlers.append(self.junit_report)
 
+        # Kill tests which are hanging based on their historical durations
+        self.watchdog = None
+        if not self.options.no_test_timeouts:
+            history = deadlines.DurationHistory(self.duration_cache,
+                                                self.get_duration_key())
+            self.watchdog = deadlines.Watchdog(history,
+                                               self.repository.path,
+                                               self.kill_application,
+                                               factor=self.options.test_timeout_factor,
+                                               slack=self.options.test_timeout_slack)
+            handlers.append(self.watchdog)
+
         # instantiate MozMill
-        profile_path = os.path.join(self.workspace, 'profile')
+        profile_path = self.workspace_manager.get_fast_path('profile', PROFILE_SIZE)
         self.mozlogger.info('Creating profile: %s' % profile_path)
 
         profile_args = dict(profile=profile_path,
@@ -308,29 +738,155 @@ class TestRun(object):
             self._mozmill.add_listener(listener[0], eventType=listener[1])
 
         self._mozmill.persisted.update(self.persisted)
+
+        if self.screenshots:
+            self.screenshots.start()
         try:
-            self._mozmill.run(tests, self.options.restart)
+            self.run_isolated(tests, profile_path)
         finally:
-            self.results = self._mozmill.finish()
+            # All screenshots have to be indexed before the reports get sent
+            if self.screenshots:
+                self.screenshots.stop()
+
+            if self.watchdog:
+                self.watchdog.stop()
+
+            self._mozmill.finish()
 
             self.mozlogger.info('Removing profile: %s' % profile_path)
-            mozfile.remove(profile_path)
+            self.workspace_manager.remove(profile_path)
 
         # Whenever a test fails it has to be marked, so we quit with the correct exit code
-        self.last_failed_tests = self.last_failed_tests or self.results.fails
+        self.last_failed_tests = self.last_failed_tests or spool.failed_tests
+
+        # Release the handlers of this testrun and the results they reference
+        self.report = self.junit_report = None
 
         self.testrun_index += 1
+        self.export_metrics()
+
+    def run_isolated(self, tests, profile_path):
+        """ Runs the tests in sessions according to their isolation level. """
+        if not self.options.isolation and \
+                not any(test.get('isolation') for test in tests):
+            self.run_mozmill(tests, self.options.restart)
+            return
+
+        default = self.options.isolation or \
+            ('restart' if self.options.restart else 'shared')
+        segments = profiles.get_segments(tests, default)
+
+        snapshot = None
+        if len(segments) > 1:
+            # The profile gets snapshotted after the first startup, which
+            # also records the baseline state for the reset test
+            self.run_mozmill([profiles.get_reset_test()], False)
+            snapshot = profiles.ProfileSnapshot(profile_path,
+                                                self.workspace_manager.get_fast_path(
+                                                    'profile_snapshot',
+                                                    workspace.get_size(profile_path)))
+            snapshot.take()
+
+        try:
+            for segment in segments:
+                if self.shard_cancelled:
+                    break
+
+                if snapshot:
+                    changed = snapshot.restore()
+                    self.mozlogger.debug('Restored %d files of the profile' % changed)
+                    metrics.inc('cache_requests_total', cache='profile',
+                                result='miss' if changed else 'hit')
+
+                self.run_mozmill(segment, False)
+        finally:
+            if snapshot:
+                self.workspace_manager.remove(snapshot.folder)
+
+    def run_mozmill(self, tests, restart):
+        """ Runs the tests and continues after tests killed by the watchdog. """
+        while tests and not self.shard_cancelled:
+            try:
+                self._mozmill.run(tests, restart)
+            except Exception:
+                if self.shard_cancelled:
+                    break
+                if not self.watchdog or not self.watchdog.expired:
+                    raise
+                self.mozlogger.exception('Application has been killed')
+
+            if not self.watchdog or not self.watchdog.expired:
+                break
+
+            tests = self.watchdog.get_remaining_tests(tests)
+            self.watchdog.expired = None
+
+            if tests:
+                self.mozlogger.info('Continuing with the remaining %d tests' % len(tests))
+
+    def kill_application(self):
+        """ Kills the application to abort a hanging test. """
+        runner = getattr(self._mozmill, 'runner', None)
+        if runner:
+            runner.stop()
+
+    def get_duration_key(self):
+        """ Returns the key of the durations of comparable testruns. """
+        return '|'.join([self.report_type, self.options.application,
+                         'restart' if self.options.restart else 'norestart'])
+
+    def get_archive_filename(self, index):
+        """ Returns the file to archive the raw results of the testrun index in. """
+        return os.path.join(self.options.archive, '%s_%s_%d.json.gz' % (
+            self.report_type, self.workspace_manager.run_id, index))
+
+    def export_metrics(self):
+        """ Writes the recorded metrics to the file for the textfile collector. """
+        if self.options.metrics_file:
+            try:
+                metrics.write(self.options.metrics_file)
+            except Exception:
+                self.mozlogger.exception('Failed to write metrics to: %s' %
+                                         self.options.metrics_file)
+
+    def close_structured_log(self):
+        """ Detaches the structured log from the shared logger and closes it. """
+        if self.structured_logging_handler:
+            self.mozlogger.removeHandler(self.structured_logging_handler)
+            self.structured_logging_handler.close()
+            self.structured_logging_handler = None
+
+        if self.structured_log:
+            self.structured_log.close()
+
+    def stop_metrics(self, result=None):
+        """ Records the result of the testrun and stops exporting metrics. """
+        if result is None:
+            if self.exception_type:
+                result = 'aborted'
+            elif self.last_failed_tests:
+                result = 'failed'
+            else:
+                result = 'passed'
+        metrics.inc('testruns_total', type=self.type, result=result)
+
+        self.export_metrics()
+        if self.metrics_server:
+            self.metrics_server.stop()
 
     def run(self):
         """ Run tests for all specified builds. """
 
         try:
-            self.prepare_application(self.binary)
-            version_info = mozversion.get_version(self._application)
+            with metrics.timed('phase_duration_seconds', type=self.type,
+                               phase='prepare_application'):
+                self.prepare_application(self.binary)
+                self.version_info = application.get_version_info(self._application,
+                                                                 self.version_cache)
 
             self.mozlogger.info('Application: %s %s (%s)' % (
-                version_info.get('application_display_name'),
-                version_info.get('application_version'),
+                self.version_info.get('application_display_name'),
+                self.version_info.get('application_version'),
                 self._application))
 
             self.mozlogger.info('Platform: %s %s %sbit' % (
@@ -338,41 +894,68 @@ class TestRun(object):
                 mozinfo.version,
                 mozinfo.bits))
 
-            path = os.path.join(self.workspace, 'mozmill-tests')
-            self.mozlogger.info('Cloning test repository to: %s' % path)
-            self.repository.clone(path)
-
-            # Update the mozmill-test repository to match the Gecko branch
-            app_repository_url = version_info.get('application_repository')
-            branch_name = application.get_mozmill_tests_branch(app_repository_url)
+            with metrics.timed('phase_duration_seconds', type=self.type,
+                               phase='prepare_repository'):
+                self.prepare_repository()
 
-            self.mozlogger.info('Updating branch of test repository to: %s' % branch_name)
-            self.repository.update(branch_name)
+            if self.options.changed_tests_only:
+                key = '|'.join([self.report_type, self.repository.url,
+                                self.repository.branch])
+                self.test_selector = selection.TestSelector(
+                    self.repository,
+                    cache.JSONCache(self.cache_folder, 'selection'),
+                    key,
+                    full_run_interval=self.options.full_run_interval)
 
             if self.options.addons:
-                self.prepare_addons()
-
-            path = os.path.join(self.workspace, 'screenshots')
-            if not os.path.isdir(path):
-                os.makedirs(path)
+                with metrics.timed('phase_duration_seconds', type=self.type,
+                                   phase='prepare_addons'):
+                    self.prepare_addons()
+
+            path = self.workspace_manager.get_fast_path(
+                os.path.join('screenshots', self.workspace_manager.run_id),
+                SCREENSHOTS_SIZE)
+            os.makedirs(path)
+            self.workspace_manager.track(path)
             self.persisted["screenshotPath"] = path
+            self.screenshots = screenshots.ScreenshotPipeline(path)
+
+            path = self.workspace_manager.create_folder('results',
+                                                        self.workspace_manager.run_id)
+            self.workspace_manager.track(path)
+            self.result_store = resultstore.ResultStore(path)
 
-            self.run_tests()
+            with metrics.timed('phase_duration_seconds', type=self.type,
+                               phase='run_tests'):
+                self.run_tests()
+
+            if self.test_selector:
+                self.test_selector.record(not self.last_failed_tests)
 
         except Exception, e:
             self.exception_type, self.exception, self.tb = sys.exc_info()
 
         finally:
-            # Remove the build when it has been installed before
+            # Remove the build when it has been installed before. On Windows
+            # the uninstaller has to be run, otherwise we can simply delete it
             if application.is_installer(self.binary, self.options.application):
                 self.mozlogger.info('Uninstalling build: %s' % self._folder)
-                mozinstall.uninstall(self._folder)
+                if mozinfo.isWin:
+                    mozinstall.uninstall(self._folder)
+                else:
+                    self.workspace_manager.remove(self._folder)
 
             self.remove_downloaded_addons()
 
             # Remove the temporarily cloned repository
-            self.mozlogger.info('Removing test repository: %s' % self.repository.path)
-            self.repository.remove()
+            if not self.options.repository_path:
+                self.mozlogger.info('Removing test repository: %s' % self.repository.path)
+                self.workspace_manager.remove(self.repository.path)
+
+            self.workspace_manager.close()
+            self.close_structured_log()
+
+            self.stop_metrics()
 
             # If an exception has been thrown, print it here and exit with status 3.
             # Giving that we save reports with failing tests, this one has priority
@@ -390,6 +973,7 @@ class AddonsTestRun(TestRun):
 
     type = "addons"
     report_version = "1.0"
+    supports_sharding = False
 
     def __init__(self, *args, **kwargs):
         TestRun.__init__(self, *args, **kwargs)
@@ -404,6 +988,12 @@ class AddonsTestRun(TestRun):
                           metavar="ID",
                           help="list of add-ons to test from the mozmill-test repository, "
                                "e.g. ide@seleniumhq.org")
+        addons.add_option("--reuse-application",
+                          dest="reuse_application",
+                          default=False,
+                          action="store_true",
+                          help="test all add-ons which can be installed without "
+                               "a restart in a single application session")
         addons.add_option("--with-untrusted",
                           dest="with_untrusted",
                           default=False,
@@ -444,6 +1034,7 @@ class AddonsTestRun(TestRun):
         if not self.options.target_addons:
             self.options.target_addons = self.get_all_addons()
 
+        suites = []
         for addon in self.options.target_addons:
             try:
                 # Resets state of target addon field for every iteration
@@ -470,6 +1061,16 @@ class AddonsTestRun(TestRun):
 
                 self.manifest_path = os.path.join(self._addon_path,
                                                   'tests', 'manifest.ini')
+
+                # Restartless add-ons can share the application session,
+                # and get removed once all suites have been executed
+                if self.options.reuse_application and not self.options.restart and \
+                        addons.is_restartless(self.target_addon):
+                    suites.append({'path': self.target_addon,
+                                   'manifest': self.manifest_path})
+                    self.target_addon = None
+                    continue
+
                 self.addon_list.append(self.target_addon)
                 TestRun.run_tests(self)
 
@@ -486,11 +1087,62 @@ class AddonsTestRun(TestRun):
                     except OSError:
                         self.mozlogger.exception('Failed to remove target add-on: %s' % self.target_addon)
 
+        if suites:
+            try:
+                self.run_addon_suites(suites)
+            except Exception:
+                self.mozlogger.exception('Failed to run tests of restartless add-ons')
+                self.exception_type, self.exception, self.tb = sys.exc_info()
+            finally:
+                for suite in suites:
+                    try:
+                        self.mozlogger.info('Removing target add-on: %s' % suite['path'])
+                        mozfile.remove(suite['path'])
+                    except OSError:
+                        self.mozlogger.exception('Failed to remove target add-on: %s' % suite['path'])
+
+    def run_addon_suites(self, suites):
+        """ Execute the tests of restartless add-ons in a single session. """
+        self.mozlogger.info('Testing %d restartless add-ons in a single session' % len(suites))
+
+        # The helper tests install and uninstall the add-on of each suite,
+        # and reset the preferences to the baseline in between
+        tests = []
+        for suite in suites:
+            suite['details'] = AddonManager.addon_details(suite['path'])
+
+            manifest = manifestparser.TestManifest(manifests=[suite['manifest']],
+                                                   strict=False)
+            tests.append(addons.get_helper_test(addons.INSTALL_TEST))
+            tests.extend(manifest.active_tests(**mozinfo.info))
+            tests.append(addons.get_helper_test(addons.UNINSTALL_TEST))
+
+        self.persisted['addons'] = {'index': 0,
+                                    'suites': [{'id': suite['details']['id'],
+                                                'path': suite['path']}
+                                               for suite in suites]}
+        try:
+            self.execute_tests(tests, send_reports=False)
+        finally:
+            del self.persisted['addons']
+
+        # Report the results of each add-on separately as before
+        index = self.testrun_index - 1
+        report = self.result_store.load(index)
+        os.remove(self.result_store.get_filename(index))
+
+        date_format = reports.DashboardReport(None, self).date_format
+        for suite, suite_report in zip(suites,
+                                       addons.get_suite_reports(report, date_format)):
+            suite_report['target_addon'] = suite['details']
+            self.send_reports(suite_report)
+
 class EnduranceTestRun(TestRun):
     """Class to execute an endurance test-run"""
 
     type = "endurance"
     report_version = "1.2"
+    supports_retries = False
 
     def __init__(self, *args, **kwargs):
 
@@ -502,9 +1154,31 @@ class EnduranceTestRun(TestRun):
 
         self.listeners.append((self.endurance_event, 'mozmill.enduranceResults'))
 
+    def get_duration_key(self):
+        # Durations depend on the amount of iterations and entities
+        key = '|'.join([TestRun.get_duration_key(self),
+                        str(self.options.iterations),
+                        str(self.options.entities),
+                        str(self.options.delay)])
+
+        # Adaptive runs repeat the tests up to the maximum amount of iterations
+        if self.options.precision:
+            key = '|'.join([key, 'adaptive',
+                            str(self.options.min_iterations),
+                            str(self.options.max_iterations or self.options.iterations),
+                            str(self.options.precision)])
+
+        return key
 
     def add_options(self, parser):
         endurance = optparse.OptionGroup(parser, "Endurance options")
+        endurance.add_option("--abort-on-leak",
+                             dest="abort_on_leak",
+                             default=False,
+                             action="store_true",
+                             help="skip the remaining tests when a memory "
+                                  "leak has been detected, whereby tests are "
+                                  "analyzed after all of their iterations")
         endurance.add_option("--delay",
                              dest="delay",
                              default=5,
@@ -526,12 +1200,52 @@ class EnduranceTestRun(TestRun):
                              metavar="ITERATIONS",
                              help="number of iterations to repeat each test "
                                   "snippet [default: %default]")
+        endurance.add_option("--leak-confidence",
+                             dest="leak_confidence",
+                             default=0.95,
+                             type="float",
+                             metavar="CONFIDENCE",
+                             help="confidence level of the growth bound used "
+                                  "for leak detection [default: %default]")
+        endurance.add_option("--leak-growth",
+                             dest="leak_growth",
+                             type="float",
+                             metavar="GROWTH",
+                             help="growth of a metric across all iterations "
+                                  "which is reported as memory leak")
+        endurance.add_option("--leak-slope",
+                             dest="leak_slope",
+                             type="float",
+                             metavar="SLOPE",
+                             help="growth of a metric per iteration which is "
+                                  "reported as memory leak")
+        endurance.add_option("--max-iterations",
+                             dest="max_iterations",
+                             type="int",
+                             metavar="ITERATIONS",
+                             help="maximum number of iterations in adaptive "
+                                  "mode [default: value of --iterations]")
+        endurance.add_option("--min-iterations",
+                             dest="min_iterations",
+                             default=5,
+                             type="int",
+                             metavar="ITERATIONS",
+                             help="minimum number of iterations in adaptive "
+                                  "mode [default: %default]")
         endurance.add_option("--no-restart",
                               dest="no_restart",
                               default=True,
                               action="store_false",
                               help="don't restart the application between "
                                    "tests [default: %default]")
+        endurance.add_option("--precision",
+                             dest="precision",
+                             type="float",
+                             metavar="PRECISION",
+                             help="repeat each test snippet until the 95% "
+                                  "confidence interval of the mean of each "
+                                  "metric is narrower than this fraction of "
+                                  "the mean (adaptive mode)")
         endurance.add_option("--reserved",
                              dest="reserved",
                              type="string",
@@ -545,15 +1259,48 @@ class EnduranceTestRun(TestRun):
     def endurance_event(self, obj):
         self.endurance_results.append(obj)
 
+        leaks = self.leak_detector.add_results(obj)
+        for metric, leak in sorted(leaks.items()):
+            self.mozlogger.warning('Memory leak detected for %s in %s: %.0f per iteration' % (
+                metric, obj.get('name'), leak['slope']))
+
+        if leaks and self.options.abort_on_leak and not self.leak_aborted:
+            self.mozlogger.warning('Skipping remaining tests due to memory leak')
+            self.leak_aborted = True
+
+            # Already finished tests are not affected by being disabled
+            for test in self.active_tests:
+                test.setdefault('disabled', 'Skipped due to detected memory leak')
+
     def run_tests(self):
         """ Execute the endurance tests in sequence. """
 
-        self.endurance_results = []
+        self.endurance_results = resultstore.EventLog(
+            self.result_store.get_filename(self.testrun_index, 'endurance', '.jsonl'))
+        self.leak_detector = endurance.LeakDetector(slope=self.options.leak_slope,
+                                                    growth=self.options.leak_growth,
+                                                    confidence=self.options.leak_confidence)
+        self.leak_aborted = False
         self.persisted['endurance'] = {'delay': self.delay,
                                        'iterations': self.options.iterations,
                                        'entities': self.options.entities,
                                        'restart': self.options.restart}
 
+        # In adaptive mode the tests stop iterating once the requested
+        # precision has been reached, but not before the minimum amount
+        if self.options.precision:
+            max_iterations = self.options.max_iterations or self.options.iterations
+            min_iterations = min(self.options.min_iterations, max_iterations)
+
+            self.persisted['endurance']['iterations'] = max_iterations
+            self.persisted['endurance']['adaptive'] = {
+                'precision': self.options.precision,
+                'confidence': endurance.PRECISION_CONFIDENCE,
+                'z': endurance.normal_quantile(0.5 + endurance.PRECISION_CONFIDENCE / 2),
+                'minIterations': min_iterations,
+                'maxIterations': max_iterations,
+            }
+
         self.manifest_path = self.get_tests_folder()
         if not self.options.reserved:
             self.manifest_path = os.path.join(self.manifest_path,
@@ -592,6 +1339,149 @@ class L10nTestRun(TestRun):
     def __init__(self, *args, **kwargs):
         TestRun.__init__(self, *args, **kwargs)
 
+    def add_options(self, parser):
+        l10n = optparse.OptionGroup(parser, "L10n options")
+        l10n.add_option("--batch",
+                        dest="batch",
+                        default=False,
+                        action="store_true",
+                        help="test all localized builds inside the specified "
+                             "folder")
+        l10n.add_option("--parallel",
+                        dest="parallel",
+                        default=1,
+                        type="int",
+                        metavar="COUNT",
+                        help="number of localized builds to test in parallel "
+                             "in batch mode [default: %default]")
+        parser.add_option_group(l10n)
+
+        TestRun.add_options(self, parser)
+
+    def get_locale(self, build, folder):
+        """ Returns the locale of a build inside the batch folder. """
+        path = os.path.relpath(build, folder)
+
+        # Builds are either stored in a folder named by the locale, or have
+        # the locale in the filename like firefox-38.0.de.linux-x86_64.tar.bz2
+        if os.path.dirname(path):
+            return os.path.basename(os.path.dirname(path))
+
+        match = re.search(r'[.-]([a-z]{2,3}(?:-[a-zA-Z]+)?)\.(?:linux|mac|win)',
+                          os.path.basename(path))
+        if match:
+            return match.group(1)
+
+        return os.path.basename(path)
+
+    def run(self):
+        """ Run tests for a single build or all builds in batch mode. """
+
+        if not self.options.batch:
+            return TestRun.run(self)
+
+        folder = os.path.abspath(self.args[0])
+        builds = self.find_builds(folder, first_only=False)
+        if not builds:
+            raise errors.NotFoundException('No builds found', folder)
+
+        self.mozlogger.info('Testing %d localized builds' % len(builds))
+
+        try:
+            # All builds share the tests repository, so it has to be prepared
+            # only once based on the version of the first build
+            self.binary = builds[0]
+            with metrics.timed('phase_duration_seconds', type=self.type,
+                               phase='prepare_application'):
+                self.prepare_application(self.binary)
+                self.version_info = application.get_version_info(self._application,
+                                                                 self.version_cache)
+            with metrics.timed('phase_duration_seconds', type=self.type,
+                               phase='prepare_repository'):
+                self.prepare_repository()
+
+            if application.is_installer(self.binary, self.options.application):
+                self.workspace_manager.remove(self._folder)
+
+            testrun_jobs = self.get_batch_jobs(folder, builds)
+            jobs.run_jobs(testrun_jobs, self.options.parallel)
+
+        except Exception:
+            traceback.print_exc()
+            self.stop_metrics('aborted')
+            raise errors.TestrunAbortedException(self)
+
+        finally:
+            if not self.options.repository_path:
+                self.mozlogger.info('Removing test repository: %s' % self.repository.path)
+                self.workspace_manager.remove(self.repository.path)
+
+            self.workspace_manager.close()
+            self.close_structured_log()
+
+        summary = [job.get_summary() for job in testrun_jobs]
+        files.JSONFile(os.path.join(self.workspace, 'summary.json')).write(summary)
+
+        self.mozlogger.info('%-12s %-14s %8s %8s %8s' % (
+            'Locale', 'Status', 'Tests', 'Failed', 'Skipped'))
+        for entry in summary:
+            results = entry.get('results') or {}
+            self.mozlogger.info('%-12s %-14s %8s %8s %8s' % (
+                entry['name'], entry['status'], results.get('tests', '-'),
+                results.get('failures', '-'), results.get('skips', '-')))
+
+        exit_code = jobs.get_exit_code(testrun_jobs)
+        self.stop_metrics({0: 'passed', 2: 'failed'}.get(exit_code, 'aborted'))
+
+        if exit_code == 2:
+            raise errors.TestFailedException()
+        elif exit_code == 3:
+            raise errors.TestrunAbortedException(self)
+        elif exit_code == 4:
+            raise errors.NotSupportedTestrunException(self)
+
+    def get_batch_jobs(self, folder, builds):
+        """ Returns the testrun jobs for all builds of the batch. """
+        args = jobs.filter_args(self.original_args,
+                                options=('--junit', '-l', '--logfile',
+                                         '--metrics-file', '--metrics-port',
+                                         '--parallel', '--repository-path',
+                                         '--structured-log', '--workspace'),
+                                flags=('--batch',))
+        args.remove(self.args[0])
+
+        testrun_jobs = []
+        for build in builds:
+            locale = self.get_locale(build, folder)
+            workspace = os.path.join(self.workspace, 'locales', locale)
+
+            job_args = args + ['--workspace', workspace,
+                               '--repository-path', self.repository.path,
+                               '--logfile', os.path.join(workspace, 'mozmill.log')]
+
+            junit_file = None
+            if self.options.junit_file:
+                junit_file = jobs.get_job_filename(self.options.junit_file, locale)
+                job_args.extend(['--junit', junit_file])
+
+            # Each locale is tested in its own process with its own metrics,
+            # which need a label to not collide with those of other locales
+            if self.options.metrics_file:
+                job_args.extend(['--metrics-file',
+                                 jobs.get_job_filename(self.options.metrics_file, locale),
+                                 '--metrics-label', 'locale=%s' % locale])
+
+            # Processes can't share the structured log, given that it gets rotated
+            if self.options.structured_log:
+                job_args.extend(['--structured-log',
+                                 jobs.get_job_filename(self.options.structured_log, locale)])
+
+            testrun_jobs.append(jobs.TestrunJob(locale, self.type, job_args + [build],
+                                                logfile=os.path.join(workspace, 'output.log'),
+                                                junit_file=junit_file))
+
+        return testrun_jobs
+
     def run_tests(self):
         """ Execute the existent l10n tests in sequence. """
 
@@ -624,6 +1514,8 @@ class UpdateTestRun(TestRun):
 
     type = "update"
     report_version = "1.0"
+    supports_sharding = False
+    supports_retries = False
 
     def __init__(self, *args, **kwargs):
         TestRun.__init__(self, *args, **kwargs)
@@ -640,7 +1532,7 @@ class UpdateTestRun(TestRun):
         if self.options.target_buildid == 'None':
             self.options.target_buildid = None
 
-        self.results = [ ]
+        self.update_proxy = None
 
         # Download of updates normally take longer than 60 seconds
         # Soft-timeout is 360s so make the hard-kill timeout 5s longer
@@ -671,6 +1563,29 @@ class UpdateTestRun(TestRun):
                           dest="target_buildid",
                           metavar="TARGET_ID",
                           help="expected build id of the updated build")
+        update.add_option("--update-offline",
+                          dest="update_offline",
+                          default=False,
+                          action="store_true",
+                          help="serve updates only from the recorded update "
+                               "snapshot without accessing the network")
+        update.add_option("--update-prefetch",
+                          dest="update_prefetch",
+                          default=False,
+                          action="store_true",
+                          help="download MAR files of the update proxy as "
+                               "soon as the update snapshot has been retrieved")
+        update.add_option("--update-proxy",
+                          dest="update_proxy",
+                          default=False,
+                          action="store_true",
+                          help="serve updates through a local proxy which "
+                               "caches the update snapshot and MAR files")
+        update.add_option("--update-snapshot",
+                          dest="update_snapshot",
+                          metavar="PATH",
+                          help="folder to record the served updates to, or to "
+                               "replay them from in offline mode")
         parser.add_option_group(update)
 
         TestRun.add_options(self, parser)
@@ -681,10 +1596,11 @@ class UpdateTestRun(TestRun):
         # If a fallback update has to be performed, create a second copy
         # of the application to avoid running the installer twice
         if not self.options.no_fallback:
-            self._backup_folder = os.path.join(self.workspace, 'binary_backup')
+            self._backup_folder = self.workspace_manager.get_fast_path(
+                'binary_backup', workspace.get_size(self._folder))
 
             self.mozlogger.info('Creating backup of binary: %s' % self._backup_folder)
-            mozfile.remove(self._backup_folder)
+            self.workspace_manager.remove(self._backup_folder)
             shutil.copytree(self._folder, self._backup_folder)
 
     def restore_application(self):
@@ -707,18 +1623,37 @@ class UpdateTestRun(TestRun):
         self.mozlogger.info('Restoring backup from: %s' % self._backup_folder)
         shutil.move(self._backup_folder, self._folder)
 
+    def start_update_proxy(self):
+        """ Starts the local proxy which caches the updates. """
+        folder = os.path.join(self.cache_folder, 'updates')
+        self.update_proxy = updateproxy.UpdateProxy(folder,
+                                                    snapshot=self.options.update_snapshot,
+                                                    offline=self.options.update_offline,
+                                                    prefetch=self.options.update_prefetch)
+        self.update_proxy.start()
+
+        url = self.options.override_update_url or updateproxy.DEFAULT_UPDATE_URL
+        self.options.override_update_url = self.update_proxy.get_proxy_url(url)
+
     def run_tests(self):
         """ Start the execution of the tests. """
 
-        # Run direct update test
-        self.run_update_tests(False)
+        if self.options.update_proxy or self.options.update_offline:
+            self.start_update_proxy()
 
-        # Run fallback update test
-        if not self.options.no_fallback:
-            # Restore backup of original application version first
-            self.restore_application()
+        try:
+            # Run direct update test
+            self.run_update_tests(False)
 
-            self.run_update_tests(True)
+            # Run fallback update test
+            if not self.options.no_fallback:
+                # Restore backup of original application version first
+                self.restore_application()
+
+                self.run_update_tests(True)
+        finally:
+            if self.update_proxy:
+                self.update_proxy.stop()
 
     def run_update_tests(self, is_fallback):
         try:
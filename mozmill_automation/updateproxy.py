@@ -0,0 +1,389 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import BaseHTTPServer
+import hashlib
+import os
+import re
+import shutil
+import SocketServer
+import tempfile
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+from xml.sax import saxutils
+
+import mozlog
+
+import cache
+import errors
+import metrics
+
+
+# Default URL used by Firefox to check for updates
+DEFAULT_UPDATE_URL = 'https://aus5.mozilla.org/update/3/%PRODUCT%/%VERSION%/' \
+                     '%BUILD_ID%/%BUILD_TARGET%/%LOCALE%/%CHANNEL%/' \
+                     '%OS_VERSION%/%DISTRIBUTION%/%DISTRIBUTION_VERSION%/update.xml'
+
+CHUNK_SIZE = 64 * 1024
+
+# Segments of the update URL path which differ between machines with the
+# same build, and which are ignored when replaying a snapshot
+UPDATE_URL_SEGMENTS = urlparse.urlparse(DEFAULT_UPDATE_URL).path.split('/')
+MACHINE_SEGMENTS = ('%OS_VERSION%',)
+
+# Entities which have to be escaped in XML attributes
+ATTRIBUTE_ENTITIES = {'"': '&quot;'}
+
+# Size of all cached updates, beyond which the least recently used updates
+# get removed
+CACHE_MAX_SIZE = 5 * 1024 * 1024 * 1024
+
+
+def is_snapshot_url(url):
+    return urlparse.urlparse(url).path.endswith('.xml')
+
+
+def normalize_url(url):
+    """Return the URL without the parts which are specific to a machine, like
+    the version of the operating system in update snapshot URLs, so that
+    snapshots recorded on one machine can be replayed on others.
+    """
+    parsed = urlparse.urlparse(url)
+    segments = [urllib.unquote(segment) for segment in parsed.path.split('/')]
+
+    # Only URLs of the default update service have a known structure
+    if len(segments) == len(UPDATE_URL_SEGMENTS) and \
+            segments[:3] == UPDATE_URL_SEGMENTS[:3]:
+        for index, segment in enumerate(UPDATE_URL_SEGMENTS):
+            if segment in MACHINE_SEGMENTS:
+                segments[index] = segment
+
+    query = urllib.urlencode(sorted(urlparse.parse_qsl(parsed.query,
+                                                       keep_blank_values=True)))
+
+    return urlparse.urlunparse((parsed.scheme, parsed.netloc,
+                                urllib.quote('/'.join(segments)),
+                                parsed.params, query, ''))
+
+
+class UpdateCache(object):
+    """Content-addressed storage for update snapshots and MAR files.
+
+    Once all cached files exceed max_size bytes, the least recently used
+    files get removed.
+    """
+
+    def __init__(self, folder, max_size=None):
+        self.folder = cache.get_cache_folder(folder)
+        self.index = cache.JSONCache(self.folder, 'index')
+        self.max_size = max_size
+
+        self._locks = {}
+        self._lock = threading.Lock()
+        self.logger = mozlog.getLogger('mozmill-automation')
+
+    def _get_lock(self, url):
+        with self._lock:
+            return self._locks.setdefault(url, threading.Lock())
+
+    def get_object_path(self, digest):
+        return os.path.join(self.folder, 'objects', digest[:2], digest)
+
+    def lookup(self, url):
+        """Return the index entry of the URL if its content is available."""
+
+        entry = self.index.get(url)
+        if entry and os.path.isfile(self.get_object_path(entry['sha1'])):
+            return entry
+
+    def fetch(self, url):
+        """Download the content of the URL into the cache and return its entry."""
+
+        response = urllib2.urlopen(url)
+        try:
+            digest = hashlib.sha1()
+            fd, tmp_path = tempfile.mkstemp(dir=self.folder)
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    data = response.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    digest.update(data)
+                    f.write(data)
+
+            path = self.get_object_path(digest.hexdigest())
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+
+            if os.path.isfile(path):
+                os.remove(tmp_path)
+            else:
+                shutil.move(tmp_path, path)
+
+            entry = {'sha1': digest.hexdigest(),
+                     'content_type': response.info().gettype(),
+                     'size': os.path.getsize(path),
+                     'last_used': time.time()}
+        finally:
+            response.close()
+
+        self.index.set(url, entry)
+        self.evict(keep=entry['sha1'])
+
+        return entry
+
+    def add(self, url, entry, path):
+        """Add a file of another cache, which is linked if possible."""
+
+        target = self.get_object_path(entry['sha1'])
+        if not os.path.isfile(target):
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            try:
+                os.link(path, target)
+            except (AttributeError, OSError):
+                shutil.copyfile(path, target)
+
+        self.index.set(url, entry)
+
+    def evict(self, keep=None):
+        """Remove the least recently used files to satisfy the size limit."""
+
+        if self.max_size is None:
+            return
+
+        with self._lock:
+            objects = {}
+            for url, entry in self.index.items():
+                item = objects.setdefault(entry['sha1'], {'urls': [], 'last_used': 0,
+                                                          'size': entry['size']})
+                item['urls'].append(url)
+                item['last_used'] = max(item['last_used'], entry.get('last_used', 0))
+
+            total = sum(item['size'] for item in objects.values())
+            for digest, item in sorted(objects.items(), key=lambda item: item[1]['last_used']):
+                if total <= self.max_size:
+                    break
+                if digest == keep:
+                    continue
+
+                self.logger.info('Removing cached update: %s' % item['urls'][0])
+                path = self.get_object_path(digest)
+                if os.path.isfile(path):
+                    os.remove(path)
+                for url in item['urls']:
+                    self.index.remove(url)
+                total -= item['size']
+
+    def get(self, url, refresh=False):
+        """Return the entry of the URL and download its content if necessary."""
+
+        with self._get_lock(url):
+            entry = None if refresh else self.lookup(url)
+            metrics.inc('cache_requests_total', cache='updates',
+                        result='hit' if entry else 'miss')
+            if not entry:
+                return self.fetch(url)
+
+            # MAR files are requested in many ranges, so the index doesn't
+            # get written for each of them
+            if time.time() - entry.get('last_used', 0) > 60:
+                entry['last_used'] = time.time()
+                self.index.set(url, entry)
+
+            return entry
+
+
+class UpdateProxy(object):
+    """Local HTTP server which serves update snapshots and MAR files from a cache.
+
+    An upstream URL like https://aus5.mozilla.org/update.xml is served under
+    <base_url>/https/aus5.mozilla.org/update.xml. All URLs in update
+    snapshots get rewritten, so that the MAR files are also served by the
+    proxy.
+
+    Served files can be recorded to a snapshot folder, which contains their
+    content and can be copied to other machines. In offline mode only the
+    content of a recorded snapshot is served, whereby requests are matched
+    by their normalized URL.
+    """
+
+    def __init__(self, folder, snapshot=None, offline=False, prefetch=False,
+                 max_size=CACHE_MAX_SIZE):
+        self.cache = UpdateCache(folder, max_size)
+        self.snapshot = snapshot
+        self.offline = offline
+        self.prefetch = prefetch
+
+        self.logger = mozlog.getLogger('mozmill-automation')
+        self.recorded = {}
+        self.server = None
+
+        if self.offline:
+            if not self.snapshot or not os.path.isdir(self.snapshot):
+                raise ValueError('Offline mode requires a recorded snapshot')
+            self.cache = UpdateCache(self.snapshot)
+
+    @property
+    def base_url(self):
+        return 'http://%s:%d' % self.server.server_address
+
+    def get_proxy_url(self, url):
+        """Return the URL of the proxy for the given upstream URL."""
+
+        return '/'.join([self.base_url, url.replace('://', '/', 1)])
+
+    def get_upstream_url(self, path):
+        scheme, _, remainder = path.lstrip('/').partition('/')
+        return '%s://%s' % (scheme, remainder)
+
+    def get_entry(self, url):
+        if self.offline:
+            entry = self.cache.lookup(normalize_url(url))
+            if not entry:
+                raise errors.NotFoundException('Not part of the update snapshot', url)
+            return entry
+
+        # Update snapshots have to be retrieved each time
+        entry = self.cache.get(url, refresh=is_snapshot_url(url))
+        self.recorded[url] = entry
+
+        return entry
+
+    def record(self):
+        """Copy the served files into the snapshot folder."""
+
+        snapshot = UpdateCache(self.snapshot)
+        for url, entry in self.recorded.items():
+            path = self.cache.get_object_path(entry['sha1'])
+            if os.path.isfile(path):
+                snapshot.add(normalize_url(url), entry, path)
+            else:
+                self.logger.warning('Cannot record evicted update: %s' % url)
+
+    def rewrite_snapshot(self, content):
+        """Let all URLs of the update snapshot point to the proxy."""
+
+        # Attribute values are XML escaped, e.g. '&' as '&amp;'
+        urls = [saxutils.unescape(url, ATTRIBUTE_ENTITIES)
+                for url in re.findall(r'URL="([^"]+)"', content)]
+        if self.prefetch and not self.offline:
+            thread = threading.Thread(target=self._prefetch, args=(urls,))
+            thread.daemon = True
+            thread.start()
+
+        def rewrite(match):
+            url = saxutils.unescape(match.group(1), ATTRIBUTE_ENTITIES)
+            return 'URL=%s' % saxutils.quoteattr(self.get_proxy_url(url))
+
+        return re.sub(r'URL="([^"]+)"', rewrite, content)
+
+    def _prefetch(self, urls):
+        for url in urls:
+            try:
+                self.logger.info('Prefetching update: %s' % url)
+                self.get_entry(url)
+            except Exception:
+                self.logger.exception('Failed to prefetch update: %s' % url)
+
+    def start(self, host='127.0.0.1', port=0):
+        parent = self
+
+        class Handler(UpdateRequestHandler):
+            proxy = parent
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.logger.info('Update proxy started at: %s' % self.base_url)
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+        # Record all served files for replaying them in offline mode
+        if self.snapshot and not self.offline:
+            self.record()
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class UpdateRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Request handler which serves content from the update proxy."""
+
+    proxy = None
+
+    def log_message(self, format, *args):
+        self.proxy.logger.debug('Update proxy: %s' % (format % args))
+
+    def do_GET(self):
+        url = self.proxy.get_upstream_url(self.path)
+
+        try:
+            entry = self.proxy.get_entry(url)
+        except errors.NotFoundException:
+            self.send_error(404)
+            return
+        except Exception:
+            self.proxy.logger.exception('Failed to retrieve: %s' % url)
+            self.send_error(502)
+            return
+
+        path = self.proxy.cache.get_object_path(entry['sha1'])
+
+        if is_snapshot_url(url) or 'xml' in entry['content_type']:
+            with open(path, 'rb') as f:
+                content = self.proxy.rewrite_snapshot(f.read())
+            self.send_response(200)
+            self.send_header('Content-Type', entry['content_type'])
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+            return
+
+        # The update service downloads MAR files incrementally via ranges
+        start, end = 0, entry['size'] - 1
+        match = re.match(r'bytes=(\d*)-(\d*)', self.headers.get('Range', ''))
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                if match.group(2):
+                    end = min(int(match.group(2)), end)
+            else:
+                start = max(0, entry['size'] - int(match.group(2)))
+
+            if start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % entry['size'])
+                self.end_headers()
+                return
+
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, entry['size']))
+        else:
+            self.send_response(200)
+
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Type', entry['content_type'])
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+
+        with open(path, 'rb') as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                data = f.read(min(CHUNK_SIZE, remaining))
+                if not data:
+                    break
+                self.wfile.write(data)
+                remaining -= len(data)
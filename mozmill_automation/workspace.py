@@ -0,0 +1,347 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import errno
+import os
+import Queue
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+import mozfile
+import mozlog
+
+import cache
+
+
+def get_size(path):
+    """Return the size of a file or of all files inside a folder."""
+
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+
+    size = 0
+    for root, dirs, files in os.walk(path):
+        # Content of the trash gets removed anyway
+        if '.trash' in dirs:
+            dirs.remove('.trash')
+
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+
+    return size
+
+
+class Reaper(object):
+    """Class to run removals of files and folders in a background thread."""
+
+    def __init__(self):
+        self.logger = mozlog.getLogger('mozmill-automation')
+        self.queue = Queue.Queue()
+
+        # The thread doesn't keep the process alive, given that unfinished
+        # removals are picked up by the next workspace
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            method, args = self.queue.get()
+            try:
+                method(*args)
+            except Exception:
+                self.logger.exception('Background task failed: %s%s' % (method.__name__, args))
+            finally:
+                self.queue.task_done()
+
+    def schedule(self, method, *args):
+        """Schedule the method to be called in the background."""
+
+        self.queue.put((method, args))
+
+    def remove(self, path):
+        self.schedule(mozfile.remove, path)
+
+
+def is_process_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+
+    return True
+
+
+class RamArea(object):
+    """Class to manage a size-limited folder on a RAM-backed file system.
+
+    The folder is unique for each testrun, and gets removed once the testrun
+    has been finished. Folders of testruns whose process is no longer
+    running are removed when a new area gets created.
+    """
+
+    PREFIX = 'mozmill-automation-'
+
+    def __init__(self, limit, root='/dev/shm', run_id=None):
+        self.logger = mozlog.getLogger('mozmill-automation')
+
+        self.limit = limit
+        self.root = root
+
+        for entry in os.listdir(self.root):
+            if entry.startswith(self.PREFIX):
+                pid = entry[len(self.PREFIX):].split('-', 1)[0]
+                if pid.isdigit() and not is_process_running(int(pid)):
+                    self.logger.info('Removing stale RAM workspace: %s' % entry)
+                    mozfile.remove(os.path.join(self.root, entry))
+
+        self.path = os.path.join(self.root, '%s%d-%s' % (self.PREFIX, os.getpid(), run_id))
+        os.makedirs(self.path)
+
+    def contains(self, path):
+        return os.path.abspath(path).startswith(os.path.join(self.path, ''))
+
+    def get_free_space(self):
+        """Return the space left within the limit and on the file system."""
+
+        stat = os.statvfs(self.root)
+        return min(self.limit - get_size(self.path), stat.f_bavail * stat.f_frsize)
+
+    def allocate(self, name, size):
+        """Return the path for an entry of the given size, or None if it
+        wouldn't fit.
+        """
+        if size > self.get_free_space():
+            return None
+
+        return os.path.join(self.path, name)
+
+    def close(self):
+        mozfile.remove(self.path)
+
+
+class Workspace(object):
+    """Class to manage the workspace of testruns.
+
+    Artifacts created by a testrun are tracked in a registry which is shared
+    by all testruns. If a disk quota has been specified, artifacts of the
+    least recently used testruns get removed once it has been exceeded.
+    Files and folders are removed by a background thread, after they have
+    been moved into the trash folder of the workspace. Trash folders are
+    registered as well, so removals which haven't been finished when the
+    process exits are completed by the next testrun.
+    """
+
+    def __init__(self, path=None, cache_folder=None, quota=None,
+                 ram_limit=None, ram_root='/dev/shm'):
+        self.logger = mozlog.getLogger('mozmill-automation')
+
+        self.temporary = not path
+        if path:
+            self.path = os.path.abspath(os.path.expanduser(path))
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+        else:
+            self.path = tempfile.mkdtemp('.workspace')
+
+        self.quota = quota
+        self.run_id = '%s-%s' % (time.strftime('%Y%m%d%H%M%S'), uuid.uuid4().hex[:8])
+        self.artifacts = [self.path] if self.temporary else []
+
+        self.registry = cache.JSONCache(cache.get_cache_folder(cache_folder),
+                                        'workspaces')
+        self.reaper = Reaper()
+        self._lock = threading.Lock()
+
+        # I/O heavy parts of the workspace can be placed in RAM
+        self.ram = None
+        self.ram_artifacts = []
+        if ram_limit:
+            try:
+                self.ram = RamArea(ram_limit, ram_root, self.run_id)
+                self.logger.info('Using RAM workspace at: %s' % self.ram.path)
+            except OSError:
+                self.logger.warning('RAM workspace not available at %s, using the disk' % ram_root)
+
+        # Remove leftovers of previous testruns, whereby the own trash gets
+        # registered again when the workspace is closed
+        own_trash = self.get_path('.trash')
+        self._update_trash(own_trash, False)
+        for trash in self.registry.get('trash', []) + [own_trash]:
+            if os.path.isdir(trash):
+                for entry in os.listdir(trash):
+                    self.reaper.remove(os.path.join(trash, entry))
+            if trash != own_trash:
+                self.reaper.schedule(self.remove_trash, trash)
+
+        if self.quota is not None:
+            self.reaper.schedule(self.enforce_quota)
+
+    def get_path(self, *names):
+        """Return the path of an entry inside the workspace."""
+
+        return os.path.join(self.path, *names)
+
+    def get_fast_path(self, name, size=0):
+        """Return the path of an entry, which is placed in RAM if available
+        and the expected size fits into it.
+        """
+        if self.ram:
+            path = self.ram.allocate(name, size)
+            if path:
+                return path
+
+            self.logger.info('Not enough space in RAM for %s (%d bytes), using the disk' % (
+                name, size))
+
+        return self.get_path(name)
+
+    def get_persistent_path(self, path):
+        """Return the path an entry of the RAM workspace is synced to."""
+
+        if self.ram and self.ram.contains(path):
+            return self.get_path(os.path.relpath(path, self.ram.path))
+
+        return path
+
+    def create_folder(self, *names):
+        """Create a folder inside the workspace and return its path."""
+
+        path = self.get_path(*names)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        return path
+
+    def track(self, path):
+        """Track an artifact which has to be kept after the testrun."""
+
+        # Artifacts in RAM are synced to their persistent path at the end
+        if self.ram and self.ram.contains(path) and not path in self.ram_artifacts:
+            self.ram_artifacts.append(path)
+        path = self.get_persistent_path(path)
+
+        if not self.temporary and not path in self.artifacts:
+            self.artifacts.append(path)
+
+    def remove(self, path):
+        """Remove the file or folder in the background."""
+
+        if not os.path.exists(path):
+            return
+
+        # Removals in RAM are fast enough to not need the background thread
+        if self.ram and self.ram.contains(path):
+            mozfile.remove(path)
+            return
+
+        # Moving the entry to the trash frees up the path immediately
+        trash = self.create_folder('.trash')
+        target = os.path.join(trash, uuid.uuid4().hex)
+        try:
+            os.rename(path, target)
+        except OSError:
+            self.logger.info('Removing: %s' % path)
+            mozfile.remove(path)
+            return
+
+        self.reaper.remove(target)
+
+    def enforce_quota(self):
+        """Remove artifacts of the least recently used testruns to satisfy the quota."""
+
+        runs = self.registry.get('runs', {}).values()
+        total = sum(run['size'] for run in runs)
+
+        # Artifacts of the current testrun are never removed
+        runs = [run for run in runs if run['id'] != self.run_id]
+        for run in sorted(runs, key=lambda run: run['last_used']):
+            if total <= self.quota:
+                break
+
+            self.logger.info('Removing artifacts of testrun %s (%d bytes)' % (
+                run['id'], run['size']))
+            for path in run['artifacts']:
+                mozfile.remove(path)
+
+            total -= run['size']
+            self._update_registry(run['id'], None)
+
+    def remove_trash(self, trash):
+        """Remove an empty trash folder and unregister it."""
+
+        try:
+            os.rmdir(trash)
+        except OSError:
+            # Still in use by another testrun
+            if os.path.isdir(trash):
+                return
+
+        self._update_trash(trash, False)
+
+    def _update_trash(self, trash, registered):
+        with self._lock:
+            folders = self.registry.get('trash', [])
+            if registered and not trash in folders:
+                self.registry.set('trash', folders + [trash])
+            elif not registered and trash in folders:
+                folders.remove(trash)
+                self.registry.set('trash', folders)
+
+    def _update_registry(self, run_id, run):
+        with self._lock:
+            runs = self.registry.get('runs', {})
+            if run:
+                runs[run_id] = run
+            else:
+                runs.pop(run_id, None)
+            self.registry.set('runs', runs)
+
+    def sync(self):
+        """Move the artifacts inside the RAM workspace to the disk."""
+
+        for path in self.ram_artifacts:
+            if not os.path.exists(path):
+                continue
+
+            target = self.get_persistent_path(path)
+            self.logger.info('Syncing artifact to: %s' % target)
+            if os.path.exists(target):
+                mozfile.remove(target)
+            elif not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            shutil.move(path, target)
+
+    def close(self):
+        """Register the artifacts and the trash of this testrun, and enforce
+        the quota. Pending removals are not waited for.
+        """
+        if self.ram:
+            self.sync()
+            self.ram.close()
+            self.ram = None
+
+        artifacts = [path for path in self.artifacts if os.path.exists(path)]
+        if artifacts:
+            self._update_registry(self.run_id, {
+                'id': self.run_id,
+                'artifacts': artifacts,
+                'size': sum(get_size(path) for path in artifacts),
+                'last_used': time.time()})
+
+        # The background thread dies with the process, so whatever is left in
+        # the trash gets removed by the next testrun, even for temporary
+        # workspaces which are never used again
+        trash = self.get_path('.trash')
+        if os.path.isdir(trash):
+            self._update_trash(trash, True)
+
+        if self.quota is not None:
+            self.reaper.schedule(self.enforce_quota)
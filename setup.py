@@ -24,6 +24,9 @@ deps = ['mercurial == 2.6.2',
         'mozversion >= 0.7',
         ]
 
+# Optional dependencies of scripts which are not needed to run tests
+extras = {'compare': ['numpy >= 1.9']}
+
 setup(name=NAME,
       version=VERSION,
       description="Automation scripts for Mozmill test execution",
@@ -46,14 +49,21 @@ setup(name=NAME,
       include_package_data=True,
       zip_safe=False,
       install_requires=deps,
+      extras_require=extras,
       entry_points="""
       # -*- Entry points: -*-
       [console_scripts]
       testrun_addons = mozmill_automation:addons_cli
+      testrun_compare = mozmill_automation:compare_cli
       testrun_endurance = mozmill_automation:endurance_cli
       testrun_functional = mozmill_automation:functional_cli
       testrun_l10n = mozmill_automation:l10n_cli
+      testrun_logquery = mozmill_automation:logquery_cli
+      testrun_merge = mozmill_automation:merge_cli
+      testrun_plan = mozmill_automation:plan_cli
       testrun_remote = mozmill_automation:remote_cli
+      testrun_replay = mozmill_automation:replay_cli
+      testrun_session = mozmill_automation:session_cli
       testrun_update = mozmill_automation:update_cli
       """,
       )